@@ -0,0 +1,192 @@
+"""
+Timings and query counts of canvas hot paths as grids and histories grow.
+
+The tests check correctness on 2x2 and 3x3 grids, where costs growing with
+the number of cells or edits don't show. benchmark_grid times generating a
+grid, assigning cells, saving an edit with neighbour propagation and
+assembling a canvas snapshot at a grid size; benchmark_history times
+looking up history on a cell with a number of edits.
+
+Each benchmark runs in a transaction that is rolled back, so can run
+against a development database. Results are a JSON document
+
+    {"commit": git revision, "created": ISO time, "python": version,
+     "results": [{"benchmark", "grid_size", "depth", "repeat", "seconds",
+                  "queries"}, ...]}
+
+with the median seconds of repeat runs and queries of the last run, for
+compare_results to set against a run at another commit (see the benchmark
+management command).
+"""
+from datetime import timedelta
+from platform import python_version
+from statistics import median
+from subprocess import CalledProcessError, check_output
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .models import VisualCanvas
+
+GRID_SIZES = (8, 16, 32, 64, 128, 256)
+
+HISTORY_DEPTHS = (10, 100, 1000, 10000)
+
+# Grid size history benchmarks are run on
+HISTORY_GRID_SIZE = 8
+
+
+def measure(function: Callable, repeat: int = 1) -> Tuple[float, int, Any]:
+    """Median seconds, and queries and result of the last of repeat runs."""
+    seconds = []
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            start = perf_counter()
+            result = function()
+            seconds.append(perf_counter() - start)
+    return median(seconds), len(queries), result
+
+
+def result(benchmark: str, grid_size: int, seconds: float, queries: int,
+           repeat: int, depth: int = None) -> dict:
+    return {'benchmark': benchmark, 'grid_size': grid_size, 'depth': depth,
+            'repeat': repeat, 'seconds': seconds, 'queries': queries}
+
+
+def create_user(**kwargs):
+    return get_user_model().objects.create(
+        username=f'benchmark-{uuid4().hex[:12]}', **kwargs)
+
+
+def create_canvas(grid_size: int) -> VisualCanvas:
+    now = timezone.now()
+    return VisualCanvas.objects.create(
+        title=f'Benchmark {uuid4().hex[:8]}', creator=create_user(),
+        start_time=now, end_time=now + timedelta(days=1),
+        grid_width=grid_size, grid_height=grid_size)
+
+
+def get_centre_cell(canvas):
+    x, y = canvas.get_centre_cell_coordinates()
+    return canvas.visual_cells.get(x_position=x, y_position=y)
+
+
+def get_boundary_patch(cell, value: int):
+    """Set the first position of every shared edge segment to value."""
+    patch = {}
+    for portion in cell.adjacent_neighbour_portions.values():
+        edge_name = portion['edge_name']
+        index = cell.get_portion_indices(
+            cell.lattice_dimensions[edge_name], portion['self_portion'])[0]
+        patch[edge_name, index] = value
+    return [(edge_name, index, value)
+            for (edge_name, index), value in patch.items()]
+
+
+def benchmark_grid(grid_size: int, repeat: int = 3) -> List[dict]:
+    """Generate a grid_size square grid and time operations on it."""
+    results = []
+    with transaction.atomic():
+        seconds, queries, canvas = measure(
+            lambda: create_canvas(grid_size))
+        results.append(result('grid_generation', grid_size, seconds,
+                              queries, 1))
+
+        artists = [create_user() for _ in range(repeat)]
+        seconds, queries, _ = measure(
+            lambda: canvas.get_or_assign_cell(artists.pop()), repeat)
+        results.append(result('cell_assignment', grid_size, seconds,
+                              queries, repeat))
+
+        cell = get_centre_cell(canvas)
+        values = iter(range(repeat))
+        seconds, queries, _ = measure(
+            lambda: cell.apply_edit_patch(
+                get_boundary_patch(cell, (next(values) + 1) % 2)),
+            repeat)
+        results.append(result('edit_save', grid_size, seconds, queries,
+                              repeat))
+
+        seconds, queries, _ = measure(lambda: canvas.get_changes_since(0),
+                                      repeat)
+        results.append(result('snapshot', grid_size, seconds, queries,
+                              repeat))
+        transaction.set_rollback(True)
+    return results
+
+
+def benchmark_history(depth: int, repeat: int = 3,
+                      grid_size: int = HISTORY_GRID_SIZE) -> List[dict]:
+    """Add depth edits to a cell and time history lookups."""
+    results = []
+    with transaction.atomic():
+        canvas = create_canvas(grid_size)
+        cell = get_centre_cell(canvas)
+        start_sequence = VisualCanvas.objects.get(pk=canvas.pk).sequence
+        # Diagonal edges aren't shared, so nothing propagates
+        edits = cell.apply_edit_patches(
+            [[('edges_south_east', 0, (number + 1) % 2)]
+             for number in range(depth)])
+        # Edits cache their neighbours in order, so each run loads afresh
+        edits = cell.edits.filter(pk=edits[-1].pk)
+        for benchmark, function in (
+                ('history_latest_valid_edit',
+                 lambda: cell.latest_valid_edit),
+                ('history_number', lambda: edits.get().history_number),
+                ('history_edit_number', lambda: edits.get().edit_number),
+                ('history_previous_valid_edit',
+                 lambda: edits.get().get_previous_valid_edit()),
+                ('history_catch_up',
+                 lambda: canvas.get_changes_since(start_sequence))):
+            seconds, queries, _ = measure(function, repeat)
+            results.append(result(benchmark, grid_size, seconds, queries,
+                                  repeat, depth))
+        transaction.set_rollback(True)
+    return results
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return check_output(['git', 'rev-parse', 'HEAD'],
+                            cwd=str(settings.ROOT_DIR)).decode().strip()
+    except (CalledProcessError, OSError):
+        return None
+
+
+def run_benchmarks(grid_sizes=GRID_SIZES, depths=HISTORY_DEPTHS,
+                   repeat: int = 3) -> dict:
+    results: List[dict] = []
+    for grid_size in grid_sizes:
+        results += benchmark_grid(grid_size, repeat)
+    for depth in depths:
+        results += benchmark_history(depth, repeat)
+    return {'commit': get_commit(), 'created': timezone.now().isoformat(),
+            'python': python_version(), 'results': results}
+
+
+def compare_results(previous: dict, current: dict) -> List[Dict]:
+    """Pair up results of two runs, with the ratio of current to previous."""
+    previous_results = {(row['benchmark'], row['grid_size'], row['depth']): row
+                        for row in previous['results']}
+    comparison = []
+    for row in current['results']:
+        before = previous_results.get(
+            (row['benchmark'], row['grid_size'], row['depth']))
+        if not before:
+            continue
+        comparison.append({
+            'benchmark': row['benchmark'], 'grid_size': row['grid_size'],
+            'depth': row['depth'],
+            'previous_seconds': before['seconds'],
+            'seconds': row['seconds'],
+            'ratio': (row['seconds'] / before['seconds']
+                      if before['seconds'] else None),
+            'previous_queries': before['queries'],
+            'queries': row['queries']})
+    return comparison
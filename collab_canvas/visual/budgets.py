@@ -0,0 +1,86 @@
+"""
+Query budgets: the most queries and seconds visual views and model
+operations may take, on a canvas of any size or history depth.
+
+Tests on 2x2 and 3x3 grids pass however many queries a cell or edit costs,
+so BUDGETS declares a Budget for each view, by URL name (hyphenated), and
+each hot model operation (underscored, as named in benchmarks). check_budget
+measures a block against one
+
+    with check_budget('cell-edit-patch'):
+        client.post(...)
+
+raising BudgetExceeded with the queries run if it goes over. The visual
+tests check every budget on a 16x16 grid with deep history (see
+tests/test_budgets.py), so an N+1 regression fails the build: raise a budget
+only for a constant number of new queries. View budgets include the session
+and user lookups of a logged in request.
+
+Seconds are generous ceilings, to catch an operation becoming orders of
+magnitude slower rather than machine noise. VISUAL_BUDGET_SECONDS_SCALE
+multiplies them for slower machines, or 0 only checks queries.
+"""
+from contextlib import contextmanager
+from time import perf_counter
+from typing import NamedTuple
+
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+class Budget(NamedTuple):
+    queries: int
+    seconds: float = 1
+
+
+BUDGETS = {
+    # Views, including a new artist assigned a cell by canvas
+    'canvas': Budget(12),
+    'canvas-changes': Budget(8),
+    'canvas-presence': Budget(4),
+    'cell': Budget(3),
+    'cell-history': Budget(3),
+    'cell-valid-edit': Budget(3),
+    'cell-edit': Budget(4),
+    'cell-edit-patch': Budget(43),
+    'cell-edit-batch': Budget(43),
+    'cell-edit-success': Budget(4),
+    'instrumentation': Budget(4),
+    # Operations. Saving edits costs 7 queries per neighbour dispatched
+    # to, of 4, however many edits are saved
+    'cell_assignment': Budget(9),
+    'edit_save': Budget(41),
+    'edit_batch': Budget(40),
+    'snapshot': Budget(3),
+    'catch_up': Budget(4),
+    'neighbours': Budget(8),
+    'history_latest_valid_edit': Budget(1),
+    'history_number': Budget(2),
+    'history_edit_number': Budget(2),
+    'history_previous_valid_edit': Budget(1),
+}
+
+
+class BudgetExceeded(AssertionError):
+    pass
+
+
+@contextmanager
+def check_budget(name: str, budget: Budget = None):
+    """Raise BudgetExceeded if the block goes over name's budget."""
+    budget = budget or BUDGETS[name]
+    scale = settings.VISUAL_BUDGET_SECONDS_SCALE
+    with CaptureQueriesContext(connection) as context:
+        start = perf_counter()
+        yield context
+        seconds = perf_counter() - start
+    queries = len(context.captured_queries)
+    if queries > budget.queries:
+        raise BudgetExceeded(
+            f"{name} ran {queries} queries, over its budget of "
+            f"{budget.queries}:\n" +
+            "\n".join(query['sql'] for query in context.captured_queries))
+    if scale and seconds > budget.seconds * scale:
+        raise BudgetExceeded(f"{name} took {seconds:.3f}s, over its budget "
+                             f"of {budget.seconds * scale:.3f}s")
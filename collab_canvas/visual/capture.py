@@ -0,0 +1,187 @@
+"""
+Capture of live workloads, to replay against a fresh database (see replay).
+
+With VISUAL_CAPTURE_LOG set every cell assignment, edit request and
+websocket message is appended to that file as a compact JSON line once
+handled, with when it started (t, epoch seconds) and how long it took (d):
+
+    {"k":"assign","t":..,"d":..,"canvas":id,"cell":id,"x":0,"y":1,
+     "user":id}
+    {"k":"request","t":..,"d":..,"view":"cell-edit-patch","canvas":id,
+     "cell":id,"x":0,"y":1,"user":id,"data":{...},"status":201}
+    {"k":"connect","t":..,"d":..,"conn":channel,"canvas":id,"cell":id,
+     "x":0,"y":1,"user":id,"binary":true}
+    {"k":"message","t":..,"d":..,"conn":channel,"message":{...}}
+    {"k":"disconnect","t":..,"d":..,"conn":channel}
+
+Connecting and disconnecting are written as taking no time. Users are
+their ids, with "superuser":true if so. Each process also writes
+a "canvas" line with a canvas' settings before its first event, so a
+replay can create a canvas like it.
+
+Events are queued for a writer thread per process, so the event loop and
+requests never wait on the disk. It keeps the file open for appending and
+writes whatever lines are queued at once, always whole lines, so processes
+can share a file. flush_events waits for the events queued so far.
+"""
+from atexit import register
+from contextlib import contextmanager
+from itertools import groupby
+from json import dumps
+from logging import getLogger
+from os import getpid
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import perf_counter, time
+from typing import List, Optional, Set, TextIO, Tuple
+from uuid import UUID
+
+from django.conf import settings
+from django.views.generic.edit import ProcessFormView
+
+CANVAS_FIELDS = ('grid_width', 'grid_height', 'cell_width', 'cell_height',
+                 'cell_colour_range', 'is_torus', 'new_cells_allowed')
+
+logger = getLogger(__name__)
+
+_writer_lock = Lock()
+_writer: Optional['CaptureWriter'] = None
+_captured_canvases: Set[UUID] = set()
+
+
+class CaptureWriter(Thread):
+
+    """Append queued (path, line) pairs to capture logs, kept open."""
+
+    def __init__(self):
+        super().__init__(name='visual-capture-writer', daemon=True)
+        self.pid = getpid()
+        self.lines: Queue = Queue()
+        self.path: Optional[str] = None
+        self.log: Optional[TextIO] = None
+
+    def run(self):
+        while True:
+            lines = [self.lines.get()]
+            while True:
+                try:
+                    lines.append(self.lines.get_nowait())
+                except Empty:
+                    break
+            try:
+                self.write(lines)
+            except OSError:
+                logger.exception(f"Lost {len(lines)} captured events")
+                self.close()
+            finally:
+                for _ in lines:
+                    self.lines.task_done()
+
+    def write(self, lines: List[Tuple[str, str]]):
+        for path, path_lines in groupby(lines, key=lambda line: line[0]):
+            if self.log is None or path != self.path:
+                self.close()
+                self.log = open(path, 'a')
+                self.path = path
+            self.log.write(''.join(line for _, line in path_lines))
+            self.log.flush()
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+        self.log = self.path = None
+
+
+def get_writer() -> CaptureWriter:
+    """This process' writer, started on first use (and again if forked)."""
+    global _writer
+    with _writer_lock:
+        if _writer is None or _writer.pid != getpid():
+            _writer = CaptureWriter()
+            _writer.start()
+        return _writer
+
+
+@register
+def flush_events():
+    """Wait until events queued so far are written."""
+    if _writer is not None and _writer.pid == getpid():
+        _writer.lines.join()
+
+
+def is_capturing() -> bool:
+    return bool(settings.VISUAL_CAPTURE_LOG)
+
+
+def write_event(event: dict):
+    line = dumps(event, separators=(',', ':'), default=str) + '\n'
+    get_writer().lines.put((settings.VISUAL_CAPTURE_LOG, line))
+
+
+def capture_canvas(canvas):
+    """Write a canvas' settings the first time this process sees it."""
+    if not is_capturing() or canvas.id in _captured_canvases:
+        return
+    write_event({'k': 'canvas', 'canvas': canvas.id,
+                 'creator': canvas.creator_id,
+                 **{field: getattr(canvas, field) for field in CANVAS_FIELDS}})
+    _captured_canvases.add(canvas.id)
+
+
+def get_user_fields(user) -> dict:
+    if user.is_superuser:
+        return {'user': user.id, 'superuser': True}
+    return {'user': user.id}
+
+
+def get_cell_fields(cell) -> dict:
+    capture_canvas(cell.canvas)
+    return {'canvas': cell.canvas_id, 'cell': cell.id, 'x': cell.x_position,
+            'y': cell.y_position}
+
+
+@contextmanager
+def capture(kind: str, **fields):
+    """
+    Time the block and write it as an event of kind, if capturing.
+
+    Yields a dict to add fields to that are only known within the block,
+    such as the cell assigned or a response status.
+    """
+    event = {'k': kind, 't': 0, 'd': 0, **fields}
+    if not is_capturing():
+        yield event
+        return
+    start, started = time(), perf_counter()
+    try:
+        yield event
+    except Exception as error:
+        event['error'] = type(error).__name__
+        raise
+    finally:
+        event['t'] = round(start, 6)
+        event['d'] = round(perf_counter() - started, 6)
+        write_event(event)
+
+
+def capture_event(kind: str, **fields):
+    """Write an event of kind that takes no time, if capturing."""
+    if is_capturing():
+        write_event({'k': kind, 't': round(time(), 6), 'd': 0, **fields})
+
+
+class CaptureEditMixin(ProcessFormView):
+
+    """Capture posts to an edit view, once it has checked the cell."""
+
+    def post(self, request, *args, **kwargs):
+        if not is_capturing():
+            return super().post(request, *args, **kwargs)
+        data = request.POST.dict()
+        data.pop('csrfmiddlewaretoken', None)
+        with capture('request', view=request.resolver_match.url_name,
+                     **get_cell_fields(self.cell),
+                     **get_user_fields(request.user), data=data) as event:
+            response = super().post(request, *args, **kwargs)
+            event['status'] = response.status_code
+        return response
@@ -1,19 +1,545 @@
-from channels.consumer import AsyncConsumer
+from asyncio import (Future, Lock, Queue, TimeoutError, ensure_future,
+                     sleep, wait_for)
+from json import dumps
+from logging import getLogger
+from typing import Dict, Optional, Set, Tuple
+from urllib.parse import parse_qs
+from uuid import UUID
+
+from asgiref.sync import sync_to_async
 from channels.db import database_sync_to_async
+from channels.exceptions import StopConsumer
+from channels.generic.http import AsyncHttpConsumer
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+from . import metrics
+from .capture import (capture, capture_event, get_cell_fields,
+                      get_user_fields)
+from .flow import OutboundQueue, TokenBucket
+from .forms import clean_patch_changes
+from .models import VisualCanvas, VisualCell, VisualCellEdit
+from .presence import get_presence
+from .profiling import is_profile_requested, profile
+from .protocol import (BINARY_SUBPROTOCOL, ProtocolError, decode_frame,
+                       decode_json, encode_frame, encode_json)
+from .tracing import trace
+
+logger = getLogger(__name__)
+
+
+class VisualCellEditConsumer(AsyncWebsocketConsumer):
+
+    """
+    A websocket means of updating neighbours on edits in real time.
+
+    Each connection joins only the channel layer groups for the neighbours'
+    edges shared with its cell, so a committed edit is sent to at most the
+    four adjacent cells and each receives only its shared edge segment
+    (see VisualCell.send_neighbour_edge_changes).
+
+    Edits are sent as {"type": "patch", "patch": [[edge_name, index,
+    value], ...], "base_edit": id, "idempotency_key": key} and applied as in
+    VisualCellEditPatchView. Clients requesting the BINARY_SUBPROTOCOL
+    exchange packed frames (see protocol), otherwise messages are JSON.
+
+    If VISUAL_EDIT_FLUSH_INTERVAL is set patches are instead applied to an
+    in memory lattice of the cell's edges, acknowledged and sent to
+    neighbours straight away without an edit id. Changes are coalesced per
+    (edge_name, index) and saved as one edit after the interval, once
+    VISUAL_EDIT_BUFFER_MAX_CHANGES are buffered or on disconnect, with a
+    second ack carrying the saved edit id. Changes failing to save are kept
+    and flushed again after the interval, and logged if still unsaved on
+    disconnect. At most that interval or number of changes can be lost if
+    the worker dies. As patches set absolute
+    values, base_edit and idempotency_key are not needed when buffering:
+    the lattice is reapplied over any edit committed elsewhere meanwhile.
+
+    Connections heartbeat their presence in the cell (see presence), and
+    edge changes are only sent to neighbours with someone connected.
+
+    Messages to the client are sent in order from an OutboundQueue of at
+    most VISUAL_OUTBOUND_QUEUE_SIZE (see flow), merging changes to the same
+    shared segment and resyncing with a snapshot if replies are dropped.
+    Patches beyond VISUAL_STROKE_RATE per second are refused with a retry
+    error.
+    """
+
+    async def connect(self):
+        """Join the cell's neighbour edge groups if the user may edit it."""
+        self.cell = await database_sync_to_async(self.get_cell)()
+        if not self.cell:
+            await self.close()
+            return
+        self.neighbours = await database_sync_to_async(
+            self.cell.get_neighbours)(
+                neighbour_coords=VisualCell.ADJACENT_COORDINATES)
+        self.groups = self.cell.get_neighbour_edge_groups(self.neighbours)
+        for group in self.groups:
+            await self.channel_layer.group_add(group, self.channel_name)
+        self.presence = get_presence()
+        await sync_to_async(self.join_presence)()
+        self.heartbeat_task = ensure_future(self.heartbeat())
+        self.is_binary = BINARY_SUBPROTOCOL in self.scope.get(
+            'subprotocols', [])
+        headers = dict(self.scope.get('headers', []))
+        self.profile_requested = is_profile_requested(
+            self.scope['user'], headers.get(b'x-visual-profile', b'').decode())
+        self.outbound = OutboundQueue(settings.VISUAL_OUTBOUND_QUEUE_SIZE)
+        self.send_task = ensure_future(self.send_outbound())
+        self.stroke_limit = TokenBucket(settings.VISUAL_STROKE_RATE,
+                                        settings.VISUAL_STROKE_BURST)
+        self.flush_interval = settings.VISUAL_EDIT_FLUSH_INTERVAL
+        if self.flush_interval:
+            self.buffer_max_changes = settings.VISUAL_EDIT_BUFFER_MAX_CHANGES
+            self.buffered_changes: Dict[Tuple[str, int], int] = {}
+            self.flush_lock = Lock()
+            self.flush_task: Optional[Future] = None
+            self.saved_edit = await database_sync_to_async(
+                self.cell.get_patch_base)()
+            self.edges = self.saved_edit.get_edges()
+        await self.accept(BINARY_SUBPROTOCOL if self.is_binary else None)
+        metrics.increment('visual_consumer_connections', consumer='edit')
+        capture_event('connect', conn=self.channel_name,
+                      **get_cell_fields(self.cell),
+                      **get_user_fields(self.scope['user']),
+                      binary=self.is_binary)
+
+    async def disconnect(self, code):
+        """Save any buffered changes and leave the cell's presence."""
+        if getattr(self, 'flush_interval', None):
+            await self.flush(reply=False)
+        if getattr(self, 'heartbeat_task', None):
+            self.heartbeat_task.cancel()
+            await sync_to_async(self.presence.leave)(
+                self.cell.canvas_id, self.cell.id, self.channel_name)
+        if getattr(self, 'send_task', None):
+            self.send_task.cancel()
+            metrics.increment('visual_consumer_connections', -1,
+                              consumer='edit')
+            capture_event('disconnect', conn=self.channel_name)
+
+    def join_presence(self):
+        self.presence.join(self.cell.canvas_id, self.cell.id,
+                           self.channel_name, self.scope['user'])
+
+    async def heartbeat(self):
+        """Renew presence well within VISUAL_PRESENCE_TIMEOUT."""
+        while True:
+            await sleep(self.presence.timeout / 3)
+            await sync_to_async(self.join_presence)()
+
+    def get_cell(self):
+        """
+        Get the cell from the url if it exists and the user may edit it.
+
+        Artists' own cells are usually cached by CachedAuthMiddleware, in
+        which case the cell version is only loaded before the first commit.
+        """
+        cell_id = self.scope['url_route']['kwargs']['cell_id']
+        cell = self.scope.get('visual_cells', {}).get(str(cell_id))
+        self.version_loaded = cell is None
+        if cell is None:
+            cell = VisualCell.objects.select_related(
+                'canvas__creator', 'artist').filter(id=cell_id).first()
+        if cell and cell.user_may_edit(self.scope['user']):
+            return cell
+        return None
+
+    def load_version(self):
+        """Load the version of a cached cell for optimistic concurrency."""
+        if not self.version_loaded:
+            self.cell.refresh_from_db(fields=['version'])
+            self.version_loaded = True
+
+    async def send_message(self, message: dict, key=None):
+        """Queue a message dict to send in the format this connection uses."""
+        self.outbound.put(encode_frame(message) if self.is_binary
+                          else encode_json(message), key)
+
+    async def send_outbound(self):
+        """Send queued messages, then a snapshot if any were dropped."""
+        while True:
+            data = await self.outbound.get()
+            if self.is_binary:
+                await self.send(bytes_data=data)
+            else:
+                await self.send(text_data=data)
+            if self.outbound.resync and not self.outbound:
+                self.outbound.resync = False
+                metrics.increment('visual_outbound_resync_total')
+                await self.send_message(
+                    await database_sync_to_async(self.get_snapshot)())
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """Decode a binary or JSON message and handle it by type."""
+        try:
+            message = (decode_frame(bytes_data) if bytes_data is not None
+                       else decode_json(text_data))
+        except ProtocolError as error:
+            await self.send_message({'type': 'error', 'errors': [str(error)]})
+            return
+        with capture('message', conn=self.channel_name, message=message):
+            await self.handle_message(message)
+
+    async def handle_message(self, message: dict):
+        """Handle a decoded message by its type."""
+        if message['type'] == 'patch':
+            if not self.stroke_limit.allow():
+                metrics.increment('visual_inbound_rate_limited_total')
+                await self.send_message({'type': 'error', 'retry': True,
+                                         'errors': ['Too many edits, please '
+                                                    'slow down']})
+                return
+            with trace('receive_patch', cell=self.cell.id):
+                await self.receive_patch(message)
+        elif message['type'] == 'get_snapshot':
+            await self.send_message(
+                await database_sync_to_async(self.get_snapshot)())
+        else:
+            await self.send_message({'type': 'error',
+                                     'errors': ['Unknown message type']})
+
+    async def receive_patch(self, message: dict):
+        """Apply a patch to the cell, replying with the edit or errors."""
+        try:
+            patch = clean_patch_changes(message.get('patch'))
+        except ValidationError as error:
+            await self.send_message({'type': 'error',
+                                     'errors': error.messages})
+            return
+        if message.get('base_edit') is not None and (
+                type(message['base_edit']) is not int):
+            await self.send_message({'type': 'error',
+                                     'errors': ['base_edit must be an edit '
+                                                'id']})
+            return
+        key = message.get('idempotency_key')
+        if key is not None and (not isinstance(key, str) or len(key) > 64):
+            await self.send_message({'type': 'error',
+                                     'errors': ['idempotency_key must be at '
+                                                'most 64 characters']})
+            return
+        if self.flush_interval:
+            await self.buffer_patch(patch)
+            return
+        await self.send_message(await database_sync_to_async(
+            self.apply_patch)(patch, message.get('base_edit'), key))
+
+    def apply_patch(self, patch, base_edit_id=None, idempotency_key=None):
+        """Commit a patch, returning the reply to send to the client."""
+        with profile('consumer.apply_patch', force=self.profile_requested):
+            self.load_version()
+            try:
+                edit = self.cell.apply_edit_patch(
+                    patch, artist=self.scope['user'],
+                    base_edit_id=base_edit_id,
+                    idempotency_key=idempotency_key)
+            except VisualCell.StaleEditException as error:
+                return {'type': 'error', 'errors': [str(error)],
+                        'stale': True}
+            except VisualCell.ConcurrentEditException:
+                self.cell.refresh_from_db(fields=['version'])
+                return {'type': 'error', 'retry': True,
+                        'errors': ["Cell was edited concurrently, please "
+                                   "retry"]}
+            except ValidationError as error:
+                return {'type': 'error', 'errors': error.messages}
+            return {'type': 'ack', 'edit': edit.id,
+                    'sequence': edit.sequence}
+
+    async def buffer_patch(self, patch):
+        """Apply a patch to the lattice, sending changed shared segments."""
+        try:
+            edges = self.cell.patch_edges(self.edges, patch)
+        except ValidationError as error:
+            await self.send_message({'type': 'error',
+                                     'errors': error.messages})
+            return
+        previous_edit = VisualCellEdit(cell=self.cell, **self.edges)
+        latest_edit = VisualCellEdit(cell=self.cell, **edges)
+        self.edges = edges
+        for edge_name, index, value in patch:
+            self.buffered_changes[edge_name, index] = value
+        await self.send_message({'type': 'ack', 'edit': None,
+                                 'sequence': None})
+        delta_portions = self.cell.extract_neighbour_edge_deltas(
+            previous_edit, latest_edit)
+        if delta_portions:
+            live_directions = await sync_to_async(
+                self.cell.get_live_directions)(
+                    {direction: self.neighbours[direction]
+                     for direction in delta_portions
+                     if direction in self.neighbours})
+            for group, event in self.cell.get_neighbour_edge_change_events(
+                    latest_edit, {direction: delta_portion for direction,
+                                  delta_portion in delta_portions.items()
+                                  if direction in live_directions}):
+                with metrics.observe_duration(
+                        'visual_channel_layer_send_seconds',
+                        type=event['type']):
+                    await self.channel_layer.group_send(group, event)
+        if len(self.buffered_changes) >= self.buffer_max_changes:
+            await self.flush()
+        elif not self.flush_task:
+            self.flush_task = ensure_future(self.flush_later())
+
+    async def flush_later(self):
+        await sleep(self.flush_interval)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self, reply: bool = True):
+        """
+        Save buffered changes as one edit.
+
+        Changes that fail to save are buffered again and flushed later, or
+        logged as lost without reply, i.e. on disconnect.
+        """
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+        async with self.flush_lock:
+            if not self.buffered_changes:
+                return
+            changes, self.buffered_changes = self.buffered_changes, {}
+            # A span of the patch that scheduled it if flushed later
+            with trace('flush', cell=self.cell.id, changes=len(changes)):
+                try:
+                    message, edit = await database_sync_to_async(
+                        self.commit_changes)(changes)
+                except Exception:
+                    logger.exception(f"Failed to save {len(changes)} "
+                                     f"buffered changes to {self.cell.id}")
+                    message, edit = {'type': 'error', 'retry': True,
+                                     'errors': ["Buffered changes could not "
+                                                "be saved, they will be "
+                                                "saved again"]}, None
+            if edit:
+                # Changes buffered while saving are kept over the saved edit
+                self.saved_edit = edit
+                self.edges = self.cell.patch_edges(
+                    edit.get_edges(),
+                    [(edge_name, index, value) for (edge_name, index), value
+                     in self.buffered_changes.items()])
+            else:
+                self.buffered_changes = {**changes, **self.buffered_changes}
+                if not reply:
+                    logger.error(f"Lost {len(self.buffered_changes)} "
+                                 f"buffered changes to {self.cell.id} on "
+                                 "disconnect")
+                elif not self.flush_task:
+                    self.flush_task = ensure_future(self.flush_later())
+            if reply:
+                await self.send_message(message)
+
+    def commit_changes(self, changes):
+        """Commit coalesced changes, retrying over concurrent edits."""
+        with profile('consumer.commit_changes', force=self.profile_requested):
+            self.load_version()
+            patch = [(edge_name, index, value)
+                     for (edge_name, index), value in changes.items()]
+            for attempt in range(VisualCell.NEIGHBOUR_EDIT_ATTEMPTS):
+                try:
+                    # Neighbours were sent each change as it was buffered
+                    edit = self.cell.apply_edit_patch(
+                        patch, artist=self.scope['user'],
+                        send_edge_changes=False)
+                    return {'type': 'ack', 'edit': edit.id,
+                            'sequence': edit.sequence}, edit
+                except VisualCell.ConcurrentEditException:
+                    self.cell.refresh_from_db(fields=['version'])
+            return {'type': 'error', 'retry': True,
+                    'errors': ["Cell was edited concurrently, buffered "
+                               "changes will be saved again"]}, None
+
+    def get_snapshot(self):
+        """The latest valid edges of the cell, to resync a client."""
+        if self.flush_interval:
+            return {'type': 'snapshot', 'cell': str(self.cell.id),
+                    'edit': self.saved_edit.id,
+                    'sequence': self.saved_edit.sequence, 'edges': self.edges}
+        try:
+            edit = self.cell.latest_valid_edit
+        except VisualCellEdit.DoesNotExist:
+            return {'type': 'error', 'errors': ['Cell has no edits yet']}
+        return {'type': 'snapshot', 'cell': str(self.cell.id),
+                'edit': edit.id, 'sequence': edit.sequence,
+                'edges': edit.get_edges()}
+
+    async def edge_change(self, event):
+        """Queue a neighbour's packed change to a shared edge segment."""
+        change = decode_frame(event['frame'])
+        key = (change['cell'], change['edge_name'], change['portion'])
+        self.outbound.put(event['frame'] if self.is_binary
+                          else encode_json(change), key)
+
+
+class CanvasChangeFanOut:
+
+    """
+    One channel layer subscription per canvas per process, shared by feeds.
+
+    The first VisualCanvasChangeFeedConsumer following a canvas joins its
+    change group with a single channel and copies each change to every
+    subscribed queue, the last to leave discards it. So thousands of
+    spectators in a worker cost one group membership rather than one each.
+    """
+
+    fan_outs: Dict[UUID, 'CanvasChangeFanOut'] = {}
+
+    # channels_redis expires group memberships, so rejoin well before then
+    GROUP_REFRESH_SECONDS = 3600
+
+    def __init__(self, canvas_id):
+        self.canvas_id = canvas_id
+        self.group = VisualCanvas.change_group_name(canvas_id)
+        self.queues: Set[Queue] = set()
+        self.channel_layer = get_channel_layer()
+        self.channel_name: Optional[str] = None
+        self.task: Optional[Future] = None
+
+    @classmethod
+    async def subscribe(cls, canvas_id, queue: Queue):
+        """Add a queue to receive changes to a canvas."""
+        fan_out = cls.fan_outs.get(canvas_id)
+        if not fan_out:
+            fan_out = cls.fan_outs[canvas_id] = cls(canvas_id)
+            fan_out.channel_name = await fan_out.channel_layer.new_channel()
+            await fan_out.channel_layer.group_add(fan_out.group,
+                                                  fan_out.channel_name)
+            fan_out.task = ensure_future(fan_out.run())
+        fan_out.queues.add(queue)
+
+    @classmethod
+    async def unsubscribe(cls, canvas_id, queue: Queue):
+        """Remove a queue, leaving the group if no others remain."""
+        fan_out = cls.fan_outs.get(canvas_id)
+        if not fan_out:
+            return
+        fan_out.queues.discard(queue)
+        if not fan_out.queues:
+            del cls.fan_outs[canvas_id]
+            if fan_out.task:
+                fan_out.task.cancel()
+            await fan_out.channel_layer.group_discard(fan_out.group,
+                                                      fan_out.channel_name)
+
+    async def run(self):
+        while True:
+            try:
+                event = await wait_for(
+                    self.channel_layer.receive(self.channel_name),
+                    self.GROUP_REFRESH_SECONDS)
+            except TimeoutError:
+                await self.channel_layer.group_add(self.group,
+                                                   self.channel_name)
+                continue
+            for queue in list(self.queues):
+                if queue.qsize() < queue.maxsize - 1:
+                    queue.put_nowait(event['change'])
+                else:
+                    # Dropping changes silently would leave a stale screen,
+                    # so the last slot ends the feed for it to catch up
+                    queue.put_nowait(None)
+                    self.queues.discard(queue)
+
+
+class VisualCanvasChangeFeedConsumer(AsyncHttpConsumer):
+
+    """
+    Stream changes to every cell of a canvas as Server-Sent Events.
+
+    For spectators such as projection screens, so needs no session but
+    the canvas' spectator token as a ``token`` query parameter (see
+    VisualCanvas.get_feed_url), otherwise it is forbidden. Each
+    event has the canvas sequence as its id, so a reconnecting
+    EventSource's Last-Event-ID (or an ``after`` query parameter) first
+    gets the changes since then as in VisualCanvas.get_changes_since. A
+    spectator that falls more than queue_size changes behind is
+    disconnected, to reconnect and catch up the same way.
+    """
+
+    queue_size = 100
+
+    async def handle(self, body):
+        self.canvas_id = self.scope['url_route']['kwargs']['canvas_id']
+        canvas = await database_sync_to_async(
+            VisualCanvas.objects.filter(id=self.canvas_id).first)()
+        if not canvas:
+            await self.send_response(404, b'Canvas not found', headers=[
+                (b'Content-Type', b'text/plain')])
+            return
+        if not canvas.is_spectator_token(self.get_query_parameter('token')):
+            await self.send_response(403, b'Invalid spectator token', headers=[
+                (b'Content-Type', b'text/plain')])
+            return
+        # One slot is kept to end the feed, see CanvasChangeFanOut.run
+        self.queue: Queue = Queue(maxsize=self.queue_size + 1)
+        await CanvasChangeFanOut.subscribe(self.canvas_id, self.queue)
+        metrics.increment('visual_consumer_connections', consumer='feed')
+        await self.send_headers(headers=[
+            (b'Content-Type', b'text/event-stream'),
+            (b'Cache-Control', b'no-cache'),
+            (b'X-Accel-Buffering', b'no')])
+        await self.send_body(b': connected\n\n', more_body=True)
+        # Also covers changes made between loading canvas and subscribing
+        sequence = self.get_last_sequence()
+        changes = await database_sync_to_async(canvas.get_changes_since)(
+            canvas.sequence if sequence is None else sequence)
+        for change in sorted(changes['cells'],
+                             key=lambda change: change['sequence']):
+            await self.send_event(
+                'snapshot' if changes['snapshot'] else 'change',
+                change, changes['sequence'])
+        self.sent_sequence = changes['sequence']
+        self.stream_task = ensure_future(self.stream())
 
+    def get_query_parameter(self, name: str) -> str:
+        values = parse_qs(self.scope.get('query_string', b'').decode()).get(
+            name)
+        return values[0] if values else ''
 
-class VisualCellEditConsumer(AsyncConsumer):
+    def get_last_sequence(self):
+        """The sequence to catch up from, if the client sent one."""
+        headers = dict(self.scope.get('headers', []))
+        last_event_id = (headers.get(b'last-event-id', b'').decode() or
+                         self.get_query_parameter('after'))
+        return int(last_event_id) if last_event_id.isdigit() else None
 
-    """A websocket means of updating neighbours on edits in real time."""
+    async def send_event(self, event: str, change: dict, sequence: int):
+        await self.send_body(
+            f'id: {sequence}\nevent: {event}\ndata: {dumps(change)}\n\n'
+            .encode(), more_body=True)
 
-    async def connect(self, event):
-        """Manage connecting cell neighbours."""
-        print('connected', event)
+    async def stream(self):
+        """Send changes from the canvas fan-out until disconnected."""
+        while True:
+            change = await self.queue.get()
+            if change is None:
+                await self.send_body(b'', more_body=False)
+                return
+            # Changes may also have been sent while catching up
+            if change['sequence'] > self.sent_sequence:
+                self.sent_sequence = change['sequence']
+                await self.send_event('change', change, change['sequence'])
 
-    async def recieve(self, event):
-        """Manage messages sent to cell neighbours."""
-        print('recieve', event)
+    async def http_request(self, message):
+        """Handle the request, then keep streaming until disconnected."""
+        if "body" in message:
+            self.body.append(message["body"])
+        if not message.get("more_body"):
+            await self.handle(b"".join(self.body))
+            if not hasattr(self, 'stream_task'):
+                await self.disconnect()
+                raise StopConsumer()
 
-    async def disconnect(self, event):
-        """Manage connecting cell neighbours."""
-        print('disconnected', event)
+    async def disconnect(self):
+        if hasattr(self, 'stream_task'):
+            self.stream_task.cancel()
+        if hasattr(self, 'queue'):
+            await CanvasChangeFanOut.unsubscribe(self.canvas_id, self.queue)
+            metrics.increment('visual_consumer_connections', -1,
+                              consumer='feed')
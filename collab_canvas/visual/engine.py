@@ -0,0 +1,553 @@
+"""
+Canvas rules without the database, and an in memory simulation of them.
+
+Layout holds the coordinate rules of grids, tori and organically growing
+canvases, including contiguous cell assignment. Geometry holds a cell
+lattice's dimensions and the edge segments shared with each neighbour, and
+extract_neighbour_edge_deltas, get_neighbour_writes and get_newer_writes
+propagate shared edge changes between neighbours as last writer wins
+registers (see VisualCell.merge_edge_writes). VisualCanvas and VisualCell
+delegate to these, so nothing here imports Django.
+
+SimulatedCanvas applies the same rules to cells held in memory, their
+edges as arrays, to size events of many thousands of artists and for
+property tests without Postgres. simulate runs one with random strokes:
+
+    simulate(artists=10000, edits=1000000)
+
+Geometry only depends on cell width and height, so is built once per size
+(get_geometry) and shared: treat its dicts as read only.
+"""
+from array import array
+from functools import lru_cache
+from math import ceil, sqrt
+from random import Random, choice, shuffle
+from time import perf_counter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+Coordinates = Tuple[int, int]
+Write = Tuple[str, int, int, int]
+
+NORTH = 0
+EAST = 1
+SOUTH = 2
+WEST = 3
+
+ADJACENT_COORDINATES = {
+    'north': (0, 1),
+    'east': (1, 0),
+    'south': (0, -1),
+    'west': (-1, 0),
+}
+
+CORNER_COORDINATES = {
+    'north_east': (1, 1),
+    'south_east': (1, -1),
+    'south_west': (-1, -1),
+    'north_west': (-1, 1),
+}
+
+NEIGHBOUR_COORDINATES = {
+    **ADJACENT_COORDINATES,
+    **CORNER_COORDINATES
+}
+
+OPPOSITE_DIRECTIONS = {
+    'north': 'south',
+    'east': 'west',
+    'south': 'north',
+    'west': 'east',
+}
+
+# Direction a neighbour's edit comes from, keyed by direction sent to
+NEIGHBOUR_EDIT_SOURCES = {
+    'north': SOUTH,
+    'east': WEST,
+    'south': NORTH,
+    'west': EAST,
+}
+
+EDGE_NAMES = ('edges_horizontal', 'edges_vertical', 'edges_south_east',
+              'edges_south_west')
+
+
+def get_portion_indices(length: int, portion: int) -> List[int]:
+    """Indices of an edge in a portion, from the start if positive."""
+    return list(range(length)[:portion] if portion > 0
+                else range(length)[portion:])
+
+
+class Geometry:
+
+    """The lattice of cells of one width and height, see get_geometry."""
+
+    __slots__ = ('width', 'height', 'dimensions', 'portions',
+                 'shared_positions', 'shared_index', 'boundary')
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.dimensions = {'edges_horizontal': width**2 + width,
+                           'edges_vertical': height**2 + height,
+                           'edges_south_east': width*height,
+                           'edges_south_west': width*height}
+        self.portions: Dict[str, Dict[str, Any]] = {
+            'north': {'edge_name': 'edges_horizontal',
+                      'self_portion': width,
+                      'neighbour_portion': -width},
+            'east': {'edge_name': 'edges_vertical',
+                     'self_portion': -height,
+                     'neighbour_portion': height},
+            'south': {'edge_name': 'edges_horizontal',
+                      'self_portion': -width,
+                      'neighbour_portion': width},
+            'west': {'edge_name': 'edges_vertical',
+                     'self_portion': height,
+                     'neighbour_portion': -height}}
+        self.shared_positions = tuple(sorted(
+            (portion['edge_name'], index)
+            for portion in self.portions.values()
+            for index in self.get_indices(portion['edge_name'],
+                                          portion['self_portion'])))
+        self.shared_index = {position: number for number, position
+                             in enumerate(self.shared_positions)}
+        # Shared (edge_name, index) to (direction, neighbour shared position
+        # number, neighbour index), for neighbours of the same size
+        self.boundary: Dict[Tuple[str, int], List[Tuple[str, int, int]]] = {
+            position: [] for position in self.shared_positions}
+        for direction, portion in self.portions.items():
+            edge_name = portion['edge_name']
+            for index, neighbour_index in zip(
+                    self.get_indices(edge_name, portion['self_portion']),
+                    self.get_indices(edge_name,
+                                     portion['neighbour_portion'])):
+                self.boundary[edge_name, index].append((
+                    direction, self.shared_index[edge_name, neighbour_index],
+                    neighbour_index))
+
+    def get_indices(self, edge_name: str, portion: int) -> List[int]:
+        return get_portion_indices(self.dimensions[edge_name], portion)
+
+
+@lru_cache(maxsize=None)
+def get_geometry(width: int, height: int) -> Geometry:
+    return Geometry(width, height)
+
+
+def extract_neighbour_edge_deltas(geometry: Geometry,
+                                  delta: Dict[str, list]) -> Dict[str, dict]:
+    """Changed shared edge segments of an edges delta, by direction."""
+    neighbours = {}
+    for direction, portion in geometry.portions.items():
+        edge = delta[portion['edge_name']]
+        segment = portion['self_portion']
+        delta_portion = edge[:segment] if segment > 0 else edge[segment:]
+        if any(delta_portion):
+            neighbours[direction] = {
+                'edge_name': portion['edge_name'],
+                'edge': edge,
+                'edge_delta': delta_portion,
+                'segment': portion['neighbour_portion']}
+    return neighbours
+
+
+def get_neighbour_writes(geometry: Geometry, direction: str,
+                         delta_portion: dict, edges: Dict[str, list],
+                         sequences: Dict[Tuple[str, int], int],
+                         neighbour_geometry: Geometry) -> List[Write]:
+    """
+    (edge_name, index, value, sequence) writes of changes to a neighbour.
+
+    Only changed positions are written, with the values and sequences they
+    have in edges rather than the delta.
+    """
+    edge_name = delta_portion['edge_name']
+    self_indices = get_portion_indices(
+        len(delta_portion['edge']),
+        geometry.portions[direction]['self_portion'])
+    neighbour_indices = neighbour_geometry.get_indices(
+        edge_name, delta_portion['segment'])
+    return [(edge_name, neighbour_index, edges[edge_name][index],
+             sequences[edge_name, index])
+            for index, neighbour_index, change in zip(
+                self_indices, neighbour_indices, delta_portion['edge_delta'])
+            if change]
+
+
+def get_newer_writes(sequences: Dict[Tuple[str, int], int],
+                     writes: Iterable[Write]) -> List[Write]:
+    """Writes newer than the sequence of the position they write."""
+    return [(edge_name, index, value, sequence)
+            for edge_name, index, value, sequence in writes
+            if sequence > sequences[edge_name, index]]
+
+
+class Layout:
+
+    """Where cells of a canvas may be, and which are neighbours."""
+
+    __slots__ = ('grid_width', 'grid_height', 'is_torus', 'new_cells_allowed')
+
+    def __init__(self, grid_width: int = 0, grid_height: int = 0,
+                 is_torus: bool = False, new_cells_allowed: bool = False):
+        self.grid_width = grid_width
+        self.grid_height = grid_height
+        self.is_torus = is_torus
+        self.new_cells_allowed = new_cells_allowed
+
+    @property
+    def is_grid(self) -> bool:
+        return 0 < self.grid_width and 0 < self.grid_height
+
+    @property
+    def max_coordinates(self) -> Coordinates:
+        return (self.grid_width - 1, self.grid_height - 1)
+
+    def is_full(self, allocated: int) -> bool:
+        return self.is_grid and allocated >= self.grid_width*self.grid_height
+
+    def contains(self, coordinates: Coordinates) -> bool:
+        """Whether coordinates are within the grid."""
+        return (0 <= coordinates[0] < self.grid_width and
+                0 <= coordinates[1] < self.grid_height)
+
+    def wrap(self, coordinates: Coordinates) -> Coordinates:
+        """Coordinates off a torus' edges projected back onto it."""
+        return (coordinates[0] % self.grid_width,
+                coordinates[1] % self.grid_height)
+
+    def get_centre_coordinates(self) -> Coordinates:
+        """The floor middle of a grid, otherwise (0, 0)."""
+        if self.is_grid:
+            return (self.max_coordinates[0]//2, self.max_coordinates[1]//2)
+        return (0, 0)
+
+    def get_random_coordinates(self, choice=choice) -> Coordinates:
+        # Note: must add 1 to include max coordinates
+        return (choice(list(range(self.max_coordinates[0] + 1))),
+                choice(list(range(self.max_coordinates[1] + 1))))
+
+    def get_neighbour_coordinates(
+            self, coordinates: Coordinates,
+            neighbour_coords: Dict[str, Coordinates] = NEIGHBOUR_COORDINATES
+    ) -> Dict[str, Coordinates]:
+        """Coordinates of neighbours by direction, across a torus' edges."""
+        neighbours = {}
+        for direction, coordinate_difference in neighbour_coords.items():
+            coords = (coordinates[0] + coordinate_difference[0],
+                      coordinates[1] + coordinate_difference[1])
+            neighbours[direction] = (self.wrap(coords) if self.is_torus
+                                     else coords)
+        return neighbours
+
+    def get_free_neighbour(self, coordinates: Coordinates, direction: str,
+                           allocated) -> Optional[Coordinates]:
+        """The unallocated cell a direction from coordinates may assign."""
+        x, y = ADJACENT_COORDINATES[direction]
+        potential_cell = (coordinates[0] + x, coordinates[1] + y)
+        if potential_cell in allocated:
+            return None
+        if self.new_cells_allowed:
+            return potential_cell
+        if self.is_torus:
+            potential_cell = self.wrap(potential_cell)
+            if potential_cell in allocated:
+                return None
+        elif not self.contains(potential_cell):
+            return None
+        return potential_cell
+
+    def choose_contiguous_coordinates(
+            self, allocated: Sequence[Coordinates],
+            shuffle=shuffle) -> Optional[Coordinates]:
+        """
+        A cell adjacent to a random allocated cell that's not allocated.
+
+        Allocated cells, then directions from each, are tried in a random
+        order. Returns None if every allocated cell is surrounded.
+        """
+        allocated_set = set(allocated)
+        allocated = list(allocated)
+        directions = list(ADJACENT_COORDINATES)
+        shuffle(allocated)
+        for cell in allocated:
+            shuffle(directions)
+            for direction in directions:
+                potential_cell = self.get_free_neighbour(cell, direction,
+                                                         allocated_set)
+                if potential_cell is not None:
+                    return potential_cell
+        return None
+
+
+class SimulatedCell:
+
+    """A cell's latest edges and shared position sequences in memory."""
+
+    __slots__ = ('coordinates', 'geometry', 'artist', 'edges', 'sequences',
+                 'neighbours', 'edits')
+
+    def __init__(self, coordinates: Coordinates, geometry: Geometry,
+                 sequence: int):
+        self.coordinates = coordinates
+        self.geometry = geometry
+        self.artist: Any = None
+        self.edges = {edge_name: array('H', bytes(2*length))
+                      for edge_name, length in geometry.dimensions.items()}
+        self.sequences = array(
+            'q', [sequence]*len(geometry.shared_positions))
+        self.neighbours: Dict[str, 'SimulatedCell'] = {}
+        self.edits = 1
+
+    def get_edges(self) -> Dict[str, list]:
+        return {edge_name: list(edge)
+                for edge_name, edge in self.edges.items()}
+
+
+class AllocatedCells:
+
+    """Coordinates of cells with an artist, without copying them."""
+
+    __slots__ = ('cells',)
+
+    def __init__(self, cells: Dict[Coordinates, SimulatedCell]):
+        self.cells = cells
+
+    def __contains__(self, coordinates: Coordinates) -> bool:
+        cell = self.cells.get(coordinates)
+        return cell is not None and cell.artist is not None
+
+
+class SimulatedCanvas:
+
+    """
+    A canvas of SimulatedCells, assigning and editing as VisualCanvas does.
+
+    Each edit reserves the next canvas sequence and writes its changed
+    shared positions into neighbours holding older writes, each neighbour
+    written to counting as a neighbour edit, as VisualCell.commit_edits
+    and merge_edge_writes do. Allocated cells with a free neighbour are
+    kept as a frontier, so assignment picks a random one and then a random
+    free direction from it in constant time, the same distribution as
+    Layout.choose_contiguous_coordinates.
+    """
+
+    __slots__ = ('layout', 'geometry', 'colour_range', 'random', 'cells',
+                 'allocated', 'artists', 'sequence', 'edits', 'frontier',
+                 'frontier_index')
+
+    def __init__(self, layout: Layout, cell_width: int = 8,
+                 cell_height: int = 8, colour_range: int = 1,
+                 random: Random = None):
+        self.layout = layout
+        self.geometry = get_geometry(cell_width, cell_height)
+        self.colour_range = colour_range
+        self.random = random or Random()
+        self.cells: Dict[Coordinates, SimulatedCell] = {}
+        self.allocated = AllocatedCells(self.cells)
+        self.artists: Dict[object, SimulatedCell] = {}
+        self.sequence = 0
+        self.edits = 0
+        self.frontier: List[Coordinates] = []
+        self.frontier_index: Dict[Coordinates, int] = {}
+        if layout.is_grid:
+            for x in range(layout.grid_width):
+                for y in range(layout.grid_height):
+                    self.add_cell((x, y))
+
+    class FullGridException(Exception):
+        pass
+
+    def add_cell(self, coordinates: Coordinates) -> SimulatedCell:
+        """Add a cell with a first edit, linked to its neighbours."""
+        self.sequence += 1
+        self.edits += 1
+        cell = self.cells[coordinates] = SimulatedCell(
+            coordinates, self.geometry, self.sequence)
+        for direction, neighbour_coordinates in (
+                self.layout.get_neighbour_coordinates(
+                    coordinates, ADJACENT_COORDINATES).items()):
+            neighbour = self.cells.get(neighbour_coordinates)
+            if neighbour is not None:
+                cell.neighbours[direction] = neighbour
+                neighbour.neighbours[OPPOSITE_DIRECTIONS[direction]] = cell
+        if self.layout.new_cells_allowed:
+            # Starting from its neighbours' shared edges
+            for (edge_name, index), boundary in self.geometry.boundary.items():
+                for direction, _, neighbour_index in boundary:
+                    neighbour = cell.neighbours.get(direction)
+                    if neighbour is not None:
+                        cell.edges[edge_name][index] = (
+                            neighbour.edges[edge_name][neighbour_index])
+        self.written(cell, self.sequence)
+        return cell
+
+    def written(self, cell: SimulatedCell, sequence: int,
+                neighbour_edit: int = None, artist=None):
+        """Called with each edit written, for subclasses to record."""
+
+    def has_free_neighbour(self, coordinates: Coordinates) -> bool:
+        return any(self.layout.get_free_neighbour(coordinates, direction,
+                                                  self.allocated)
+                   for direction in ADJACENT_COORDINATES)
+
+    def _update_frontier(self, coordinates: Coordinates):
+        if self.has_free_neighbour(coordinates):
+            if coordinates not in self.frontier_index:
+                self.frontier_index[coordinates] = len(self.frontier)
+                self.frontier.append(coordinates)
+        elif coordinates in self.frontier_index:
+            # Swap the last in to keep removal constant time
+            position = self.frontier_index.pop(coordinates)
+            last = self.frontier.pop()
+            if last != coordinates:
+                self.frontier[position] = last
+                self.frontier_index[last] = position
+
+    def assign(self, artist) -> SimulatedCell:
+        """The artist's cell, assigning a contiguous one if need be."""
+        cell = self.artists.get(artist)
+        if cell is not None:
+            return cell
+        if not self.artists:
+            coordinates = ((0, 0) if self.layout.new_cells_allowed
+                           else self.layout.get_centre_coordinates())
+        elif self.layout.is_full(len(self.artists)):
+            raise self.FullGridException
+        elif not self.frontier:
+            raise LookupError("No available cells found")
+        else:
+            start = self.random.choice(self.frontier)
+            free = [self.layout.get_free_neighbour(start, direction,
+                                                   self.allocated)
+                    for direction in ADJACENT_COORDINATES]
+            coordinates = self.random.choice(
+                [neighbour for neighbour in free if neighbour is not None])
+        cell = self.cells.get(coordinates) or self.add_cell(coordinates)
+        cell.artist = artist
+        self.artists[artist] = cell
+        self._update_frontier(coordinates)
+        for neighbour_coordinates in self.layout.get_neighbour_coordinates(
+                coordinates, ADJACENT_COORDINATES).values():
+            neighbour = self.cells.get(neighbour_coordinates)
+            if neighbour is not None and neighbour.artist is not None:
+                self._update_frontier(neighbour_coordinates)
+        return cell
+
+    def edit(self, cell: SimulatedCell,
+             patch: Iterable[Tuple[str, int, int]]) -> int:
+        """
+        Apply (edge_name, index, value) changes as one edit of cell.
+
+        Returns the number of edits written, the cell's own and one per
+        neighbour merging a change, or 0 if nothing changed. Patches are
+        assumed valid, see VisualCell.patch_edges.
+        """
+        edges = cell.edges
+        previous: Dict[Tuple[str, int], int] = {}
+        for edge_name, index, value in patch:
+            edge = edges[edge_name]
+            previous.setdefault((edge_name, index), edge[index])
+            edge[index] = value
+        changed = [position for position, value in previous.items()
+                   if edges[position[0]][position[1]] != value]
+        if not changed:
+            return 0
+        self.sequence += 1
+        sequence = self.sequence
+        cell.edits += 1
+        shared_index = cell.geometry.shared_index
+        boundary = cell.geometry.boundary
+        merged: List[str] = []
+        for position in changed:
+            number = shared_index.get(position)
+            if number is None:
+                continue
+            cell.sequences[number] = sequence
+            edge_name, index = position
+            value = edges[edge_name][index]
+            for direction, neighbour_number, neighbour_index in (
+                    boundary[position]):
+                neighbour = cell.neighbours.get(direction)
+                if (neighbour is not None and
+                        sequence > neighbour.sequences[neighbour_number]):
+                    neighbour.edges[edge_name][neighbour_index] = value
+                    neighbour.sequences[neighbour_number] = sequence
+                    if direction not in merged:
+                        merged.append(direction)
+        self.written(cell, sequence, artist=cell.artist)
+        # Dispatched in the same order as VisualCell.get_neighbours
+        for direction in ADJACENT_COORDINATES:
+            if direction in merged:
+                self.sequence += 1
+                neighbour = cell.neighbours[direction]
+                neighbour.edits += 1
+                self.written(neighbour, self.sequence,
+                             NEIGHBOUR_EDIT_SOURCES[direction], cell.artist)
+        written = 1 + len(merged)
+        self.edits += written
+        return written
+
+
+# Strokes drawn ahead by simulate and then repeated
+STROKES = 100000
+
+
+def get_stroke(geometry: Geometry, length: int, colour_range: int,
+               random: Random) -> List[Tuple[str, int, int]]:
+    """Changes along consecutive positions of one edge, as when drawing."""
+    edge_name = random.choice(EDGE_NAMES)
+    size = geometry.dimensions[edge_name]
+    start = random.randrange(size)
+    value = random.randint(0, colour_range)
+    return [(edge_name, (start + offset) % size, value)
+            for offset in range(min(length, size))]
+
+
+def simulate(artists: int = 10000, edits: int = 1000000,
+             grid_size: int = None, is_torus: bool = False,
+             new_cells_allowed: bool = False, cell_size: int = 8,
+             colour_range: int = 1, stroke_length: int = 4,
+             seed: int = None) -> dict:
+    """
+    Assign artists cells of a new canvas, then make edits of random strokes.
+
+    The grid is the smallest square fitting the artists unless grid_size
+    is given, or unbounded if new_cells_allowed.
+    """
+    random = Random(seed)
+    if new_cells_allowed:
+        grid_size = 0
+    elif grid_size is None:
+        grid_size = max(ceil(sqrt(artists)), 3 if is_torus else 1)
+    canvas = SimulatedCanvas(
+        Layout(grid_size, grid_size, is_torus, new_cells_allowed),
+        cell_size, cell_size, colour_range, random)
+    started = perf_counter()
+    cells = [canvas.assign(artist) for artist in range(artists)]
+    assign_seconds = perf_counter() - started
+    # Strokes and who draws them are picked ahead, so only editing is timed
+    strokes = [(random.choice(cells),
+                get_stroke(canvas.geometry, stroke_length, colour_range,
+                           random))
+               for _ in range(min(edits, STROKES))]
+    edits_before = canvas.edits
+    own_edits = 0
+    started = perf_counter()
+    for number in range(edits):
+        if canvas.edit(*strokes[number % STROKES]):
+            own_edits += 1
+    edit_seconds = perf_counter() - started
+    written = canvas.edits - edits_before
+    return {
+        'artists': artists,
+        'cells': len(canvas.cells),
+        'edits': edits,
+        'edits_written': written,
+        'own_edits': own_edits,
+        'neighbour_edits': written - own_edits,
+        'assign_seconds': assign_seconds,
+        'edit_seconds': edit_seconds,
+        'edits_per_minute': edits / edit_seconds * 60 if edit_seconds else 0,
+        'sequence': canvas.sequence,
+    }
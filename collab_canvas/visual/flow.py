@@ -0,0 +1,80 @@
+"""
+Flow control for live edit connections (see VisualCellEditConsumer).
+
+A client reading slower than its neighbours draw would otherwise let channel
+layer messages pile up until channels_redis drops them or the worker stalls,
+so each connection sends from a bounded OutboundQueue. Inbound patches are
+limited per connection by a TokenBucket.
+"""
+from asyncio import Event
+from collections import OrderedDict
+from itertools import count
+from time import monotonic
+from typing import Any, Hashable
+
+from . import metrics
+
+
+class OutboundQueue:
+
+    """
+    Messages waiting to be sent to one client, bounded by maxsize.
+
+    Messages put with a key replace any unsent message with that key in
+    place, so neighbour edge changes keyed by their shared segment are
+    merged into the latest state of that segment however far behind the
+    client is. Once maxsize messages are waiting the oldest is dropped and
+    resync set, for the sender to follow the backlog with a snapshot.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.messages: 'OrderedDict[Hashable, Any]' = OrderedDict()
+        self.keys = count()
+        self.ready = Event()
+        self.resync = False
+
+    def __len__(self):
+        return len(self.messages)
+
+    def put(self, message, key=None):
+        if key is not None and key in self.messages:
+            self.messages[key] = message
+            metrics.increment('visual_outbound_merged_total')
+            return
+        if len(self.messages) >= self.maxsize:
+            self.messages.popitem(last=False)
+            self.resync = True
+            metrics.increment('visual_outbound_dropped_total')
+        self.messages[next(self.keys) if key is None else key] = message
+        self.ready.set()
+
+    async def get(self):
+        """Wait for and remove the oldest message."""
+        while not self.messages:
+            self.ready.clear()
+            await self.ready.wait()
+        return self.messages.popitem(last=False)[1]
+
+
+class TokenBucket:
+
+    """Allow rate actions per second on average, in bursts up to burst."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens: float = burst
+        self.updated = monotonic()
+
+    def allow(self) -> bool:
+        if not self.rate:
+            return True
+        now = monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
@@ -1,4 +1,9 @@
-from django.forms import ModelForm
+from json import JSONDecodeError, loads
+from uuid import UUID
+
+from django.core.exceptions import ValidationError
+from django.forms import CharField, Form, IntegerField, ModelForm
+
 from .models import VisualCellEdit
 
 
@@ -9,7 +14,7 @@ class VisualCellEditForm(ModelForm):
     class Meta:
 
         model = VisualCellEdit
-        fields = VisualCellEdit.get_edge_names()
+        fields = VisualCellEdit.get_edge_names() + ['idempotency_key']
 
     # def __init__(self, *args, **kwargs):
     #     super().__init__(*args, **kwargs)
@@ -23,3 +28,100 @@ class VisualCellEditForm(ModelForm):
     #
     #     If canvas is dynamic ensure
     #     """
+
+
+def clean_patch_changes(patch) -> list:
+    """Check patch is a non-empty list of [edge_name, index, value]."""
+    if not isinstance(patch, list) or not patch:
+        raise ValidationError("Patch must be a non-empty list")
+    edge_names = VisualCellEdit.get_edge_names()
+    cleaned_patch = []
+    for change in patch:
+        if (not isinstance(change, list) or len(change) != 3 or
+                change[0] not in edge_names or
+                not all(type(i) is int for i in change[1:])):
+            raise ValidationError(f"{change} is not an [edge_name, index, "
+                                  "value] change")
+        cleaned_patch.append(tuple(change))
+    return cleaned_patch
+
+
+def load_json(value: str):
+    """Parse a JSON form value, raising a ValidationError if invalid."""
+    try:
+        return loads(value)
+    except JSONDecodeError:
+        raise ValidationError("Must be valid JSON")
+
+
+class VisualCellEditPatchForm(Form):
+
+    """
+    Sparse edit of a cell as a JSON list of [edge_name, index, value].
+
+    Validation here only checks the shape of the patch, the cell itself
+    checks indices and values via VisualCell.apply_edit_patch.
+    """
+
+    patch = CharField()
+    base_edit = IntegerField(required=False)
+    idempotency_key = CharField(max_length=64, required=False)
+
+    def clean_patch(self):
+        """Parse patch into a list of (edge_name, index, value) tuples."""
+        return clean_patch_changes(load_json(self.cleaned_data['patch']))
+
+
+class VisualCellEditBatchForm(Form):
+
+    """An ordered JSON list of patches, each saved as a separate edit."""
+
+    edits = CharField()
+    base_edit = IntegerField(required=False)
+    idempotency_keys = CharField(required=False)
+
+    def clean_edits(self):
+        """Parse edits into a list of patches."""
+        edits = load_json(self.cleaned_data['edits'])
+        if not isinstance(edits, list) or not edits:
+            raise ValidationError("Edits must be a non-empty list of patches")
+        return [clean_patch_changes(patch) for patch in edits]
+
+    def clean_idempotency_keys(self):
+        """Parse optional JSON list of one unique key per edit."""
+        if not self.cleaned_data['idempotency_keys']:
+            return None
+        keys = load_json(self.cleaned_data['idempotency_keys'])
+        if (not isinstance(keys, list) or len(set(keys)) != len(keys) or
+                not all(isinstance(key, str) and 0 < len(key) <= 64
+                        for key in keys)):
+            raise ValidationError("Idempotency keys must be a list of unique "
+                                  "strings of up to 64 characters")
+        return keys
+
+    def clean(self):
+        cleaned_data = super().clean()
+        edits = cleaned_data.get('edits')
+        keys = cleaned_data.get('idempotency_keys')
+        if edits and keys and len(edits) != len(keys):
+            self.add_error('idempotency_keys',
+                           "One idempotency key is needed per edit")
+        return cleaned_data
+
+
+class VisualCanvasChangesForm(Form):
+
+    """A canvas sequence number and optional comma separated cell ids."""
+
+    after = IntegerField(min_value=0)
+    cells = CharField(required=False)
+
+    def clean_cells(self):
+        """Parse cells into a list of UUIDs, or None for all cells."""
+        if not self.cleaned_data['cells']:
+            return None
+        try:
+            return [UUID(cell_id)
+                    for cell_id in self.cleaned_data['cells'].split(',')]
+        except ValueError:
+            raise ValidationError("Cells must be comma separated cell ids")
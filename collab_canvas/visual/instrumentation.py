@@ -0,0 +1,155 @@
+"""
+Per view query counts and time spent in the database, signals and templates.
+
+VisualInstrumentationMiddleware measures each request to a visual view:
+queries and their time through a connection execute wrapper, time in
+signal receivers and neighbour propagation (functions decorated with
+timed), template rendering and the whole request. The last
+VISUAL_INSTRUMENTATION_WINDOW samples of each view are kept in process for
+rolling percentiles, listed on VisualInstrumentationView for staff, and in
+DEBUG each response carries its own in Server-Timing and X-Visual-Queries
+headers.
+
+Stages overlap: queries run by signal receivers count towards both db and
+signals.
+"""
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from threading import Lock, local
+from time import perf_counter
+from typing import Any, DefaultDict, Deque, Dict, Set
+
+from django.conf import settings
+from django.db import connection
+
+from .metrics import percentile
+
+STAGES = ('db', 'signals', 'propagation', 'render', 'total')
+
+_local = local()
+
+
+class RequestStats:
+
+    """Queries and seconds per stage of the current request."""
+
+    def __init__(self):
+        self.queries = 0
+        self.timings: DefaultDict[str, float] = defaultdict(float)
+        self.active_stages: Set[str] = set()
+
+    def record_query(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.timings['db'] += perf_counter() - start
+
+    def get_sample(self) -> Dict[str, float]:
+        return {'queries': self.queries,
+                **{stage: self.timings[stage] for stage in STAGES}}
+
+
+def get_request_stats() -> RequestStats:
+    return getattr(_local, 'stats', None)
+
+
+@contextmanager
+def timed(stage: str):
+    """Add time spent to stage of the current request, also a decorator."""
+    stats = get_request_stats()
+    if stats is None or stage in stats.active_stages:
+        # Outside a request, or already counted by an outer call
+        yield
+        return
+    stats.active_stages.add(stage)
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        stats.timings[stage] += perf_counter() - start
+        stats.active_stages.discard(stage)
+
+
+class RollingStats:
+
+    """The last window samples of each view, for percentiles."""
+
+    def __init__(self, window: int):
+        self.window = window
+        self.samples: DefaultDict[str, Deque[Dict[str, float]]] = defaultdict(
+            lambda: deque(maxlen=self.window))
+        self.counts: DefaultDict[str, int] = defaultdict(int)
+        self.lock = Lock()
+
+    def add(self, view_name: str, sample: Dict[str, float]):
+        with self.lock:
+            self.samples[view_name].append(sample)
+            self.counts[view_name] += 1
+
+    def get_summary(self) -> Dict[str, dict]:
+        """Count and p50, p90 and p99 of each measure per view."""
+        with self.lock:
+            samples = {view_name: list(view_samples)
+                       for view_name, view_samples in self.samples.items()}
+            counts = dict(self.counts)
+        summary: Dict[str, Dict[str, Any]] = {}
+        for view_name, view_samples in sorted(samples.items()):
+            summary[view_name] = {'count': counts[view_name]}
+            for measure in ('queries',) + STAGES:
+                values = [sample[measure] for sample in view_samples]
+                summary[view_name][measure] = {
+                    'p50': percentile(values, 0.5),
+                    'p90': percentile(values, 0.9),
+                    'p99': percentile(values, 0.99)}
+        return summary
+
+
+_rolling_stats = None
+
+
+def get_rolling_stats() -> RollingStats:
+    global _rolling_stats
+    if _rolling_stats is None:
+        _rolling_stats = RollingStats(settings.VISUAL_INSTRUMENTATION_WINDOW)
+    return _rolling_stats
+
+
+class VisualInstrumentationMiddleware:
+
+    """Measure requests to visual views, see the module docstring."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = _local.stats = RequestStats()
+        start = perf_counter()
+        try:
+            with connection.execute_wrapper(stats.record_query):
+                response = self.get_response(request)
+        finally:
+            _local.stats = None
+        stats.timings['total'] = perf_counter() - start
+        match = getattr(request, 'resolver_match', None)
+        if match and match.app_name == 'visual':
+            sample = stats.get_sample()
+            get_rolling_stats().add(match.view_name, sample)
+            if settings.DEBUG:
+                response['Server-Timing'] = ', '.join(
+                    f'{stage};dur={sample[stage] * 1000:.1f}'
+                    for stage in STAGES)
+                response['X-Visual-Queries'] = sample['queries']
+        return response
+
+    def process_template_response(self, request, response):
+        stats = get_request_stats()
+        if stats is not None:
+            start = perf_counter()
+
+            def record_render(response):
+                stats.timings['render'] += perf_counter() - start
+
+            response.add_post_render_callback(record_render)
+        return response
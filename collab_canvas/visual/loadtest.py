@@ -0,0 +1,283 @@
+"""
+Simulated artists drawing over websockets, to size ASGI workers.
+
+run_load_test connects a WebsocketCommunicator per artist to an ASGI
+application (collab_canvas.visual.routing.application by default), signed
+in by session cookie as a browser would be. Each artist draws strokes of
+consecutive changes along one edge of its own cell of a new canvas, sending
+a patch per stroke every interval without waiting for replies. Reported:
+
+    fan_out:    seconds from a patch being sent to each neighbour receiving
+                its shared edge change, live if buffered (no edit id yet)
+    saved_edge_frames:  edge changes for edits not saved in reply to a
+                patch, such as by a buffer flush, left out of fan_out
+    ack:        seconds from a patch being sent to its reply
+    messages_per_second:    patches sent plus messages received
+    edits_per_second:       VisualCellEdit rows written, own and neighbour
+
+Everything runs in this process, so results are for one worker with the
+database and channel layer it is configured with (see the loadtest
+management command).
+"""
+from asyncio import TimeoutError, ensure_future, gather, sleep
+from bisect import bisect_right
+from collections import deque
+from datetime import timedelta
+from math import ceil, sqrt
+from random import Random
+from time import perf_counter
+from typing import Deque, Dict, List, Tuple
+from uuid import uuid4
+
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import Q
+from django.test import Client
+from django.utils import timezone
+
+from .metrics import percentile
+from .models import VisualCanvas, VisualCellEdit
+from .protocol import (BINARY_SUBPROTOCOL, decode_frame, decode_json,
+                       encode_frame, encode_json)
+
+LOAD_TEST_USERNAME_PREFIX = 'loadtest-'
+
+EDIT_PATH = 'canvas/cell/{cell_id}/edit/changes'
+
+
+def create_load_test_canvas(artists: int, grid_size: int = None):
+    """
+    A new square canvas with artists each assigned a cell, and cookies.
+
+    The grid is the smallest square fitting the artists unless grid_size is
+    given, so every artist has neighbours. Returns the canvas and a list of
+    (cell, session cookie) pairs.
+    """
+    User = get_user_model()
+    grid_size = grid_size or max(ceil(sqrt(artists)), 2)
+    run = uuid4().hex[:8]
+    creator = User.objects.create(
+        username=f'{LOAD_TEST_USERNAME_PREFIX}{run}-creator',
+        is_superuser=True)
+    now = timezone.now()
+    canvas = VisualCanvas.objects.create(
+        title=f'Load test {run}', creator=creator, start_time=now,
+        end_time=now + timedelta(days=1), grid_width=grid_size,
+        grid_height=grid_size)
+    cells = canvas.visual_cells.order_by('x_position', 'y_position')
+    sessions = []
+    for index, cell in enumerate(cells[:artists]):
+        cell.artist = User.objects.create(
+            username=f'{LOAD_TEST_USERNAME_PREFIX}{run}-{index}')
+        cell.save()
+        client = Client()
+        client.force_login(cell.artist)
+        sessions.append((cell, get_session_cookie(client)))
+    return canvas, sessions
+
+
+def get_session_cookie(client: Client) -> str:
+    """A Cookie header signing a websocket in as a logged in client."""
+    return '; '.join(f'{name}={cookie.value}'
+                     for name, cookie in client.cookies.items())
+
+
+def delete_load_test_canvas(canvas):
+    """Delete a load test canvas, its cells, edits and artists."""
+    get_user_model().objects.filter(
+        Q(pk=canvas.creator_id) | Q(visual_cells__canvas=canvas)).delete()
+
+
+def get_stroke(cell, length: int, random: Random):
+    """Changes along consecutive positions of one edge, as when drawing."""
+    dimensions = cell.lattice_dimensions
+    edge_name = random.choice(sorted(dimensions))
+    start = random.randrange(dimensions[edge_name])
+    value = random.randint(0, cell.colour_range)
+    return [[edge_name, (start + offset) % dimensions[edge_name], value]
+            for offset in range(min(length, dimensions[edge_name]))]
+
+
+class SimulatedArtist:
+
+    """One websocket client drawing on a cell and reading what it's sent."""
+
+    def __init__(self, application, cell, cookie: str, origin: str,
+                 binary: bool, buffered: bool):
+        self.cell = cell
+        self.binary = binary
+        self.buffered = buffered
+        self.communicator = WebsocketCommunicator(
+            application, EDIT_PATH.format(cell_id=cell.id),
+            headers=[(b'cookie', cookie.encode()),
+                     (b'origin', origin.encode())],
+            subprotocols=[BINARY_SUBPROTOCOL] if binary else None)
+        self.unanswered: Deque[float] = deque()
+        self.sent: List[float] = []
+        self.edit_sent: Dict[int, float] = {}
+        self.ack_latencies: List[float] = []
+        self.received: List[Tuple[str, int, float]] = []
+        self.messages_received = 0
+        self.errors = 0
+        self.reader = None
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise ConnectionError(f"Artist of {self.cell} was refused")
+        self.reader = ensure_future(self.read())
+
+    async def draw(self, strokes: int, stroke_length: int, interval: float,
+                   random: Random):
+        for _ in range(strokes):
+            await self.send({'type': 'patch',
+                             'patch': get_stroke(self.cell, stroke_length,
+                                                 random)})
+            await sleep(interval)
+
+    async def send(self, message: dict):
+        """Send a message, expecting a reply."""
+        sent = perf_counter()
+        self.unanswered.append(sent)
+        self.sent.append(sent)
+        if self.binary:
+            await self.communicator.send_to(bytes_data=encode_frame(message))
+        else:
+            await self.communicator.send_to(text_data=encode_json(message))
+
+    async def read(self):
+        while True:
+            try:
+                data = await self.communicator.receive_from(timeout=60)
+            except TimeoutError:
+                continue
+            received = perf_counter()
+            self.messages_received += 1
+            message = (decode_frame(data) if isinstance(data, bytes)
+                       else decode_json(data))
+            if message['type'] == 'edge':
+                self.received.append((message['cell'], message['edit'],
+                                      received))
+                continue
+            if message['type'] == 'error':
+                self.errors += 1
+            elif self.buffered and message['edit'] is not None:
+                continue  # Buffered changes saved, not a reply to a patch
+            if self.unanswered:
+                sent = self.unanswered.popleft()
+                self.ack_latencies.append(received - sent)
+                if message['type'] == 'ack' and message['edit']:
+                    self.edit_sent[message['edit']] = sent
+
+    async def wait_for_replies(self, timeout: float):
+        waited = 0.0
+        while self.unanswered and waited < timeout:
+            await sleep(0.01)
+            waited += 0.01
+
+    async def disconnect(self):
+        if self.reader:
+            self.reader.cancel()
+        await self.communicator.disconnect()
+
+
+def count_edits(canvas) -> int:
+    return VisualCellEdit.objects.filter(cell__canvas=canvas).count()
+
+
+def summarise(latencies):
+    return {'count': len(latencies),
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'max': max(latencies, default=0)}
+
+
+def measure_fan_out(artists) -> Tuple[List[float], int]:
+    """
+    Latencies from patches to neighbours' edge changes, and those left out.
+
+    An edge change with an edit id is matched to the patch acked with it. One
+    without was sent live while buffered, so follows its cell's latest
+    stroke. Changes for edits saved otherwise, such as by a buffer flush,
+    aren't a reply to any one stroke so are only counted.
+    """
+    edit_sent = {edit: sent for artist in artists
+                 for edit, sent in artist.edit_sent.items()}
+    cell_sent = {str(artist.cell.id): artist.sent for artist in artists}
+    fan_out: List[float] = []
+    saved_edge_frames = 0
+    for artist in artists:
+        for cell_id, edit, received in artist.received:
+            if edit is None:
+                times = cell_sent.get(cell_id, [])
+                position = bisect_right(times, received)
+                sent = times[position - 1] if position else received
+            elif edit in edit_sent:
+                sent = edit_sent[edit]
+            else:
+                saved_edge_frames += 1
+                continue
+            fan_out.append(received - sent)
+    return fan_out, saved_edge_frames
+
+
+async def run_load_test(application=None, clients: int = 16,
+                        strokes: int = 50, stroke_length: int = 4,
+                        interval: float = 0.05, binary: bool = True,
+                        grid_size: int = None, origin: str = 'http://localhost',
+                        seed: int = None, keep: bool = False,
+                        reply_timeout: float = 30) -> dict:
+    """Draw with clients simulated artists at once and return statistics."""
+    if application is None:
+        from . import routing
+        application = routing.application
+    random = Random(seed)
+    canvas, sessions = await database_sync_to_async(
+        create_load_test_canvas)(clients, grid_size)
+    buffered = bool(settings.VISUAL_EDIT_FLUSH_INTERVAL)
+    artists = [SimulatedArtist(application, cell, cookie, origin, binary,
+                               buffered)
+               for cell, cookie in sessions]
+    try:
+        await gather(*(artist.connect() for artist in artists))
+        edits_before = await database_sync_to_async(count_edits)(canvas)
+        started = perf_counter()
+        await gather(*(artist.draw(strokes, stroke_length, interval,
+                                   Random(random.random()))
+                       for artist in artists))
+        # Then neighbour changes and buffered saves still to come
+        await gather(*(artist.wait_for_replies(reply_timeout)
+                       for artist in artists))
+        await sleep(0.1)
+        await gather(*(artist.disconnect() for artist in artists))
+        duration = perf_counter() - started
+        edits = await database_sync_to_async(count_edits)(canvas) - (
+            edits_before)
+    finally:
+        if not keep:
+            await database_sync_to_async(delete_load_test_canvas)(canvas)
+    fan_out, saved_edge_frames = measure_fan_out(artists)
+    messages_sent = sum(len(artist.sent) for artist in artists)
+    messages_received = sum(artist.messages_received for artist in artists)
+    return {
+        'canvas': str(canvas.id),
+        'clients': clients,
+        'strokes': strokes,
+        'stroke_length': stroke_length,
+        'interval': interval,
+        'binary': binary,
+        'buffered': buffered,
+        'duration': duration,
+        'messages_sent': messages_sent,
+        'messages_received': messages_received,
+        'messages_per_second': (messages_sent + messages_received) / duration,
+        'edits': edits,
+        'edits_per_second': edits / duration,
+        'errors': sum(artist.errors for artist in artists),
+        'ack': summarise([latency for artist in artists
+                          for latency in artist.ack_latencies]),
+        'fan_out': summarise(fan_out),
+        'saved_edge_frames': saved_edge_frames,
+    }
@@ -0,0 +1,49 @@
+from json import dump, dumps, load
+
+from django.core.management.base import BaseCommand
+
+from ...benchmarks import (GRID_SIZES, HISTORY_DEPTHS, compare_results,
+                           run_benchmarks)
+
+
+class Command(BaseCommand):
+
+    help = ("Time and count queries of canvas hot paths at growing grid sizes "
+            "and history depths, in transactions rolled back afterwards. "
+            "Large sizes take a long time, pass --sizes to limit them.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='*',
+                            default=list(GRID_SIZES),
+                            help="Grid sizes (cells per side) to run")
+        parser.add_argument('--depths', type=int, nargs='*',
+                            default=list(HISTORY_DEPTHS),
+                            help="Number of edits in a cell's history")
+        parser.add_argument('--repeat', type=int, default=3,
+                            help="Runs of each benchmark, the median is kept")
+        parser.add_argument('--output',
+                            help="Write JSON results to this file rather "
+                                 "than stdout")
+        parser.add_argument('--compare',
+                            help="JSON results of a previous run to compare "
+                                 "with")
+
+    def handle(self, *args, **options):
+        results = run_benchmarks(options['sizes'], options['depths'],
+                                 options['repeat'])
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                dump(results, output, indent=2)
+        else:
+            self.stdout.write(dumps(results, indent=2))
+        if options['compare']:
+            with open(options['compare']) as previous:
+                comparison = compare_results(load(previous), results)
+            for row in comparison:
+                ratio = (f"{row['ratio']:.2f}x" if row['ratio'] is not None
+                         else 'n/a')
+                self.stderr.write(
+                    f"{row['benchmark']:<28} {row['grid_size']:>4} "
+                    f"{row['depth'] or '':>6} {ratio:>8} "
+                    f"{row['previous_queries']:>6} -> {row['queries']} "
+                    "queries")
@@ -0,0 +1,75 @@
+from json import dumps
+
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from ...loadtest import run_load_test
+
+
+class Command(BaseCommand):
+
+    help = ("Drive simulated artists drawing over websockets against the "
+            "ASGI application, reporting fan-out latency and throughput. "
+            "A canvas and artists are created, and deleted afterwards "
+            "unless --keep is passed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=16,
+                            help="Artists drawing at once")
+        parser.add_argument('--strokes', type=int, default=50,
+                            help="Strokes drawn by each artist")
+        parser.add_argument('--stroke-length', type=int, default=4,
+                            help="Changes per stroke")
+        parser.add_argument('--interval', type=float, default=0.05,
+                            help="Seconds between each artist's strokes")
+        parser.add_argument('--grid-size', type=int,
+                            help="Cells per side, by default the smallest "
+                                 "square fitting the clients")
+        parser.add_argument('--json', action='store_true',
+                            help="Print results as JSON")
+        parser.add_argument('--in-memory-layer', action='store_true',
+                            help="Use an in memory channel layer rather "
+                                 "than CHANNEL_LAYERS")
+        parser.add_argument('--flush-interval', type=float,
+                            help="Override VISUAL_EDIT_FLUSH_INTERVAL")
+        parser.add_argument('--text', action='store_true',
+                            help="Send JSON text rather than binary frames")
+        parser.add_argument('--origin', default='http://localhost',
+                            help="Origin header, which must be an allowed "
+                                 "host")
+        parser.add_argument('--seed', type=int,
+                            help="Seed for reproducible strokes")
+        parser.add_argument('--keep', action='store_true',
+                            help="Keep the canvas and artists")
+
+    def handle(self, *args, **options):
+        overrides = {}
+        if options['in_memory_layer']:
+            overrides['CHANNEL_LAYERS'] = {
+                'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+        if options['flush_interval'] is not None:
+            overrides['VISUAL_EDIT_FLUSH_INTERVAL'] = options['flush_interval']
+        with override_settings(**overrides):
+            results = async_to_sync(run_load_test)(
+                clients=options['clients'], strokes=options['strokes'],
+                stroke_length=options['stroke_length'],
+                interval=options['interval'],
+                binary=not options['text'], grid_size=options['grid_size'],
+                origin=options['origin'], seed=options['seed'],
+                keep=options['keep'])
+        if options['json']:
+            self.stdout.write(dumps(results, indent=2))
+            return
+        self.stdout.write(
+            f"{results['clients']} clients drew {results['messages_sent']} "
+            f"strokes in {results['duration']:.2f}s\n"
+            f"fan-out p50 {results['fan_out']['p50'] * 1000:.1f}ms "
+            f"p99 {results['fan_out']['p99'] * 1000:.1f}ms "
+            f"({results['fan_out']['count']} changes, "
+            f"{results['saved_edge_frames']} saved later left out)\n"
+            f"ack p50 {results['ack']['p50'] * 1000:.1f}ms "
+            f"p99 {results['ack']['p99'] * 1000:.1f}ms\n"
+            f"{results['messages_per_second']:.0f} messages/s, "
+            f"{results['edits_per_second']:.0f} edits written/s, "
+            f"{results['errors']} errors")
@@ -0,0 +1,81 @@
+from json import dumps
+from typing import Any, Dict
+
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from ...replay import ReplayError, read_capture, run_replay
+
+
+class Command(BaseCommand):
+
+    help = ("Replay a workload captured to VISUAL_CAPTURE_LOG against this "
+            "database, reporting throughput and latency. Canvases and users "
+            "standing in for captured ones are created, and deleted "
+            "afterwards unless --keep is passed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('capture', help="Captured workload file")
+        parser.add_argument('--speed', type=float, default=1,
+                            help="Times faster than captured, 0 for as fast "
+                                 "as possible")
+        parser.add_argument('--json', action='store_true',
+                            help="Print results as JSON")
+        parser.add_argument('--in-memory-layer', action='store_true',
+                            help="Use an in memory channel layer rather "
+                                 "than CHANNEL_LAYERS")
+        parser.add_argument('--flush-interval', type=float,
+                            help="Override VISUAL_EDIT_FLUSH_INTERVAL")
+        parser.add_argument('--origin', default='http://localhost',
+                            help="Origin header, which must be an allowed "
+                                 "host")
+        parser.add_argument('--host',
+                            help="Host header of requests, by default the "
+                                 "origin's, which must be an allowed host")
+        parser.add_argument('--keep', action='store_true',
+                            help="Keep the canvases and users")
+
+    def handle(self, *args, **options):
+        if options['speed'] < 0:
+            raise CommandError("--speed can't be negative")
+        try:
+            canvases, events = read_capture(options['capture'])
+        except OSError as error:
+            raise CommandError(error)
+        # Not capturing the replay into the capture it's replaying
+        overrides: Dict[str, Any] = {'VISUAL_CAPTURE_LOG': ''}
+        if options['in_memory_layer']:
+            overrides['CHANNEL_LAYERS'] = {
+                'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+        if options['flush_interval'] is not None:
+            overrides['VISUAL_EDIT_FLUSH_INTERVAL'] = options['flush_interval']
+        with override_settings(**overrides):
+            try:
+                results = async_to_sync(run_replay)(
+                    canvases, events, speed=options['speed'],
+                    origin=options['origin'], host=options['host'],
+                    keep=options['keep'])
+            except ReplayError as error:
+                raise CommandError(error)
+        if options['json']:
+            self.stdout.write(dumps(results, indent=2))
+            return
+        self.stdout.write(
+            f"Replayed {results['events']} events at {results['speed']}x in "
+            f"{results['duration']:.2f}s, captured in "
+            f"{results['captured_duration']:.2f}s\n"
+            f"{results['events_per_second']:.0f} events/s "
+            f"(captured {results['captured_events_per_second']:.0f}), "
+            f"{results['edits_per_second']:.0f} edits written/s, "
+            f"{results['errors']} errors, {results['skipped']} skipped\n"
+            f"lag p99 {results['lag']['p99'] * 1000:.1f}ms")
+        for kind, latency in results['latency'].items():
+            line = (f"{kind}: p50 {latency['p50'] * 1000:.1f}ms "
+                    f"p99 {latency['p99'] * 1000:.1f}ms "
+                    f"({latency['count']})")
+            captured = results['captured'].get(kind)
+            if captured:
+                line += (f", captured p50 {captured['p50'] * 1000:.1f}ms "
+                         f"p99 {captured['p99'] * 1000:.1f}ms")
+            self.stdout.write(line)
@@ -0,0 +1,61 @@
+from json import dumps
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...engine import simulate
+
+
+class Command(BaseCommand):
+
+    help = ("Simulate artists assigned cells of a canvas and drawing random "
+            "strokes in memory, with the canvas rules but no database, "
+            "reporting edits per minute.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--artists', type=int, default=10000,
+                            help="Artists assigned a cell")
+        parser.add_argument('--edits', type=int, default=1000000,
+                            help="Strokes drawn, one edit each")
+        parser.add_argument('--stroke-length', type=int, default=4,
+                            help="Changes per stroke")
+        parser.add_argument('--grid-size', type=int,
+                            help="Cells per side, by default the smallest "
+                                 "square fitting the artists")
+        parser.add_argument('--torus', action='store_true',
+                            help="Wrap the grid's edges")
+        parser.add_argument('--new-cells-allowed', action='store_true',
+                            help="Grow the canvas rather than use a grid")
+        parser.add_argument('--cell-size', type=int, default=8,
+                            help="Cell width and height")
+        parser.add_argument('--colour-range', type=int, default=1,
+                            help="Highest edge value")
+        parser.add_argument('--seed', type=int,
+                            help="Seed for reproducible assignment and "
+                                 "strokes")
+        parser.add_argument('--json', action='store_true',
+                            help="Print results as JSON")
+
+    def handle(self, *args, **options):
+        if options['artists'] < 1 or options['edits'] < 1:
+            raise CommandError("--artists and --edits must be positive")
+        grid_size = options['grid_size']
+        if grid_size is not None and grid_size**2 < options['artists']:
+            raise CommandError(f"A grid of {grid_size}x{grid_size} can't fit "
+                               f"{options['artists']} artists")
+        results = simulate(
+            artists=options['artists'], edits=options['edits'],
+            grid_size=grid_size, is_torus=options['torus'],
+            new_cells_allowed=options['new_cells_allowed'],
+            cell_size=options['cell_size'],
+            colour_range=options['colour_range'],
+            stroke_length=options['stroke_length'], seed=options['seed'])
+        if options['json']:
+            self.stdout.write(dumps(results, indent=2))
+            return
+        self.stdout.write(
+            f"Assigned {results['artists']} artists {results['cells']} cells "
+            f"in {results['assign_seconds']:.2f}s\n"
+            f"{results['edits']} edits in {results['edit_seconds']:.2f}s, "
+            f"{results['edits_per_minute']:,.0f} edits/minute\n"
+            f"{results['edits_written']} written: {results['own_edits']} "
+            f"own, {results['neighbour_edits']} to neighbours")
@@ -0,0 +1,75 @@
+from json import dumps
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...workload import (SHAPES, STROKE_LENGTHS, WorkloadError,
+                         delete_workload, generate_workload)
+
+
+class Command(BaseCommand):
+
+    help = ("Generate a canvas with synthetic artists and edits, simulated "
+            "in memory and loaded in bulk, to test against realistic data "
+            "volumes. Pass --delete with a run to delete one.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shape', choices=SHAPES, default='grid',
+                            help="Bounded grid, torus or organically "
+                                 "growing canvas")
+        parser.add_argument('--artists', type=int, default=100,
+                            help="Artists assigned a cell")
+        parser.add_argument('--edits', type=int, default=100,
+                            help="Strokes drawn by each artist on average, "
+                                 "an edit each unless nothing changes")
+        parser.add_argument('--grid-size', type=int,
+                            help="Cells per side, by default the smallest "
+                                 "square fitting the artists")
+        parser.add_argument('--cell-size', type=int, default=8,
+                            help="Cell width and height")
+        parser.add_argument('--colour-range', type=int, default=1,
+                            help="Highest edge value")
+        parser.add_argument('--stroke-length', type=int, default=4,
+                            help="Changes per stroke")
+        parser.add_argument('--lengths', choices=list(STROKE_LENGTHS),
+                            default='fixed',
+                            help="Distribution of stroke lengths")
+        parser.add_argument('--activity', choices=('uniform', 'pareto'),
+                            default='uniform',
+                            help="Distribution of strokes between artists")
+        parser.add_argument('--hours', type=float, default=1,
+                            help="Hours before now edits are spread over")
+        parser.add_argument('--seed', type=int,
+                            help="Seed for a reproducible workload")
+        parser.add_argument('--json', action='store_true',
+                            help="Print results as JSON")
+        parser.add_argument('--delete', metavar='RUN',
+                            help="Delete a run's users, canvas, cells and "
+                                 "edits instead")
+
+    def handle(self, *args, **options):
+        if options['delete']:
+            deleted = delete_workload(options['delete'])
+            self.stdout.write(f"Deleted {deleted} rows")
+            return
+        try:
+            results = generate_workload(
+                shape=options['shape'], artists=options['artists'],
+                edits=options['edits'], grid_size=options['grid_size'],
+                cell_size=options['cell_size'],
+                colour_range=options['colour_range'],
+                stroke_length=options['stroke_length'],
+                lengths=options['lengths'], activity=options['activity'],
+                hours=options['hours'], seed=options['seed'])
+        except WorkloadError as error:
+            raise CommandError(error)
+        if options['json']:
+            self.stdout.write(dumps(results, indent=2))
+            return
+        self.stdout.write(
+            f"Run {results['run']}: {results['shape']} canvas "
+            f"{results['slug']} with {results['artists']} artists in "
+            f"{results['cells']} cells\n"
+            f"{results['edits']} edits loaded in {results['seconds']:.1f}s "
+            f"({results['edits_per_second']:.0f}/s): "
+            f"{results['first_edits']} first, {results['own_edits']} own, "
+            f"{results['neighbour_edits']} to neighbours")
@@ -0,0 +1,200 @@
+"""
+Process local metrics of live editing, exposed in Prometheus text format.
+
+Each metric is declared in METRICS with its type and help, and is updated
+with increment (counters and gauges), set_gauge or observe (histograms).
+Updates are a dict change under a lock, cheap enough to leave on in
+production. Labels are keyword arguments, keep their values few (canvas
+ids, not cell ids). render() formats every sample for VisualMetricsView.
+
+    visual_edits_total:             edits committed, per canvas
+    visual_neighbour_fan_out:       neighbours an edit's shared edge
+                                    changes are merged into
+    visual_cell_assignment_seconds: time to find or create and assign a
+                                    cell to an artist
+    visual_canvas_cells:            cells per canvas, counted when scraped
+    visual_consumer_connections:    open websocket and feed connections,
+                                    per consumer
+    visual_channel_layer_send_seconds: channel layer group_send time, per
+                                    event type
+    visual_celery_queue_depth:      messages waiting per Celery queue,
+                                    counted when scraped
+    visual_outbound_merged_total:   neighbour edge changes replaced by a
+                                    newer change before being sent
+    visual_outbound_dropped_total:  replies dropped from a full outbound
+                                    queue
+    visual_outbound_resync_total:   snapshots sent to resync a client after
+                                    dropping replies
+    visual_inbound_rate_limited_total: patches refused for exceeding
+                                    VISUAL_STROKE_RATE
+    visual_neighbour_edits_locked_total: neighbour edits merged holding
+                                    the cell lock after losing every
+                                    version check, per canvas
+
+Todo:
+    * Aggregate across worker processes.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+from math import ceil
+from time import perf_counter
+from typing import Dict, List, Sequence, Tuple
+
+from kombu.exceptions import OperationalError
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+
+METRICS: Dict[str, tuple] = {
+    'visual_edits_total': ('counter', "Edits committed"),
+    'visual_neighbour_fan_out': (
+        'histogram', "Neighbours an edit's shared edges are merged into",
+        (0, 1, 2, 3, 4)),
+    'visual_cell_assignment_seconds': (
+        'histogram', "Time to assign a cell to an artist", SECONDS_BUCKETS),
+    'visual_canvas_cells': ('gauge', "Cells per canvas"),
+    'visual_consumer_connections': ('gauge', "Open consumer connections"),
+    'visual_channel_layer_send_seconds': (
+        'histogram', "Channel layer group_send time", SECONDS_BUCKETS),
+    'visual_celery_queue_depth': ('gauge', "Messages waiting per queue"),
+    'visual_outbound_merged_total': (
+        'counter', "Edge changes merged before being sent"),
+    'visual_outbound_dropped_total': (
+        'counter', "Replies dropped from full outbound queues"),
+    'visual_outbound_resync_total': (
+        'counter', "Snapshots sent after dropping replies"),
+    'visual_inbound_rate_limited_total': (
+        'counter', "Patches refused for exceeding the stroke rate"),
+    'visual_neighbour_edits_locked_total': (
+        'counter', "Neighbour edits merged under lock after conflicts"),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_counters: Dict[Tuple[str, Labels], float] = defaultdict(int)
+_histograms: Dict[Tuple[str, Labels], list] = {}
+_lock = Lock()
+
+
+def _key(name: str, labels: dict) -> Tuple[str, Labels]:
+    return name, tuple(sorted((label, str(value))
+                              for label, value in labels.items()))
+
+
+def increment(name: str, amount: float = 1, **labels):
+    """Add amount to a counter or gauge, negative for gauges going down."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] += amount
+
+
+def set_gauge(name: str, value: float, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = value
+
+
+def clear_gauge(name: str):
+    """Drop every labelled value of a gauge, before setting current ones."""
+    with _lock:
+        for key in [key for key in _counters if key[0] == name]:
+            del _counters[key]
+
+
+def observe(name: str, value: float, **labels):
+    """Count value in the first histogram bucket it fits."""
+    buckets = METRICS[name][2]
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            # A count per bucket then +Inf, the sum and the total count
+            histogram = _histograms[key] = [[0] * (len(buckets) + 1), 0, 0]
+        histogram[0][bisect_left(buckets, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+@contextmanager
+def observe_duration(name: str, **labels):
+    """Observe the seconds spent in the block."""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, perf_counter() - start, **labels)
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(label, value.replace('\\', r'\\')
+                         .replace('"', r'\"').replace('\n', r'\n'))
+        for label, value in labels) + '}'
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def get_counters() -> Dict[str, float]:
+    """Counter and gauge values keyed by name and labels."""
+    with _lock:
+        return {name + _format_labels(labels): value
+                for (name, labels), value in _counters.items()}
+
+
+def render() -> str:
+    """Every sample in the Prometheus text exposition format."""
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, [list(histogram[0]), histogram[1],
+                                   histogram[2]])
+                            for key, histogram in _histograms.items())
+    lines: List[str] = []
+    for name, (metric_type, help_text, *buckets) in sorted(METRICS.items()):
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}']
+        if metric_type != 'histogram':
+            lines += [f'{name}{_format_labels(labels)} {_format_value(value)}'
+                      for (sample_name, labels), value in counters
+                      if sample_name == name]
+            continue
+        for (sample_name, labels), (counts, total, count) in histograms:
+            if sample_name != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(buckets[0] + ('+Inf',), counts):
+                cumulative += bucket_count
+                bucket_labels = labels + (('le', str(bound)),)
+                lines.append(f'{name}_bucket{_format_labels(bucket_labels)} '
+                             f'{cumulative}')
+            lines += [f'{name}_sum{_format_labels(labels)} '
+                      f'{_format_value(total)}',
+                      f'{name}_count{_format_labels(labels)} {count}']
+    return '\n'.join(lines) + '\n'
+
+
+def get_celery_queue_depths(app) -> Dict[str, int]:
+    """Messages waiting in the default Celery queue, if the broker says."""
+    queue = app.conf.task_default_queue
+    with app.connection_for_read() as connection:
+        try:
+            # Fail fast rather than hold up a scrape retrying the broker
+            connection.ensure_connection(max_retries=1)
+            declared = connection.default_channel.queue_declare(
+                queue=queue, passive=True)
+        except (connection.connection_errors + connection.channel_errors +
+                (OperationalError, OSError)):
+            return {}
+    return {queue: declared.message_count}
+
+
+def percentile(values: Sequence[float], fraction: float) -> float:
+    """Nearest rank percentile of values, 0 if there are none."""
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[max(ceil(fraction * len(values)) - 1, 0)]
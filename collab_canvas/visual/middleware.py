@@ -0,0 +1,122 @@
+"""
+Websocket authentication resolved through the cache.
+
+At the start of an event artists connect, and reconnect, in bursts, and
+AuthMiddlewareStack loads the same sessions and users from the database on
+every connect. CachedAuthMiddleware instead keeps each session's user, and
+each user's assigned cells, in the default cache (Redis in production) for
+VISUAL_AUTH_CACHE_TIMEOUT seconds. Logging out deletes the session's entry
+and saving or deleting a cell its artists' (see signals), so in the common
+case connecting needs no database queries to authenticate.
+
+As AuthMiddleware checks a session's auth hash against the user's password,
+each user's current session auth hash is cached too, updated whenever the
+user is saved and dropped if they're deactivated or deleted. A cached user
+whose hash no longer matches is loaded afresh, so changing a password still
+ends other sessions.
+
+Assigned cells are added to scope['visual_cells'] keyed by id, see
+VisualCellEditConsumer.get_cell.
+"""
+from typing import Dict
+
+from channels.auth import AuthMiddleware, get_user
+from channels.db import database_sync_to_async
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.crypto import constant_time_compare
+
+from .models import VisualCell
+
+
+def session_cache_key(session_key: str) -> str:
+    return f'visual.auth.session.{session_key}'
+
+
+def cells_cache_key(user_id) -> str:
+    return f'visual.auth.cells.{user_id}'
+
+
+def auth_hash_cache_key(user_id) -> str:
+    return f'visual.auth.hash.{user_id}'
+
+
+def get_cached_user(session_key: str):
+    """The cached user of a session, or None if not cached or stale."""
+    if not session_key:
+        return None
+    user = cache.get(session_cache_key(session_key))
+    if user is None or not constant_time_compare(
+            cache.get(auth_hash_cache_key(user.id), ''),
+            user.get_session_auth_hash()):
+        return None
+    return user
+
+
+def cache_user(session_key: str, user):
+    cache.set_many({session_cache_key(session_key): user,
+                    auth_hash_cache_key(user.id): user.get_session_auth_hash()},
+                   settings.VISUAL_AUTH_CACHE_TIMEOUT)
+
+
+def update_auth_hash(user):
+    """Cache a saved user's session auth hash, if they may still log in."""
+    if user.is_active:
+        cache.set(auth_hash_cache_key(user.id), user.get_session_auth_hash(),
+                  settings.VISUAL_AUTH_CACHE_TIMEOUT)
+    else:
+        invalidate_auth_hash(user.id)
+
+
+def get_assigned_cells(user) -> Dict[str, VisualCell]:
+    """Cells the user is the artist of keyed by id, cached."""
+    key = cells_cache_key(user.id)
+    cells = cache.get(key)
+    if cells is None:
+        cells = {str(cell.id): cell for cell in
+                 VisualCell.objects.select_related(
+                     'canvas__creator', 'artist').filter(artist=user)}
+        cache.set(key, cells, settings.VISUAL_AUTH_CACHE_TIMEOUT)
+    return cells
+
+
+def invalidate_session(session_key: str):
+    cache.delete(session_cache_key(session_key))
+
+
+def invalidate_auth_hash(user_id):
+    cache.delete(auth_hash_cache_key(user_id))
+
+
+def invalidate_assigned_cells(*user_ids):
+    keys = [cells_cache_key(user_id) for user_id in user_ids
+            if user_id is not None]
+    if keys:
+        cache.delete_many(keys)
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+
+    """AuthMiddleware resolving users and their cells via the cache."""
+
+    def populate_scope(self, scope):
+        super().populate_scope(scope)
+        # Filled in place, as inner applications already have the scope
+        scope.setdefault('visual_cells', {})
+
+    async def resolve_scope(self, scope):
+        session_key = scope['session'].session_key
+        user = await database_sync_to_async(get_cached_user)(session_key)
+        if user is None:
+            user = await get_user(scope)
+            if user.is_authenticated:
+                await database_sync_to_async(cache_user)(session_key, user)
+        scope['user']._wrapped = user
+        if user.is_authenticated:
+            scope['visual_cells'].update(
+                await database_sync_to_async(get_assigned_cells)(user))
+
+
+def CachedAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.5 on 2026-10-19 03:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visual', '0009_auto_20190209_2031'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visualcell',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Number of committed edits, for optimistic concurrency'),
+        ),
+    ]
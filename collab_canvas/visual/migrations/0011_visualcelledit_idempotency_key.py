@@ -0,0 +1,22 @@
+# Generated by Django 2.1.5 on 2026-10-19 04:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visual', '0010_visualcell_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visualcelledit',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=64, null=True, verbose_name='Client key so retried submissions of an edit are only saved once'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='visualcelledit',
+            unique_together={('cell', 'idempotency_key')},
+        ),
+    ]
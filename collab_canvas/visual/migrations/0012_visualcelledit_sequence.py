@@ -0,0 +1,44 @@
+# Generated by Django 2.1.5 on 2026-10-19 04:52
+
+from django.db import migrations, models
+
+
+def number_existing_edits(apps, schema_editor):
+    """Number edits made before sequences in timestamp order per canvas."""
+    VisualCanvas = apps.get_model('visual', 'VisualCanvas')
+    VisualCellEdit = apps.get_model('visual', 'VisualCellEdit')
+    for canvas in VisualCanvas.objects.all():
+        edit_ids = VisualCellEdit.objects.filter(
+            cell__canvas=canvas).order_by(
+                'timestamp', '_order', 'id').values_list('id', flat=True)
+        sequence = 0
+        for sequence, edit_id in enumerate(edit_ids, start=1):
+            VisualCellEdit.objects.filter(id=edit_id).update(
+                sequence=sequence)
+        VisualCanvas.objects.filter(id=canvas.id).update(sequence=sequence)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visual', '0011_visualcelledit_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visualcanvas',
+            name='sequence',
+            field=models.BigIntegerField(default=0, editable=False, verbose_name='Sequence number of the latest edit to any cell of the canvas'),
+        ),
+        migrations.AddField(
+            model_name='visualcelledit',
+            name='sequence',
+            field=models.BigIntegerField(blank=True, editable=False, null=True, verbose_name='Order of the edit among all edits to the canvas'),
+        ),
+        migrations.AddIndex(
+            model_name='visualcelledit',
+            index=models.Index(fields=['cell', 'sequence'], name='visual_visu_cell_id_3ac4c4_idx'),
+        ),
+        migrations.RunPython(number_existing_edits,
+                             migrations.RunPython.noop),
+    ]
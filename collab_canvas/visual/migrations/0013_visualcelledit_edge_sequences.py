@@ -0,0 +1,19 @@
+# Generated by Django 2.1.5 on 2026-10-19 08:17
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visual', '0012_visualcelledit_sequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visualcelledit',
+            name='edge_sequences',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), blank=True, default=list, editable=False, size=None, verbose_name='Sequence of the latest write to each edge position shared with neighbours'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.1.5 on 2026-10-19 09:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visual', '0013_visualcelledit_edge_sequences'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='visualcelledit',
+            index=models.Index(fields=['cell', '_order'], name='visual_visu_cell_id_135820_idx'),
+        ),
+    ]
@@ -9,22 +9,37 @@ Todo:
     * Possibility of generating random cells
     * Rearrange default blank and random cells as cell methods
 """
-from random import shuffle, choice
-from typing import Dict, Tuple, Type
-from uuid import uuid4
+from random import shuffle
+from typing import (Dict, Iterable, List, Optional, Sequence, Set, Tuple,
+                    Type)
+from uuid import UUID, uuid4
 
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from django.contrib.postgres.fields import ArrayField
 from django.core.exceptions import ValidationError
-from django.db.models import (CASCADE, SET_NULL, BigAutoField, CharField,
-                              BooleanField, DateTimeField, ForeignKey, Max,
-                              Model, PositiveSmallIntegerField, IntegerField,
+from django.core.signing import Signer
+from django.db import IntegrityError, connection, transaction
+from django.db.models import (CASCADE, DEFERRED, SET_NULL, BigAutoField,
+                              BigIntegerField, CharField, BooleanField,
+                              DateTimeField, F, ForeignKey, Index, Max, Model,
+                              PositiveIntegerField,
+                              PositiveSmallIntegerField, IntegerField,
                               SlugField, TextField, UUIDField)
 from django.urls import reverse
+from django.utils.crypto import constant_time_compare
 from django.utils.text import slugify
 from django.utils.translation import ugettext_lazy as _
 
 from config.settings.base import AUTH_USER_MODEL
 
+from . import engine, metrics
+from .capture import capture, get_cell_fields, get_user_fields
+from .instrumentation import timed
+from .presence import get_presence
+from .protocol import encode_frame
+from .tracing import continuation, span
+
 
 DEFAULT_SQUARE_GRID_SIZE = 8
 DEFAULT_SQUARE_CELL_SIZE = 8
@@ -94,6 +109,9 @@ class VisualCanvas(Model):
                             default=False)
     new_cells_allowed = BooleanField(_("Allow new cells to be added"),
                                      default=False)
+    sequence = BigIntegerField(
+        _("Sequence number of the latest edit to any cell of the canvas"),
+        default=0, editable=False)
 
     def __str__(self):
         return f'{self.title} ends {self.end_time:%Y-%m-%d %H:%M}'
@@ -101,6 +119,12 @@ class VisualCanvas(Model):
     class Meta:
         verbose_name_plural = "visual canvases"
 
+    @property
+    def layout(self) -> engine.Layout:
+        """The canvas' coordinate rules, see engine.Layout."""
+        return engine.Layout(self.grid_width, self.grid_height,
+                             self.is_torus, self.new_cells_allowed)
+
     @property
     def is_grid(self):
         """Test if both grid_width and grid_height are > 0."""
@@ -114,16 +138,101 @@ class VisualCanvas(Model):
             raise ValidationError(_(f'Torus {self} must  have a width and '
                                     'height'))
 
+    @staticmethod
+    def change_group_name(canvas_id) -> str:
+        """Channel layer group for changes to any cell of a canvas."""
+        return f'visual.canvas.{canvas_id}'
+
+    def get_spectator_token(self) -> str:
+        """Signature of the canvas id letting spectators follow its feed."""
+        return Signer(salt='visual.canvas.spectator').signature(str(self.id))
+
+    def is_spectator_token(self, token: str) -> bool:
+        return constant_time_compare(token, self.get_spectator_token())
+
+    def get_feed_url(self) -> str:
+        """Spectator feed of changes, see VisualCanvasChangeFeedConsumer."""
+        return (f'/visual/canvas/{self.id}/feed/'
+                f'?token={self.get_spectator_token()}')
+
+    @classmethod
+    def reserve_sequence(cls, canvas_id, count: int = 1) -> int:
+        """
+        Increment a canvas sequence by count, returning the first reserved.
+
+        Call within the transaction saving the edits numbered: the canvas row
+        stays locked until it commits, so edits to a canvas commit in
+        sequence order and clients catching up after a sequence number
+        can't miss one committed later. This is the one point all edits to
+        a canvas serialise on, neighbour merges included. Reserve last, just
+        before inserting, and leave propagation and channel sends until
+        after the commit, so other edits to the canvas only wait on the
+        insert.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {cls._meta.db_table} SET sequence = sequence + %s '
+                f'WHERE {cls._meta.pk.column} = %s RETURNING sequence',
+                [count, canvas_id])
+            sequence = cursor.fetchone()[0] - count + 1
+        transaction.on_commit(lambda: metrics.increment(
+            'visual_edits_total', count, canvas=canvas_id))
+        return sequence
+
+    CATCH_UP_MAX_EDITS = 500
+
+    def get_changes_since(self, sequence: int,
+                          cell_ids: Iterable = None) -> dict:
+        """
+        Changes to cells after sequence, to resync a reconnecting client.
+
+        Each changed cell is included once, with a sparse patch of
+        [edge_name, index, value] from its latest valid edit at sequence to
+        its latest valid edit now, or its edges if it had no edit then. If
+        more than CATCH_UP_MAX_EDITS edits were made a snapshot of all the
+        cells' edges is returned instead.
+        """
+        current_sequence = VisualCanvas.objects.values_list(
+            'sequence', flat=True).get(pk=self.pk)
+        edits = VisualCellEdit.objects.filter(
+            cell__canvas=self, is_valid=True, sequence__lte=current_sequence)
+        if cell_ids is not None:
+            edits = edits.filter(cell_id__in=cell_ids)
+        is_snapshot = (edits.filter(sequence__gt=sequence).count() >
+                       self.CATCH_UP_MAX_EDITS)
+        latest_edits = list(
+            (edits if is_snapshot else edits.filter(sequence__gt=sequence))
+            .order_by('cell_id', '-sequence').distinct('cell_id'))
+        base_edits: Dict[UUID, VisualCellEdit] = {}
+        if not is_snapshot and latest_edits:
+            base_edits = {edit.cell_id: edit for edit in edits.filter(
+                cell_id__in=[edit.cell_id for edit in latest_edits],
+                sequence__lte=sequence).order_by(
+                    'cell_id', '-sequence').distinct('cell_id')}
+        cells = []
+        for edit in latest_edits:
+            change = {'cell': str(edit.cell_id), 'edit': edit.id,
+                      'sequence': edit.sequence}
+            if edit.cell_id in base_edits:
+                change['patch'] = edit.get_edges_patch(
+                    base_edits[edit.cell_id])
+            else:
+                change['edges'] = edit.get_edges()
+            cells.append(change)
+        return {'sequence': current_sequence, 'snapshot': is_snapshot,
+                'cells': cells}
+
     def generate_grid(self, can_add=False):
-        """Generate a grid."""
+        """
+        Generate a grid.
+
+        Cells and their first edits are each saved in one insert, see
+        VisualCell.initialize_edits.
+        """
         cell_count = self.visual_cells.count()
         if self.is_grid and cell_count == 0:
-            for x in range(self.grid_width):
-                for y in range(self.grid_height):
-                    self.visual_cells.create(x_position=x, y_position=y,
-                                             width=self.cell_width,
-                                             height=self.cell_height,
-                                             colour_range=self.cell_colour_range)
+            self.add_cells((x, y) for x in range(self.grid_width)
+                           for y in range(self.grid_height))
         elif self.is_grid and can_add and not self.is_torus:
             try:
                 current_max_x, current_max_y = self.visual_cells.aggregate(
@@ -137,13 +246,9 @@ class VisualCanvas(Model):
                                         "are < set max_coordinates "
                                         f"{self.max_coordinates} for canvas "
                                         f"{self.title}"))
-            for x in range(self.grid_width):
-                for y in range(self.grid_height):
-                    if x > current_max_x or y > current_max_y:
-                        self.visual_cells.create(x_position=x, y_position=y,
-                                                 width=self.cell_width,
-                                                 height=self.cell_height,
-                                                 colour_range=self.cell_colour_range)
+            self.add_cells((x, y) for x in range(self.grid_width)
+                           for y in range(self.grid_height)
+                           if x > current_max_x or y > current_max_y)
         elif not can_add and not self.is_torus:
             raise ValidationError(_("Cells can only be added to a grid if "
                                     "can_add=True"))
@@ -151,6 +256,17 @@ class VisualCanvas(Model):
             raise ValidationError(_("Cells cannot be added to a torus that "
                                     f"already has {cell_count} cells"))
 
+    def add_cells(self, coordinates: Iterable[Tuple[int, int]]
+                  ) -> List['VisualCell']:
+        """Bulk create cells of the canvas' dimensions with first edits."""
+        cells = VisualCell.objects.bulk_create(
+            VisualCell(canvas=self, x_position=x, y_position=y,
+                       width=self.cell_width, height=self.cell_height,
+                       colour_range=self.cell_colour_range)
+            for x, y in coordinates)
+        VisualCell.initialize_edits(cells)
+        return cells
+
     @property
     def max_coordinates(self):
         """
@@ -173,10 +289,7 @@ class VisualCanvas(Model):
         Todo:
             * Consider ways of approximating the centre of other shapes
         """
-        if self.is_grid:
-            return (self.max_coordinates[0]//2, self.max_coordinates[1]//2)
-        else:
-            return (0, 0)
+        return self.layout.get_centre_coordinates()
 
     def get_random_cell_coordinates(self):
         """
@@ -186,9 +299,8 @@ class VisualCanvas(Model):
             * Add errors for cases of non-grid
             * Consdier removing random for dynamic grid
         """
-        if self.is_grid:  # Note: must add 1 to include max coordinates
-            return (choice(list(range(self.max_coordinates[0] + 1))),
-                    choice(list(range(self.max_coordinates[1] + 1))))
+        if self.is_grid:
+            return self.layout.get_random_coordinates()
         else:
             self.visual_cells.order_by('?').first().coordinates
 
@@ -203,21 +315,8 @@ class VisualCanvas(Model):
             * Rewrite to more efficiently handle type issues.
             * Try to just handle tuples better
         """
-        type_correct = False
-        if type(coordinates) is not list:
-            coordinates = list(coordinates)
-            type_correct = True
-        if coordinates[0] > self.max_coordinates[0]:
-            coordinates[0] = 0
-        elif coordinates[0] < 0:
-            coordinates[0] = self.max_coordinates[0]
-        if coordinates[1] > self.max_coordinates[1]:
-            coordinates[1] = 0
-        elif coordinates[1] < 0:
-            coordinates[1] = self.max_coordinates[1]
-        if type_correct:
-            return tuple(coordinates)
-        return coordinates
+        wrapped = self.layout.wrap(coordinates)
+        return list(wrapped) if type(coordinates) is list else wrapped
 
     # def find_empty_torus_cell(self):
     #     """Query for place for a new cell."""
@@ -303,46 +402,26 @@ class VisualCanvas(Model):
             artist__isnull=True).values_list('x_position', 'y_position'))
         if not allocated_cells:
             return self.choose_initial_cell(first_cell_algorithm)
-        if (self.is_grid and
-                len(allocated_cells) >= self.grid_height*self.grid_width):
+        layout = self.layout
+        if layout.is_full(len(allocated_cells)):
             raise self.FullGridException
-        COORDINATE_DIFFERENCES = list(VisualCell.ADJACENT_COORDINATES.values())
-        shuffle(allocated_cells)
-        for cell in allocated_cells:
-            shuffle(COORDINATE_DIFFERENCES)
-            for coordinate_difference in COORDINATE_DIFFERENCES:
-                potential_cell = (cell[0] + coordinate_difference[0],
-                                  cell[1] + coordinate_difference[1])
-                if potential_cell not in allocated_cells:  # Might choose a pre-allocated cell
-                    if self.new_cells_allowed:
-                        return VisualCell(canvas=self,
-                                          x_position=potential_cell[0],
-                                          y_position=potential_cell[1],
-                                          width=width, height=height,
-                                          colour_range=colour_range,
-                                          **kwargs)
-                    if self.is_torus:
-                        potential_cell = self.correct_coordinates_for_torus(
-                            potential_cell)
-                        if potential_cell in allocated_cells:
-                            continue
-                    else:  # Grid but not torus
-                        if (not 0 <= potential_cell[0] < self.grid_width or
-                                not 0 <= potential_cell[1] < self.grid_height):
-                            continue
-                    try:
-                        blank_cell = self.visual_cells.get(
-                            x_position=potential_cell[0],
-                            y_position=potential_cell[1], width=width,
-                            height=height, colour_range=colour_range, **kwargs)
-                        if not blank_cell.artist:
-                            return blank_cell
-                    except VisualCell.DoesNotExist:
-                        raise VisualCell.DoesNotExist(_("No cell with that position"))
-                    except AssertionError:
-                        raise ValidationError(_("That cell is already owned by "
-                                                f"another artist {blank_cell.artist}"))
-        raise VisualCell.DoesNotExist(_(f"No available cells in {self} found"))
+        potential_cell = layout.choose_contiguous_coordinates(allocated_cells,
+                                                              shuffle)
+        if potential_cell is None:
+            raise VisualCell.DoesNotExist(
+                _(f"No available cells in {self} found"))
+        if self.new_cells_allowed:
+            return VisualCell(canvas=self, x_position=potential_cell[0],
+                              y_position=potential_cell[1], width=width,
+                              height=height, colour_range=colour_range,
+                              **kwargs)
+        try:
+            return self.visual_cells.get(
+                x_position=potential_cell[0], y_position=potential_cell[1],
+                width=width, height=height, colour_range=colour_range,
+                **kwargs)
+        except VisualCell.DoesNotExist:
+            raise VisualCell.DoesNotExist(_("No cell with that position"))
 
     def get_or_assign_cell(self, artist: Type[AUTH_USER_MODEL], *args,
                            **kwargs):
@@ -351,10 +430,13 @@ class VisualCanvas(Model):
             cell = self.visual_cells.get(artist=artist, *args, **kwargs)
             return cell
         except VisualCell.DoesNotExist:
-            cell = self.get_or_create_contiguous_cell(*args, **kwargs)
-            cell.artist = artist
-            cell.full_clean()
-            cell.save()
+            with capture('assign', **get_user_fields(artist)) as event, \
+                    metrics.observe_duration('visual_cell_assignment_seconds'):
+                cell = self.get_or_create_contiguous_cell(*args, **kwargs)
+                cell.artist = artist
+                cell.full_clean()
+                cell.save()
+                event.update(get_cell_fields(cell))
             return cell
 
     # def artists(self):
@@ -440,10 +522,10 @@ class VisualCell(Model):
         * Consider adding https://mypy.readthedocs.io/en/latest/final_attrs.html
     """
 
-    NORTH = 0
-    EAST = 1
-    SOUTH = 2
-    WEST = 3
+    NORTH = engine.NORTH
+    EAST = engine.EAST
+    SOUTH = engine.SOUTH
+    WEST = engine.WEST
 
     ADJACENT_CHOICES = (
         (NORTH, 'north'),
@@ -452,24 +534,16 @@ class VisualCell(Model):
         (WEST, 'west'),
     )
 
-    ADJACENT_COORDINATES = {
-        'north': (0, 1),
-        'east': (1, 0),
-        'south': (0, -1),
-        'west': (-1, 0),
-    }
+    # Direction a neighbour's edit comes from, keyed by direction sent to
+    NEIGHBOUR_EDIT_SOURCES = engine.NEIGHBOUR_EDIT_SOURCES
 
-    CORNER_COORDINATES = {
-        'north_east': (1, 1),
-        'south_east': (1, -1),
-        'south_west': (-1, -1),
-        'north_west': (-1, 1),
-    }
+    OPPOSITE_DIRECTIONS = engine.OPPOSITE_DIRECTIONS
 
-    NEIGHBOUR_COORDINATES = {
-        **ADJACENT_COORDINATES,
-        **CORNER_COORDINATES
-    }
+    ADJACENT_COORDINATES = engine.ADJACENT_COORDINATES
+
+    CORNER_COORDINATES = engine.CORNER_COORDINATES
+
+    NEIGHBOUR_COORDINATES = engine.NEIGHBOUR_COORDINATES
 
     # Assuming as cells have the same dimensions (default cells)
     # ADJACENT_NEIGHBOUR_EDGES = {
@@ -513,6 +587,9 @@ class VisualCell(Model):
                                  "cell"), default=True)
     neighbours_may_edit = BooleanField(_("Whether artist's neighbours are allowed "
                                          "to edit this cell"), default=True)
+    version = PositiveIntegerField(_("Number of committed edits, for "
+                                     "optimistic concurrency"), default=0,
+                                   editable=False)
 
     class Meta:
 
@@ -521,6 +598,19 @@ class VisualCell(Model):
         unique_together = (("canvas", "artist"),
                            ("canvas", "x_position", "y_position"))
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Keep the loaded artist, for saves to tell if it changed."""
+        cell = super().from_db(db, field_names, values)
+        cell.loaded_artist_id = cell.__dict__.get('artist_id', DEFERRED)
+        return cell
+
+    def user_may_edit(self, user) -> bool:
+        """Whether user is an administrator, the artist or canvas creator."""
+        return user.is_authenticated and (user.is_superuser or
+                                          user == self.artist or
+                                          user == self.canvas.creator)
+
     def clean(self):
         """Means of testing if cell is outside a pre-defined grid."""
         if ((self.canvas.grid_height or self.canvas.grid_width) and
@@ -536,20 +626,52 @@ class VisualCell(Model):
     #             self.initialise_with_neighbour_edges()
     #         elif
 
+    @property
+    def geometry(self) -> engine.Geometry:
+        """The cell's lattice, shared with cells of its size."""
+        return engine.get_geometry(self.width, self.height)
+
     @property
     def adjacent_neighbour_portions(self):
-        return {'north': {'edge_name': 'edges_horizontal',
-                          'self_portion': self.width,
-                          'neighbour_portion': -self.width},
-                'east': {'edge_name': 'edges_vertical',
-                         'self_portion': -self.height,
-                         'neighbour_portion': self.height},
-                'south': {'edge_name': 'edges_horizontal',
-                          'self_portion': -self.width,
-                          'neighbour_portion': self.width},
-                'west': {'edge_name': 'edges_horizontal',
-                         'self_portion': self.height,
-                         'neighbour_portion': -self.height}, }
+        return self.geometry.portions
+
+    get_portion_indices = staticmethod(engine.get_portion_indices)
+
+    @property
+    def shared_edge_positions(self) -> Tuple[Tuple[str, int], ...]:
+        """(edge_name, index) of edge positions shared with neighbours."""
+        return self.geometry.shared_positions
+
+    @classmethod
+    def initialize_edits(cls, cells: List['VisualCell']):
+        """
+        Save the first edit of each new cell, in one insert per canvas.
+
+        Editable cells of canvases allowing new cells start with their
+        neighbours' shared edges, others blank. As those edges are copied
+        from the neighbours there is nothing to dispatch back to them.
+        """
+        edits_by_canvas: Dict[UUID, List[VisualCellEdit]] = {}
+        for cell in cells:
+            if cell.is_editable and cell.canvas.new_cells_allowed:
+                edges = cell.get_blank_with_neighbour_edges()
+            else:
+                edges = cell.default_blank_cell()
+            # Note: we do not assign an artist to the intial design because
+            # it is autogenerated, not the artist's creative choice
+            edits_by_canvas.setdefault(cell.canvas_id, []).append(
+                VisualCellEdit(cell=cell, _order=0, **edges))
+        for canvas_id, edits in edits_by_canvas.items():
+            with transaction.atomic():
+                sequence = VisualCanvas.reserve_sequence(canvas_id,
+                                                         len(edits))
+                for edit in edits:
+                    edit.sequence = sequence
+                    edit.set_edge_sequences()
+                    sequence += 1
+                VisualCellEdit.objects.bulk_create(edits)
+            for edit in edits:
+                edit.cell.send_canvas_change(edit)
 
     def default_blank_cell(self):
         return {k: [0]*l for k, l in self.lattice_dimensions.items()}
@@ -591,12 +713,15 @@ class VisualCell(Model):
         neighbours = self.get_neighbours(
             neighbour_coords=self.ADJACENT_COORDINATES)
         for direction, neighbour in neighbours.items():
-            if neighbour:
+            # Neighbours created alongside this cell have no edit yet
+            neighbour_edit = (neighbour.get_latest_valid_edit_or_none()
+                              if neighbour else None)
+            if neighbour_edit:
                 edge_name, self_portion, neighbour_portion = (
                     self.adjacent_neighbour_portions[direction].values()
                 )  # This assumes python >=3.7 where dicts are ordered
                 edge_segment = edges_dict[edge_name]
-                neighbour_segment = getattr(neighbour.latest_valid_edit, edge_name)
+                neighbour_segment = getattr(neighbour_edit, edge_name)
                 neighbour_edge = (neighbour_segment[:neighbour_portion] if
                                   neighbour_portion > 0
                                   else neighbour_segment[neighbour_portion:])
@@ -607,58 +732,396 @@ class VisualCell(Model):
                     edge_segment[self_portion:] = neighbour_edge
         return edges_dict
 
-    def extract_neighbour_edge_deltas(self):
+    def extract_neighbour_edge_deltas(self, previous_edit=None,
+                                      latest_edit=None):
         """
         Extract deltas that may need to be applied to neighbours.
 
         Note:
             * Currently only gets from latest *valid* edit
+            * previous_edit allows deltas across more than one edit
         """
-        neighbours = {}
-        delta = self.latest_valid_edit.get_edges_delta()
-        for direction, edge_segment in (
-                self.adjacent_neighbour_portions.items()
-        ):
-            edge = delta[edge_segment['edge_name']]
-            segment = edge_segment['self_portion']
-            delta_portion = edge[:segment] if segment > 0 else edge[segment:]
-            if 1 in delta_portion or -1 in delta_portion:
-                neighbours[direction] = {
-                    'edge_name': edge_segment['edge_name'],
-                    'edge': edge,
-                    'edge_delta': delta_portion,
-                    'segment': edge_segment['neighbour_portion']}
-        return neighbours
+        latest_edit = latest_edit or self.latest_valid_edit
+        return engine.extract_neighbour_edge_deltas(
+            self.geometry,
+            latest_edit.get_edges_delta(previous_edit=previous_edit))
+
+    NEIGHBOUR_EDIT_ATTEMPTS = 3
+
+    @staticmethod
+    def edge_group_name(cell_id, direction: str) -> str:
+        """Channel layer group for changes to one edge of a cell."""
+        return f'visual.cell.{cell_id}.{direction}'
+
+    def get_neighbour_edge_groups(
+            self, neighbours: Dict[str, 'VisualCell'] = None) -> List[str]:
+        """Channel layer groups for neighbours' edges shared with this cell."""
+        if neighbours is None:
+            neighbours = self.get_neighbours(
+                neighbour_coords=self.ADJACENT_COORDINATES)
+        return [self.edge_group_name(neighbour.id,
+                                     self.OPPOSITE_DIRECTIONS[direction])
+                for direction, neighbour in neighbours.items()]
+
+    def get_neighbour_edge_change_events(self, latest_edit, delta_portions):
+        """
+        Channel layer (group, event) pairs for changed shared edge segments.
+
+        Each segment goes only to the group for that edge, see
+        VisualCellEditConsumer, with the values it now has rather than the
+        delta so neighbours can apply it regardless of their own state.
+        Changes are packed as protocol frames to keep channel layer
+        messages small. An unsaved latest_edit is sent without an edit id.
+        """
+        events = []
+        for direction, delta_portion in delta_portions.items():
+            edge_name = delta_portion['edge_name']
+            portion = self.adjacent_neighbour_portions[direction]
+            edge = getattr(latest_edit, edge_name)
+            self_portion = portion['self_portion']
+            events.append((
+                self.edge_group_name(self.id, direction),
+                {'type': 'edge.change',
+                 'frame': encode_frame({
+                     'type': 'edge',
+                     'cell': str(self.id),
+                     'edit': latest_edit.id,
+                     'sequence': latest_edit.sequence,
+                     'direction': self.OPPOSITE_DIRECTIONS[direction],
+                     'edge_name': edge_name,
+                     'portion': portion['neighbour_portion'],
+                     'values': (edge[:self_portion] if self_portion > 0
+                                else edge[self_portion:])})}))
+        return events
+
+    def send_neighbour_edge_changes(self, latest_edit, delta_portions):
+        """Send changed shared edge segments to connected neighbours."""
+        channel_layer = get_channel_layer()
+        if not channel_layer:
+            return
+        for group, event in self.get_neighbour_edge_change_events(
+                latest_edit, delta_portions):
+            with span('send_neighbour_edge_change', group=group):
+                with metrics.observe_duration(
+                        'visual_channel_layer_send_seconds',
+                        type=event['type']):
+                    async_to_sync(channel_layer.group_send)(group, event)
+
+    def send_canvas_change(self, latest_edit, previous_edit=None):
+        """
+        Send an edit to the canvas group once committed, for spectators.
+
+        The change is a sparse patch from previous_edit if given, otherwise
+        all the edit's edges. See VisualCanvasChangeFeedConsumer.
+        """
+        channel_layer = get_channel_layer()
+        if not channel_layer:
+            return
+        change = {'cell': str(self.id), 'edit': latest_edit.id,
+                  'sequence': latest_edit.sequence}
+        if previous_edit:
+            change['patch'] = latest_edit.get_edges_patch(previous_edit)
+        else:
+            change['edges'] = latest_edit.get_edges()
+
+        def send():
+            with metrics.observe_duration(
+                    'visual_channel_layer_send_seconds', type='canvas.change'):
+                async_to_sync(channel_layer.group_send)(
+                    VisualCanvas.change_group_name(self.canvas_id),
+                    {'type': 'canvas.change', 'change': change})
+
+        transaction.on_commit(continuation(send, 'send_canvas_change'))
+
+    @staticmethod
+    def get_live_directions(neighbours: Dict[str, 'VisualCell']) -> set:
+        """
+        Directions of neighbours someone is connected to (see presence).
 
-    def dispatch_neighbour_edits(self):
-        delta_portions = self.extract_neighbour_edge_deltas()
+        Every direction if presence can't see every connection.
+        """
+        presence = get_presence()
+        if not presence.sees_every_connection:
+            return set(neighbours)
+        present_cells = presence.get_present_cells(
+            neighbour.id for neighbour in neighbours.values())
+        return {direction for direction, neighbour in neighbours.items()
+                if str(neighbour.id) in present_cells}
+
+    @timed('propagation')
+    @span('dispatch_neighbour_edits')
+    def dispatch_neighbour_edits(self, previous_edit=None,
+                                 send_edge_changes: bool = True):
+        """
+        Merge shared edge changes since previous_edit into neighbours.
+
+        Changes are also sent to connected neighbours unless
+        send_edge_changes is False, for callers that already sent them live
+        (see VisualCellEditConsumer). Merges always land, see
+        merge_edge_writes, so this cell's committed edit is never left
+        unmerged or failed for clients to save twice.
+        """
+        latest_edit = self.latest_valid_edit
+        delta_portions = self.extract_neighbour_edge_deltas(previous_edit,
+                                                            latest_edit)
+        metrics.observe('visual_neighbour_fan_out', len(delta_portions))
         if delta_portions:
             neighbour_coordinates_dict = {k: self.ADJACENT_COORDINATES[k]
                                           for k in delta_portions}
             neighbours = self.get_neighbours(
                 neighbour_coords=neighbour_coordinates_dict)
+            if send_edge_changes:
+                live_directions = self.get_live_directions(neighbours)
+                self.send_neighbour_edge_changes(
+                    latest_edit, {direction: delta_portion for direction,
+                                  delta_portion in delta_portions.items()
+                                  if direction in live_directions})
+            latest_edges = latest_edit.get_edges()
+            latest_sequences = latest_edit.get_edge_sequences()
             for direction, neighbour in neighbours.items():
-                edge_name, edge, edge_delta, segment = (
-                    delta_portions[direction].values()
-                )
-                neighbour_latest = neighbour.latest_valid_edit
-                neighbour_latest.id = None  # Copies the most recent instance
-                neighbour_latest.artist = self.artist
-                latest_edge = getattr(neighbour_latest, edge_name)
-                # Todo: check these are the right portions
-                new_edge = (edge_delta + latest_edge[segment:] if segment > 0
-                            else latest_edge[:segment] + edge_delta)
-                setattr(neighbour_latest, edge_name, new_edge)
-                neighbour_latest.full_clean()
-                neighbour_latest.save()
+                writes = engine.get_neighbour_writes(
+                    self.geometry, direction, delta_portions[direction],
+                    latest_edges, latest_sequences, neighbour.geometry)
+                with span('merge_edge_writes', cell=neighbour.id,
+                          direction=direction, writes=len(writes)):
+                    neighbour.merge_edge_writes(
+                        writes, self.NEIGHBOUR_EDIT_SOURCES[direction],
+                        artist=self.artist)
+
+    def merge_edge_writes(self, writes: Iterable[Tuple[str, int, int, int]],
+                          neighbour_edit: int = None,
+                          artist=None):
+        """
+        Merge (edge_name, index, value, sequence) writes from a neighbour.
+
+        Each shared edge position is a last writer wins register: the
+        latest edit keeps the canvas sequence of the write that set each
+        position (VisualCellEdit.edge_sequences) and only newer writes are
+        applied. As merging doesn't depend on order, concurrent edits to
+        both sides of a boundary converge on both cells whichever commits
+        first, and a merge losing the version check is simply redone.
+        After NEIGHBOUR_EDIT_ATTEMPTS it is redone holding the cell's row
+        lock instead, so it always lands and the boundary can't diverge.
+
+        Returns the saved edit, or None if every write was superseded.
+        """
+        for attempt in range(self.NEIGHBOUR_EDIT_ATTEMPTS):
+            try:
+                return self.commit_edge_writes(writes, neighbour_edit, artist)
+            except self.ConcurrentEditException:
+                self.refresh_from_db(fields=['version'])
+        metrics.increment('visual_neighbour_edits_locked_total',
+                          canvas=self.canvas_id)
+        with transaction.atomic():
+            self.version = VisualCell.objects.select_for_update().filter(
+                pk=self.pk).values_list('version', flat=True).get()
+            return self.commit_edge_writes(writes, neighbour_edit, artist)
+
+    def commit_edge_writes(self, writes, neighbour_edit=None, artist=None):
+        """Commit writes newer than the latest edit's, see merge_edge_writes."""
+        latest_edit = self.latest_valid_edit
+        sequences = latest_edit.get_edge_sequences()
+        applied = engine.get_newer_writes(sequences, writes)
+        if not applied:
+            return None
+        edit = VisualCellEdit(
+            artist=artist, neighbour_edit=neighbour_edit,
+            **self.patch_edges(latest_edit.get_edges(),
+                               [write[:3] for write in applied]))
+        sequences.update({(edge_name, index): sequence for
+                          edge_name, index, value, sequence in applied})
+        edit.edge_sequences = [sequences[position] for position in
+                               self.shared_edge_positions]
+        return self.commit_edits([edit], latest_edit,
+                                 dispatch_neighbours=False)[0]
+
+    class ConcurrentEditException(Exception):
+        pass
+
+    def commit_edits(self, edits: List['VisualCellEdit'],
+                     previous_edit: 'VisualCellEdit' = None,
+                     dispatch_neighbours: bool = True,
+                     send_edge_changes: bool = True):
+        """
+        Save edits in one insert if no other edit committed since loading.
+
+        The cell version is compared and incremented in the same transaction
+        as the insert, which is all the transaction covers. If another edit
+        has committed since this cell was loaded a ConcurrentEditException
+        is raised and the edit can be retried. The version update takes the
+        cell's row lock, so an edit racing one still in progress waits for
+        it to commit before failing its check.
+
+        Reserving the canvas sequence (see VisualCanvas.reserve_sequence)
+        locks the canvas row until the commit, so edits to any cells of a
+        canvas serialise from there: they commit one at a time, in sequence
+        order. That is done just before the insert, and neighbour edits are
+        dispatched after the commit, to keep the wait to an insert and its
+        COMMIT.
+        """
+        # The span ends after the transaction, so includes its COMMIT
+        with span('commit', cell=self.id, edits=len(edits)):
+            with transaction.atomic():
+                updated = VisualCell.objects.filter(
+                    pk=self.pk, version=self.version).update(
+                        version=F('version') + 1)
+                if not updated:
+                    raise self.ConcurrentEditException(
+                        _(f"{self} has changed since version {self.version}"))
+                # bulk_create does not set order_with_respect_to's _order
+                latest_order = self.edits.order_by('-_order').values_list(
+                    '_order', flat=True).first()
+                order = 0 if latest_order is None else latest_order + 1
+                preceding_edit = previous_edit
+                if preceding_edit is None and not edits[0].edge_sequences:
+                    preceding_edit = self.get_latest_valid_edit_or_none()
+                sequence = VisualCanvas.reserve_sequence(self.canvas_id,
+                                                         len(edits))
+                for edit in edits:
+                    edit.cell = self
+                    edit._order = order
+                    edit.sequence = sequence
+                    if not edit.edge_sequences:
+                        edit.set_edge_sequences(preceding_edit)
+                    preceding_edit = edit
+                    order += 1
+                    sequence += 1
+                edits = VisualCellEdit.objects.bulk_create(edits)
+        self.version += 1
+        self.send_canvas_change(edits[-1], previous_edit)
+        if dispatch_neighbours:
+            self.dispatch_neighbour_edits(previous_edit=previous_edit,
+                                          send_edge_changes=send_edge_changes)
+        return edits
+
+    class StaleEditException(Exception):
+        pass
+
+    def get_patch_base(self, base_edit_id: int = None):
+        """
+        Return the latest valid edit for patches, checking base_edit_id.
+
+        If base_edit_id is passed and is no longer the latest valid edit a
+        StaleEditException is raised.
+        """
+        try:
+            latest_edit = self.latest_valid_edit
+        except VisualCellEdit.DoesNotExist:
+            latest_edit = None
+        if base_edit_id is not None and (not latest_edit or
+                                         latest_edit.id != base_edit_id):
+            raise self.StaleEditException(
+                _(f"Edit {base_edit_id} is not the latest valid edit of "
+                  f"{self}"))
+        if not latest_edit:
+            # Note: we do not assign an artist to the intial design because
+            # it is autogenerated, not the artist's creative choice
+            latest_edit = self.edits.create(
+                **self.get_blank_with_neighbour_edges())
+        return latest_edit
+
+    def patch_edges(self, edges: Dict[str, list],
+                    patch: Iterable[Tuple[str, int, int]]):
+        """
+        Return a copy of edges with (edge_name, index, value) changes.
+
+        Only patched positions are validated, and only patched edge arrays
+        are copied, so the cost scales with the patch rather than cell size.
+        """
+        dimensions = self.lattice_dimensions
+        edges = dict(edges)
+        copied_edges: Set[str] = set()
+        for edge_name, index, value in patch:
+            if edge_name not in dimensions:
+                raise ValidationError(_(f"{edge_name} is not an edge"))
+            if not 0 <= index < dimensions[edge_name]:
+                raise ValidationError(_(f"{edge_name} index {index} is "
+                                        "outside the cell lattice"))
+            if not 0 <= value <= self.colour_range:
+                raise ValidationError(_(f"{edge_name} value {value} is "
+                                        "outside the colour range"))
+            if edge_name not in copied_edges:
+                edges[edge_name] = list(edges[edge_name])
+                copied_edges.add(edge_name)
+            edges[edge_name][index] = value
+        return edges
+
+    def get_idempotent_edits(self,
+                             idempotency_keys: Sequence[Optional[str]]):
+        """
+        Return edits already committed with idempotency_keys, in key order.
+
+        Returns an empty list if none were committed. A ValidationError is
+        raised if only some were, as keys are committed together.
+        """
+        edits = {edit.idempotency_key: edit for edit in
+                 self.edits.filter(idempotency_key__in=idempotency_keys)}
+        if edits and len(edits) != len(set(idempotency_keys)):
+            raise ValidationError(_("Idempotency keys "
+                                    f"{', '.join(edits)} were already used "
+                                    "in a different batch of edits"))
+        return [edits[key] for key in idempotency_keys if key in edits]
+
+    def apply_edit_patch(self, patch: Iterable[Tuple[str, int, int]],
+                         artist=None,
+                         base_edit_id: int = None,
+                         idempotency_key: str = None,
+                         send_edge_changes: bool = True):
+        """Save a new edit applying (edge_name, index, value) changes."""
+        return self.apply_edit_patches(
+            [patch], artist=artist, base_edit_id=base_edit_id,
+            idempotency_keys=[idempotency_key] if idempotency_key else None,
+            send_edge_changes=send_edge_changes)[0]
+
+    def apply_edit_patches(self,
+                           patches: Iterable[Iterable[Tuple[str, int, int]]],
+                           artist=None,
+                           base_edit_id: int = None,
+                           idempotency_keys: List[Optional[str]] = None,
+                           send_edge_changes: bool = True):
+        """
+        Save an ordered batch of patches as one edit each, in one insert.
+
+        All patches are validated before anything is saved. As bulk_create
+        skips post_save, neighbour edits are dispatched once for the net
+        change across the batch rather than per edit.
+
+        If idempotency_keys (one per patch) were already committed, the
+        original edits are returned without writing or dispatching again.
+        """
+        patches = list(patches)
+        if idempotency_keys:
+            if len(idempotency_keys) != len(patches):
+                raise ValidationError(_("One idempotency key is needed per "
+                                        "edit"))
+            committed_edits = self.get_idempotent_edits(idempotency_keys)
+            if committed_edits:
+                return committed_edits
+        else:
+            idempotency_keys = [None]*len(patches)
+        latest_edit = self.get_patch_base(base_edit_id)
+        edges = latest_edit.get_edges()
+        edits = []
+        for patch, idempotency_key in zip(patches, idempotency_keys):
+            edges = self.patch_edges(edges, patch)
+            edits.append(VisualCellEdit(artist=artist,
+                                        idempotency_key=idempotency_key,
+                                        **edges))
+        try:
+            return self.commit_edits(edits, previous_edit=latest_edit,
+                                     send_edge_changes=send_edge_changes)
+        except IntegrityError:
+            # A retry with the same keys committed first
+            committed_edits = (self.get_idempotent_edits(idempotency_keys)
+                               if any(idempotency_keys) else None)
+            if not committed_edits:
+                raise
+            return committed_edits
 
     @property
     def lattice_dimensions(self):
         """Default ratios of lengths of rectangular cells with diagonals."""
-        return {'edges_horizontal': self.width**2 + self.width,
-                'edges_vertical': self.height**2 + self.height,
-                'edges_south_east': self.width*self.height,
-                'edges_south_west': self.width*self.height, }
+        return self.geometry.dimensions
 
     @property
     def coordinates(self):
@@ -714,11 +1177,8 @@ class VisualCell(Model):
         """
         neighbour_coords = neighbour_coords or self.NEIGHBOUR_COORDINATES
         neighbours = {}
-        for direction, coordinate_difference in neighbour_coords.items():
-            coords = (self.x_position + coordinate_difference[0],
-                      self.y_position + coordinate_difference[1])
-            if self.canvas.is_torus:
-                coords = self.canvas.correct_coordinates_for_torus(coords)
+        for direction, coords in self.canvas.layout.get_neighbour_coordinates(
+                self.coordinates, neighbour_coords).items():
             try:
                 neighbour = self.canvas.visual_cells.get(x_position=coords[0],
                                                          y_position=coords[1])
@@ -747,7 +1207,14 @@ class VisualCell(Model):
     @property
     def latest_valid_edit(self):
         """Latest valid edit, often for display to artists for further edits."""
-        return self.edits.filter(is_valid=True).latest()
+        # _order breaks ties between bulk created edits sharing a timestamp
+        return self.edits.filter(is_valid=True).latest('timestamp', '_order')
+
+    def get_latest_valid_edit_or_none(self):
+        try:
+            return self.latest_valid_edit
+        except VisualCellEdit.DoesNotExist:
+            return None
 
     # def set_neighbours(self):
     #     for direction, coordinates in CELL_NEIGHBOURS.items():
@@ -775,7 +1242,6 @@ class VisualCellEdit(Model):
         * Decide if a boolean 'submit' (or similar) is worth including to
         indicate artist's sense of "completion"
         * Whether it's worth marking with comments
-        * Whether a sequence number is worth saving
         * How to mark issues or skips in time series
         * See if it's worth adding ordering to Meta
         * See if the order_with_respect_to is worth it...
@@ -797,6 +1263,17 @@ class VisualCellEdit(Model):
     neighbour_edit = PositiveSmallIntegerField(
         _("Which neighbour, if any, is the source of the edit"),
         blank=True, null=True, choices=VisualCell.ADJACENT_CHOICES)
+    idempotency_key = CharField(
+        _("Client key so retried submissions of an edit are only saved once"),
+        max_length=64, blank=True, null=True)
+    sequence = BigIntegerField(
+        _("Order of the edit among all edits to the canvas"),
+        blank=True, null=True, editable=False)
+    edge_sequences = ArrayField(
+        BigIntegerField(),
+        verbose_name=_("Sequence of the latest write to each edge position "
+                       "shared with neighbours"),
+        blank=True, default=list, editable=False)
 
     def __str__(self):
         """
@@ -814,6 +1291,29 @@ class VisualCellEdit(Model):
                        kwargs={'cell_id': self.cell.id,
                                'cell_history': self.history_number})
 
+    def save(self, *args, **kwargs):
+        """
+        Number new edits with the next canvas sequence number.
+
+        Neighbour dispatch from post_save is deferred until the insert has
+        committed, so it doesn't hold the canvas sequence locked.
+        """
+        if self.pk is None:
+            # services imports models
+            from .services import defer_side_effects
+            previous_edit = (None if self.edge_sequences else
+                             self.cell.get_latest_valid_edit_or_none())
+            with defer_side_effects():
+                with transaction.atomic():
+                    self.sequence = VisualCanvas.reserve_sequence(
+                        self.cell.canvas_id)
+                    if not self.edge_sequences:
+                        self.set_edge_sequences(previous_edit)
+                    super().save(*args, **kwargs)
+            self.cell.send_canvas_change(self)
+        else:
+            super().save(*args, **kwargs)
+
     @classmethod
     def get_edge_names(cls):
         """Currently returns all egdes, but may be restrictable in future."""
@@ -825,21 +1325,54 @@ class VisualCellEdit(Model):
         return {edge_name: getattr(self, edge_name) for edge_name in
                 self.get_edge_names()}
 
+    def get_edge_sequences(self) -> Dict[Tuple[str, int], int]:
+        """
+        Sequence of the latest write to each shared edge position.
+
+        Edits saved before sequences were kept count as the latest write.
+        """
+        positions = self.cell.shared_edge_positions
+        sequences = self.edge_sequences or [self.sequence or 0]*len(positions)
+        return dict(zip(positions, sequences))
+
+    def set_edge_sequences(self, previous_edit=None):
+        """Record this edit's sequence for shared positions it changes."""
+        if previous_edit is None:
+            self.edge_sequences = [self.sequence] * len(
+                self.cell.shared_edge_positions)
+            return
+        previous_sequences = previous_edit.get_edge_sequences()
+        self.edge_sequences = [
+            self.sequence if getattr(self, edge_name)[index] != getattr(
+                previous_edit, edge_name)[index] else sequence
+            for (edge_name, index), sequence in previous_sequences.items()]
+
     # def get_edges(self):
     #     """Yield edges as tuples of name and value."""
     #     for edge_name in self.get_edge_names():
     #         yield edge_name, getatrr()
 
-    def get_edges_delta(self, valid_only: bool = True):
+    def get_edges_patch(self, previous_edit) -> List[list]:
+        """Sparse [edge_name, index, value] changes since previous_edit."""
+        return [[edge_name, index, value]
+                for edge_name in self.get_edge_names()
+                for index, (value, previous) in enumerate(
+                    zip(getattr(self, edge_name),
+                        getattr(previous_edit, edge_name)))
+                if value != previous]
+
+    def get_edges_delta(self, valid_only: bool = True, previous_edit=None):
         """
         Get difference in edge vector between self and valid predecessor.
 
         Note:
             * If valid_only is False then it will be delta with respect to
             timestamp.
+            * Passing previous_edit gives the delta to that edit instead.
         """
-        previous_edit = (self.get_previous_valid_edit() if valid_only else
-                         self.get_previous_in_order())
+        if not previous_edit:
+            previous_edit = (self.get_previous_valid_edit() if valid_only else
+                             self.get_previous_in_order())
         if previous_edit:
             delta = {}
             for edge_name in self.get_edge_names():
@@ -904,4 +1437,7 @@ class VisualCellEdit(Model):
             * Enforcing permission is key
         """
         order_with_respect_to = 'cell'
+        unique_together = (('cell', 'idempotency_key'),)
+        indexes = [Index(fields=['cell', 'sequence']),
+                   Index(fields=['cell', '_order'])]
         get_latest_by = 'timestamp'  # Hopefully order_with_respect_to + get
@@ -0,0 +1,156 @@
+"""
+Who is connected to each cell and canvas, kept with expiring heartbeats.
+
+Each VisualCellEditConsumer connection joins the presence of its cell and
+canvas, heartbeats while open and leaves on disconnect. A connection whose
+worker dies stops heartbeating and is ignored after VISUAL_PRESENCE_TIMEOUT.
+
+With django-redis caches presence is shared between workers as a Redis hash
+per cell and per canvas, keyed by channel name, so joining, heartbeating and
+leaving are O(1) hash writes. Other caches (local development and tests)
+keep presence in process, which only sees every connection able to receive
+edge changes if the channel layer is in process too. Otherwise a warning
+is logged and sees_every_connection is False, so edge changes are sent to
+every neighbour rather than skipping ones connected to other workers.
+
+Todo:
+    * Prune stale hash entries in a periodic task rather than on read.
+"""
+from json import dumps, loads
+from logging import getLogger
+from time import time
+from typing import Dict, Iterable, List, Optional, Set
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+from django_redis import get_redis_connection
+
+logger = getLogger(__name__)
+
+
+def cell_key(cell_id) -> str:
+    return f'visual.presence.cell.{cell_id}'
+
+
+def canvas_key(canvas_id) -> str:
+    return f'visual.presence.canvas.{canvas_id}'
+
+
+class Presence:
+
+    """Presence kept in process, for caches without shared state."""
+
+    def __init__(self, timeout: float = None,
+                 sees_every_connection: bool = True):
+        self.timeout = timeout or settings.VISUAL_PRESENCE_TIMEOUT
+        self.sees_every_connection = sees_every_connection
+        self.hashes: Dict[str, Dict[str, str]] = {}
+
+    def is_live(self, heartbeat: float, now: float) -> bool:
+        return now - heartbeat < self.timeout
+
+    def join(self, canvas_id, cell_id, connection: str, user):
+        """Add or heartbeat a connection to a cell."""
+        now = time()
+        self._set_many([
+            (cell_key(cell_id), connection, dumps(now)),
+            (canvas_key(canvas_id), connection, dumps(
+                {'cell': str(cell_id), 'user': str(user.id),
+                 'username': user.username, 'heartbeat': now}))])
+
+    heartbeat = join
+
+    def leave(self, canvas_id, cell_id, connection: str):
+        self._delete_many([(cell_key(cell_id), connection),
+                           (canvas_key(canvas_id), connection)])
+
+    def get_present_cells(self, cell_ids: Iterable) -> Set[str]:
+        """Which of cell_ids have a live connection."""
+        now = time()
+        cell_ids = [str(cell_id) for cell_id in cell_ids]
+        return {cell_id for cell_id, heartbeats in zip(
+                    cell_ids, self._get_values([cell_key(cell_id)
+                                                for cell_id in cell_ids]))
+                if any(self.is_live(loads(heartbeat), now)
+                       for heartbeat in heartbeats)}
+
+    def get_canvas_presence(self, canvas_id) -> List[dict]:
+        """Live connections to a canvas, pruning any expired."""
+        now = time()
+        key = canvas_key(canvas_id)
+        presence, expired = [], []
+        for connection, value in self._get_items(key):
+            value = loads(value)
+            if self.is_live(value['heartbeat'], now):
+                presence.append(value)
+            else:
+                expired.append(connection)
+        self._delete_many([(key, connection) for connection in expired])
+        return sorted(presence, key=lambda value: value['heartbeat'])
+
+    def _set_many(self, items):
+        for key, field, value in items:
+            self.hashes.setdefault(key, {})[field] = value
+
+    def _delete_many(self, items):
+        for key, field in items:
+            self.hashes.get(key, {}).pop(field, None)
+
+    def _get_values(self, keys: List[str]) -> List[List[str]]:
+        return [list(self.hashes.get(key, {}).values()) for key in keys]
+
+    def _get_items(self, key: str):
+        return list(self.hashes.get(key, {}).items())
+
+
+class RedisPresence(Presence):
+
+    """Presence shared between workers as Redis hashes."""
+
+    def __init__(self, redis, timeout: float = None):
+        super().__init__(timeout)
+        self.redis = redis
+
+    def _set_many(self, items):
+        pipeline = self.redis.pipeline(transaction=False)
+        for key, field, value in items:
+            # The whole hash expires once no connection heartbeats
+            pipeline.hset(key, field, value)
+            pipeline.expire(key, int(self.timeout) + 1)
+        pipeline.execute()
+
+    def _delete_many(self, items):
+        pipeline = self.redis.pipeline(transaction=False)
+        for key, field in items:
+            pipeline.hdel(key, field)
+        pipeline.execute()
+
+    def _get_values(self, keys: List[str]) -> List[List[str]]:
+        pipeline = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipeline.hvals(key)
+        return [[value.decode() for value in values]
+                for values in pipeline.execute()]
+
+    def _get_items(self, key: str):
+        return [(connection.decode(), value.decode())
+                for connection, value in self.redis.hgetall(key).items()]
+
+
+_presence: Optional[Presence] = None
+
+
+def get_presence() -> Presence:
+    """Presence shared via Redis if the default cache is django-redis."""
+    global _presence
+    if _presence is None:
+        try:
+            _presence = RedisPresence(get_redis_connection())
+        except NotImplementedError:
+            _presence = Presence(sees_every_connection=isinstance(
+                get_channel_layer(), InMemoryChannelLayer))
+            if not _presence.sees_every_connection:
+                logger.warning("Presence is kept per process as the default "
+                               "cache isn't django-redis, so edge changes "
+                               "are sent to every neighbour")
+    return _presence
@@ -0,0 +1,118 @@
+"""
+Opt-in cProfile of a sample of visual requests and consumer messages.
+
+VISUAL_PROFILE_SAMPLE_RATE of requests to visual views, and of patches and
+flushes committed by VisualCellEditConsumer, are profiled. Staff can also
+profile a request, or every message of a websocket connection, by sending
+an ``X-Visual-Profile: 1`` header. Each profile is dumped to
+VISUAL_PROFILE_DIR as a .prof file for pstats or snakeviz, keeping the
+latest VISUAL_PROFILE_KEEP, and listed for staff by VisualProfileListView.
+
+cProfile only sees the thread it was enabled in, so consumers profile
+their synchronous database work rather than the event loop.
+"""
+from cProfile import Profile
+from contextlib import contextmanager
+from datetime import datetime
+from os import listdir, makedirs, remove, stat
+from os.path import join
+from random import random
+from re import sub
+from typing import Dict, List
+
+from django.conf import settings
+
+PROFILE_HEADER = 'HTTP_X_VISUAL_PROFILE'
+PROFILE_SUFFIX = '.prof'
+
+
+def is_profile_requested(user, header: str) -> bool:
+    """Whether a staff user asked for a profile with the header."""
+    return header == '1' and user.is_authenticated and user.is_staff
+
+
+def is_sampled() -> bool:
+    return random() < settings.VISUAL_PROFILE_SAMPLE_RATE
+
+
+def start_profile() -> Profile:
+    profiler = Profile()
+    profiler.enable()
+    return profiler
+
+
+def save_profile(profiler: Profile, name: str) -> str:
+    """Dump a profile as a timestamped file, dropping the oldest."""
+    profiler.disable()
+    makedirs(settings.VISUAL_PROFILE_DIR, exist_ok=True)
+    file_name = '{}-{}{}'.format(
+        datetime.utcnow().strftime('%Y%m%dT%H%M%S.%f'),
+        sub(r'[^\w.-]+', '_', name), PROFILE_SUFFIX)
+    profiler.dump_stats(join(settings.VISUAL_PROFILE_DIR, file_name))
+    for profile in get_profiles()[settings.VISUAL_PROFILE_KEEP:]:
+        try:
+            remove(join(settings.VISUAL_PROFILE_DIR, profile['name']))
+        except FileNotFoundError:
+            pass  # Dropped by another process saving at the same time
+    return file_name
+
+
+@contextmanager
+def profile(name: str, force: bool = False):
+    """Profile the block if forced or sampled."""
+    if not (force or is_sampled()):
+        yield
+        return
+    profiler = start_profile()
+    try:
+        yield
+    finally:
+        save_profile(profiler, name)
+
+
+def get_profiles() -> List[Dict]:
+    """Saved profiles, newest first."""
+    try:
+        file_names = listdir(settings.VISUAL_PROFILE_DIR)
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for file_name in file_names:
+        if not file_name.endswith(PROFILE_SUFFIX):
+            continue
+        try:
+            stats = stat(join(settings.VISUAL_PROFILE_DIR, file_name))
+        except FileNotFoundError:
+            continue  # Dropped since listing
+        profiles.append({
+            'name': file_name, 'size': stats.st_size,
+            'created': datetime.utcfromtimestamp(stats.st_mtime)})
+    return sorted(profiles, key=lambda profile: profile['name'],
+                  reverse=True)
+
+
+class VisualProfilingMiddleware:
+
+    """Profile sampled or staff requested requests to visual views."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler = getattr(request, 'visual_profiler', None)
+            if profiler is not None:
+                file_name = save_profile(profiler,
+                                         request.resolver_match.view_name)
+        if profiler is not None:
+            response['X-Visual-Profile'] = file_name
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """Start profiling once the view is known to be a visual one."""
+        if request.resolver_match.app_name == 'visual' and (
+                is_sampled() or is_profile_requested(
+                    request.user, request.META.get(PROFILE_HEADER))):
+            request.visual_profiler = start_profile()
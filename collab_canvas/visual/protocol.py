@@ -0,0 +1,206 @@
+"""
+Binary and JSON encodings of messages sent over VisualCellEditConsumer.
+
+Messages are dicts with a 'type' key, as sent in the JSON fallback. Binary
+frames pack the same messages (network byte order) after a two byte header
+of protocol version and message type:
+
+    patch:          base_edit (q, 0 if none), idempotency key (B length,
+                    utf-8), changes (H count, then B edge, H index, h value)
+    edge:           cell (16s uuid), edit (q), sequence (q), direction (B),
+                    edge (B), portion (h), values (H count, h values)
+    ack:            edit (q), sequence (q)
+    error:          flags (B, 1 retry, 2 stale), errors (B count, then H
+                    length and utf-8 each)
+    get_snapshot:   no body
+    snapshot:       cell (16s uuid), edit (q), sequence (q), then each edge
+                    in EDGE_NAMES order as values (H count, h values)
+
+Values are signed to match the edge arrays stored on VisualCellEdit. An edit
+or sequence of 0 packs None, for changes buffered but not yet saved.
+Sequences are the canvas sequence numbers of edits (see
+VisualCanvas.get_changes_since), which clients keep to catch up after
+reconnecting.
+
+Todo:
+    * Bump PROTOCOL_VERSION when any layout changes, older frames are
+      rejected rather than guessed at.
+"""
+from json import dumps, loads, JSONDecodeError
+from struct import Struct, error as StructError
+from typing import Any, Dict
+from uuid import UUID
+
+PROTOCOL_VERSION = 2
+
+BINARY_SUBPROTOCOL = f'visual.binary.v{PROTOCOL_VERSION}'
+
+MESSAGE_TYPES = ('patch', 'edge', 'ack', 'error', 'get_snapshot', 'snapshot')
+MESSAGE_TYPE_CODES = {name: code for code, name in enumerate(MESSAGE_TYPES)}
+
+EDGE_NAMES = ('edges_horizontal', 'edges_vertical', 'edges_south_east',
+              'edges_south_west')
+EDGE_NAME_CODES = {name: code for code, name in enumerate(EDGE_NAMES)}
+
+DIRECTIONS = ('north', 'east', 'south', 'west')
+DIRECTION_CODES = {name: code for code, name in enumerate(DIRECTIONS)}
+
+ERROR_RETRY = 1
+ERROR_STALE = 2
+
+HEADER = Struct('>BB')
+PATCH_HEADER = Struct('>qB')
+COUNT = Struct('>H')
+CHANGE = Struct('>BHh')
+EDGE_HEADER = Struct('>16sqqBBh')
+EDIT = Struct('>qq')
+ERROR_HEADER = Struct('>BB')
+SNAPSHOT_HEADER = Struct('>16sqq')
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def _pack_values(values) -> bytes:
+    return COUNT.pack(len(values)) + Struct(f'>{len(values)}h').pack(*values)
+
+
+def _unpack_values(frame: bytes, offset: int):
+    count, = COUNT.unpack_from(frame, offset)
+    offset += COUNT.size
+    values_struct = Struct(f'>{count}h')
+    values = list(values_struct.unpack_from(frame, offset))
+    return values, offset + values_struct.size
+
+
+def encode_frame(message: dict) -> bytes:
+    """Pack a message dict into a binary frame."""
+    message_type = message['type']
+    try:
+        frame = HEADER.pack(PROTOCOL_VERSION,
+                            MESSAGE_TYPE_CODES[message_type])
+        if message_type == 'patch':
+            key = (message.get('idempotency_key') or '').encode()
+            changes = message['patch']
+            return b''.join(
+                [frame, PATCH_HEADER.pack(message.get('base_edit') or 0,
+                                          len(key)),
+                 key, COUNT.pack(len(changes))] +
+                [CHANGE.pack(EDGE_NAME_CODES[edge_name], index, value)
+                 for edge_name, index, value in changes])
+        if message_type == 'edge':
+            return b''.join([
+                frame,
+                EDGE_HEADER.pack(UUID(message['cell']).bytes,
+                                 message['edit'] or 0,
+                                 message.get('sequence') or 0,
+                                 DIRECTION_CODES[message['direction']],
+                                 EDGE_NAME_CODES[message['edge_name']],
+                                 message['portion']),
+                _pack_values(message['values'])])
+        if message_type == 'ack':
+            return frame + EDIT.pack(message['edit'] or 0,
+                                     message.get('sequence') or 0)
+        if message_type == 'error':
+            flags = ((ERROR_RETRY if message.get('retry') else 0) |
+                     (ERROR_STALE if message.get('stale') else 0))
+            errors = [error.encode() for error in message['errors']]
+            return b''.join(
+                [frame, ERROR_HEADER.pack(flags, len(errors))] +
+                [COUNT.pack(len(error)) + error for error in errors])
+        if message_type == 'snapshot':
+            return b''.join(
+                [frame, SNAPSHOT_HEADER.pack(UUID(message['cell']).bytes,
+                                             message['edit'] or 0,
+                                             message.get('sequence') or 0)] +
+                [_pack_values(message['edges'][edge_name])
+                 for edge_name in EDGE_NAMES])
+        return frame
+    except (KeyError, TypeError, StructError) as error:
+        raise ProtocolError(f"Can't encode {message_type} message: {error}")
+
+
+def decode_frame(frame: bytes) -> dict:
+    """Unpack a binary frame into a message dict."""
+    try:
+        version, type_code = HEADER.unpack_from(frame)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError(f"Unsupported protocol version {version}")
+        message_type = MESSAGE_TYPES[type_code]
+        message: Dict[str, Any] = {'type': message_type}
+        offset = HEADER.size
+        if message_type == 'patch':
+            base_edit, key_length = PATCH_HEADER.unpack_from(frame, offset)
+            offset += PATCH_HEADER.size
+            key = frame[offset:offset + key_length].decode()
+            offset += key_length
+            count, = COUNT.unpack_from(frame, offset)
+            offset += COUNT.size
+            message['patch'] = [
+                [EDGE_NAMES[edge_code], index, value]
+                for edge_code, index, value in CHANGE.iter_unpack(
+                    frame[offset:offset + count * CHANGE.size])]
+            offset += count * CHANGE.size
+            message['base_edit'] = base_edit or None
+            message['idempotency_key'] = key or None
+        elif message_type == 'edge':
+            cell, edit, sequence, direction, edge_code, portion = (
+                EDGE_HEADER.unpack_from(frame, offset))
+            message['values'], offset = _unpack_values(
+                frame, offset + EDGE_HEADER.size)
+            message.update(cell=str(UUID(bytes=cell)), edit=edit or None,
+                           sequence=sequence or None,
+                           direction=DIRECTIONS[direction],
+                           edge_name=EDGE_NAMES[edge_code], portion=portion)
+        elif message_type == 'ack':
+            edit, sequence = EDIT.unpack_from(frame, offset)
+            message['edit'] = edit or None
+            message['sequence'] = sequence or None
+            offset += EDIT.size
+        elif message_type == 'error':
+            flags, count = ERROR_HEADER.unpack_from(frame, offset)
+            offset += ERROR_HEADER.size
+            errors = []
+            for _ in range(count):
+                length, = COUNT.unpack_from(frame, offset)
+                offset += COUNT.size
+                errors.append(frame[offset:offset + length].decode())
+                offset += length
+            message['errors'] = errors
+            if flags & ERROR_RETRY:
+                message['retry'] = True
+            if flags & ERROR_STALE:
+                message['stale'] = True
+        elif message_type == 'snapshot':
+            cell, edit, sequence = SNAPSHOT_HEADER.unpack_from(frame,
+                                                               offset)
+            offset += SNAPSHOT_HEADER.size
+            edges = {}
+            for edge_name in EDGE_NAMES:
+                edges[edge_name], offset = _unpack_values(frame, offset)
+            message.update(cell=str(UUID(bytes=cell)), edit=edit or None,
+                           sequence=sequence or None, edges=edges)
+    except (IndexError, StructError, UnicodeDecodeError) as error:
+        raise ProtocolError(f"Malformed frame: {error}")
+    if offset != len(frame):
+        raise ProtocolError(f"Malformed frame: {len(frame) - offset} "
+                            "trailing bytes")
+    return message
+
+
+def encode_json(message: dict) -> str:
+    """Encode a message as JSON text, the fallback for debugging."""
+    return dumps(message)
+
+
+def decode_json(text: str) -> dict:
+    """Decode a JSON text message."""
+    try:
+        message = loads(text)
+    except JSONDecodeError as error:
+        raise ProtocolError(f"Malformed JSON: {error}")
+    if not isinstance(message, dict) or message.get('type') not in (
+            MESSAGE_TYPE_CODES):
+        raise ProtocolError("Messages must be objects with a known type")
+    return message
@@ -0,0 +1,313 @@
+"""
+Replay a captured workload (see capture) against this database.
+
+read_capture loads a VISUAL_CAPTURE_LOG file. run_replay creates a canvas
+like each one captured, and a user standing in for each captured user,
+then re-drives every event at the offset it was captured at divided by
+speed (0 for as fast as possible):
+
+    assign:     VisualCanvas.get_or_assign_cell for the user
+    request:    the captured form data posted to the same view by a test
+                Client logged in as the user, with host as its Host header
+    connect, message and disconnect:
+                a websocket per captured connection to an ASGI application,
+                as in loadtest
+
+Captured cells are matched to replayed ones by assignment, otherwise by
+position, and are assigned to the user editing them if nobody is, as they
+may have been assigned before capture started. base_edit is dropped from
+requests and messages since edit ids differ in a replay. Each user's
+assignments and requests, and each connection's messages, are replayed in
+order while different ones overlap as they did when captured.
+
+Reported with throughput, per kind of event:
+
+    latency:    replayed seconds, to the reply for messages
+    captured:   captured seconds (d), to handling a message
+    lag:        seconds events started behind schedule, if this process
+                couldn't keep up
+
+Like loadtest everything runs in this process, so compare replays run
+with the same settings against a fresh database.
+"""
+from asyncio import gather, sleep
+from collections import defaultdict
+from datetime import timedelta
+from json import loads
+from time import perf_counter
+from typing import Any, DefaultDict, Dict, List, Tuple
+from urllib.parse import urlsplit
+from uuid import uuid4
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.text import slugify
+
+from .capture import CANVAS_FIELDS
+from .loadtest import (SimulatedArtist, count_edits, get_session_cookie,
+                       summarise)
+from .models import VisualCanvas, VisualCell
+
+REPLAY_USERNAME_PREFIX = 'replay-'
+
+EVENT_KINDS = ('assign', 'request', 'connect', 'message', 'disconnect')
+
+
+class ReplayError(Exception):
+    pass
+
+
+def read_capture(path: str) -> Tuple[Dict[str, dict], List[dict]]:
+    """Captured canvases by id, and events in the order they started."""
+    canvases: Dict[str, dict] = {}
+    events: List[dict] = []
+    with open(path) as capture_log:
+        for line in capture_log:
+            try:
+                event = loads(line)
+            except ValueError:
+                continue  # Blank, or cut short by a process stopping
+            if event['k'] == 'canvas':
+                canvases.setdefault(event['canvas'], event)
+            elif event['k'] in EVENT_KINDS:
+                events.append(event)
+    return canvases, sorted(events, key=lambda event: event['t'])
+
+
+def without_base_edit(data: dict) -> dict:
+    return {key: value for key, value in data.items() if key != 'base_edit'}
+
+
+class Replay:
+
+    """Stand-ins for captured canvases, users and cells, and results."""
+
+    def __init__(self, canvases: Dict[str, dict], application, origin: str,
+                 host: str, reply_timeout: float):
+        self.captured_canvases = canvases
+        self.application = application
+        self.origin = origin
+        self.host = host
+        self.reply_timeout = reply_timeout
+        self.buffered = bool(settings.VISUAL_EDIT_FLUSH_INTERVAL)
+        self.run = uuid4().hex[:8]
+        self.canvases: Dict[str, VisualCanvas] = {}
+        self.users: Dict[str, Any] = {}
+        self.clients: Dict[str, Client] = {}
+        self.cells: Dict[str, VisualCell] = {}
+        self.artists: Dict[str, SimulatedArtist] = {}
+        self.disconnected: List[SimulatedArtist] = []
+        self.latencies: DefaultDict[str, List[float]] = defaultdict(list)
+        self.captured: DefaultDict[str, List[float]] = defaultdict(list)
+        self.lags: List[float] = []
+        self.errors = 0
+        self.skipped = 0
+
+    def prepare(self, events: List[dict]):
+        """Create canvases, users and cells that weren't assigned."""
+        assigned = {event['cell'] for event in events
+                    if event['k'] == 'assign'}
+        for event in events:
+            if 'user' in event:
+                self.get_user(event['user'], event.get('superuser', False))
+            if 'canvas' in event:
+                self.get_canvas(event['canvas'])
+            if 'cell' in event and event['cell'] not in assigned:
+                self.get_cell(event)
+
+    def get_user(self, captured_id: str, superuser: bool = False):
+        user = self.users.get(captured_id)
+        if user is None:
+            user = self.users[captured_id] = get_user_model().objects.create(
+                username=f'{REPLAY_USERNAME_PREFIX}{self.run}-{captured_id}',
+                is_superuser=superuser)
+            client = self.clients[captured_id] = Client(
+                HTTP_HOST=self.host, SERVER_NAME=self.host.split(':')[0])
+            client.force_login(user)
+        return user
+
+    def get_canvas(self, captured_id: str) -> VisualCanvas:
+        canvas = self.canvases.get(captured_id)
+        if canvas is None:
+            try:
+                captured = self.captured_canvases[captured_id]
+            except KeyError:
+                raise ReplayError(f"Canvas {captured_id} is not captured")
+            now = timezone.now()
+            title = f'Replay {self.run} {len(self.canvases) + 1}'
+            canvas = self.canvases[captured_id] = VisualCanvas.objects.create(
+                title=title, slug=slugify(title),
+                creator=self.get_user(captured['creator']), start_time=now,
+                end_time=now + timedelta(days=1),
+                **{field: captured[field] for field in CANVAS_FIELDS})
+        return canvas
+
+    def get_cell(self, event: dict):
+        """The cell matching an event's, editable by the event's user."""
+        cell = self.cells.get(event['cell'])
+        if cell is None:
+            canvas = self.get_canvas(event['canvas'])
+            coordinates = event['x'], event['y']
+            cell = canvas.visual_cells.filter(
+                x_position=event['x'], y_position=event['y']).first() or (
+                    canvas.add_cells([coordinates])[0])
+            self.cells[event['cell']] = cell
+        user = self.users[event['user']]
+        if cell.artist_id is None and not cell.user_may_edit(user):
+            cell.artist = user
+            cell.save()
+        return cell
+
+    def assign(self, event: dict):
+        canvas = self.get_canvas(event['canvas'])
+        self.cells[event['cell']] = canvas.get_or_assign_cell(
+            self.users[event['user']])
+
+    def post(self, event: dict):
+        url = reverse(f"visual:{event['view']}",
+                      kwargs={'cell_id': self.get_cell(event).id})
+        return self.clients[event['user']].post(
+            url, without_base_edit(event['data']))
+
+    def record(self, event: dict, started: float):
+        self.latencies[event['k']].append(perf_counter() - started)
+        self.captured[event['k']].append(event['d'])
+
+    async def replay_assign(self, event: dict):
+        started = perf_counter()
+        await database_sync_to_async(self.assign)(event)
+        self.record(event, started)
+
+    async def replay_request(self, event: dict):
+        started = perf_counter()
+        response = await database_sync_to_async(self.post)(event)
+        self.record(event, started)
+        if response.status_code >= 400:
+            self.errors += 1
+
+    async def replay_connect(self, event: dict):
+        cell = await database_sync_to_async(self.get_cell)(event)
+        artist = SimulatedArtist(
+            self.application, cell,
+            get_session_cookie(self.clients[event['user']]), self.origin,
+            event['binary'], self.buffered)
+        started = perf_counter()
+        try:
+            await artist.connect()
+        except ConnectionError:
+            self.errors += 1
+            return
+        self.latencies['connect'].append(perf_counter() - started)
+        self.artists[event['conn']] = artist
+
+    async def replay_message(self, event: dict):
+        artist = self.artists.get(event['conn'])
+        if artist is None:
+            # Connected before capture started, or refused in the replay
+            self.skipped += 1
+            return
+        self.captured['message'].append(event['d'])
+        await artist.send(without_base_edit(event['message']))
+
+    async def replay_disconnect(self, event: dict):
+        artist = self.artists.pop(event['conn'], None)
+        if artist is not None:
+            await artist.wait_for_replies(self.reply_timeout)
+            await artist.disconnect()
+            self.disconnected.append(artist)
+
+    async def play(self, events: List[dict], started: float, speed: float):
+        """Replay events in order, each at its offset divided by speed."""
+        for event in events:
+            if speed:
+                delay = started + event['offset'] / speed - perf_counter()
+                if delay > 0:
+                    await sleep(delay)
+                self.lags.append(max(-delay, 0))
+            await getattr(self, f"replay_{event['k']}")(event)
+
+    async def disconnect_all(self):
+        """Disconnect connections still open when the capture ended."""
+        for conn in list(self.artists):
+            await self.replay_disconnect({'conn': conn})
+
+    def count_edits(self) -> int:
+        return sum(count_edits(canvas) for canvas in self.canvases.values())
+
+    def delete(self):
+        """Delete replay users, and with them canvases, cells and edits."""
+        get_user_model().objects.filter(
+            username__startswith=f'{REPLAY_USERNAME_PREFIX}{self.run}-'
+        ).delete()
+
+
+def get_actor(event: dict):
+    """Events of an actor are replayed in order: a connection or a user."""
+    return ('conn', event['conn']) if 'conn' in event else (
+        'user', event['user'])
+
+
+async def run_replay(canvases: Dict[str, dict], events: List[dict],
+                     application=None, speed: float = 1,
+                     origin: str = 'http://localhost', host: str = None,
+                     keep: bool = False, reply_timeout: float = 30) -> dict:
+    """
+    Replay captured events at speed times as fast and return statistics.
+
+    Requests are sent with host as their Host header, by default origin's,
+    so it must be in ALLOWED_HOSTS as when serving.
+    """
+    if application is None:
+        from . import routing
+        application = routing.application
+    if not events:
+        raise ReplayError("No events were captured")
+    replay = Replay(canvases, application, origin,
+                    host or urlsplit(origin).netloc, reply_timeout)
+    start = events[0]['t']
+    actors: DefaultDict[Tuple[str, str], List[dict]] = defaultdict(list)
+    for event in events:
+        actors[get_actor(event)].append(dict(event, offset=event['t'] - start))
+    try:
+        await database_sync_to_async(replay.prepare)(events)
+        edits_before = await database_sync_to_async(replay.count_edits)()
+        started = perf_counter()
+        await gather(*(replay.play(actor_events, started, speed)
+                       for actor_events in actors.values()))
+        await replay.disconnect_all()
+        duration = perf_counter() - started
+        await sleep(0.1)
+        edits = await database_sync_to_async(replay.count_edits)() - (
+            edits_before)
+    finally:
+        if not keep:
+            await database_sync_to_async(replay.delete)()
+    for artist in replay.disconnected:
+        replay.latencies['message'] += artist.ack_latencies
+        replay.errors += artist.errors
+    captured_duration = max(event['t'] + event['d']
+                            for event in events) - start
+    return {
+        'canvases': [str(canvas.id) for canvas in replay.canvases.values()],
+        'events': len(events),
+        'speed': speed,
+        'buffered': replay.buffered,
+        'captured_duration': captured_duration,
+        'duration': duration,
+        'events_per_second': len(events) / duration,
+        'captured_events_per_second': (len(events) / captured_duration
+                                       if captured_duration else 0),
+        'edits': edits,
+        'edits_per_second': edits / duration,
+        'errors': replay.errors,
+        'skipped': replay.skipped,
+        'lag': summarise(replay.lags),
+        'latency': {kind: summarise(latencies)
+                    for kind, latencies in sorted(replay.latencies.items())},
+        'captured': {kind: summarise(durations)
+                     for kind, durations in sorted(replay.captured.items())},
+    }
@@ -1,15 +1,23 @@
-from channels.auth import AuthMiddlewareStack
+from channels.http import AsgiHandler
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
-from django.urls import path
+from django.urls import path, re_path
 
-from .consumers import VisualCellEditConsumer
+from .consumers import VisualCanvasChangeFeedConsumer, VisualCellEditConsumer
+from .middleware import CachedAuthMiddlewareStack
 
 
 application = ProtocolTypeRouter({
-    # Empty for now (http->django views is added by default)
+    # Spectator feeds stream without sessions, all else goes to django views
+    'http': URLRouter(
+        [
+            path("visual/canvas/<uuid:canvas_id>/feed/",
+                 VisualCanvasChangeFeedConsumer),
+            re_path(r"", AsgiHandler),
+        ]
+    ),
     'websocket': AllowedHostsOriginValidator(
-        AuthMiddlewareStack(
+        CachedAuthMiddlewareStack(
             URLRouter(
                 [
                     path("canvas/cell/<uuid:cell_id>/edit/changes",
@@ -0,0 +1,215 @@
+"""
+Creating canvases, cells and edits with their side effects made explicit.
+
+Saving a grid VisualCanvas generates its cells, a new VisualCell gets a
+first edit and a new VisualCellEdit (not itself merged from a neighbour) is
+dispatched to its neighbours' shared edges. The post_save receivers in
+signals only pass new instances to canvas_created, cell_created and
+edit_created here, so ordinary saves behave as they always have.
+
+Bulk imports and data migrations can instead save inside
+
+    with defer_side_effects():
+        ...
+
+to collect those side effects and run them in batches once the outermost
+block exits: grids and first edits are each one insert, and every edited
+cell dispatches its net change to its neighbours once rather than per
+edit. With until_commit=True they wait for the transaction to commit (see
+transaction.on_commit), so propagation doesn't hold an import's
+transaction open. bulk_create sends no signals, so create_cells and
+create_edits bulk insert and then record the side effects themselves.
+
+copy_edits goes further for generated datasets (see workload), loading
+edits already numbered and propagated with COPY and no side effects.
+
+Todo:
+    * Record assignments here too, rather than in views.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+from io import StringIO
+from itertools import islice
+from threading import local
+from typing import Dict, Iterable, List
+from uuid import UUID
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import VisualCanvas, VisualCell, VisualCellEdit
+
+_local = local()
+
+
+class SideEffects:
+
+    """Side effects of saves collected by defer_side_effects."""
+
+    def __init__(self):
+        self.canvases: List[VisualCanvas] = []
+        self.cells: List[VisualCell] = []
+        # Each edited cell's first edit, to dispatch the net change from
+        # the edit before it
+        self.first_edits: Dict[str, VisualCellEdit] = {}
+
+    def run(self):
+        """Generate grids, then first edits, then dispatch edited cells."""
+        for canvas in self.canvases:
+            canvas.generate_grid()
+        edited_cell_ids = set(VisualCellEdit.objects.filter(
+            cell__in=self.cells).values_list('cell_id', flat=True))
+        # Cells saved with edits of their own start from those instead
+        VisualCell.initialize_edits([cell for cell in self.cells
+                                     if cell.id not in edited_cell_ids])
+        for edit in self.first_edits.values():
+            edit.cell.dispatch_neighbour_edits(
+                previous_edit=edit.get_previous_valid_edit())
+
+
+def get_deferred_side_effects() -> SideEffects:
+    return getattr(_local, 'side_effects', None)
+
+
+@contextmanager
+def defer_side_effects(until_commit: bool = False):
+    """Collect side effects of saves and run them batched on exit."""
+    if get_deferred_side_effects() is not None:
+        # Nested blocks join the outermost
+        yield get_deferred_side_effects()
+        return
+    side_effects = _local.side_effects = SideEffects()
+    try:
+        yield side_effects
+    finally:
+        _local.side_effects = None
+    if until_commit:
+        transaction.on_commit(side_effects.run)
+    else:
+        side_effects.run()
+
+
+def canvas_created(canvas: VisualCanvas):
+    """Generate the cells of a new grid canvas."""
+    if not (canvas.grid_width or canvas.grid_height):
+        return
+    side_effects = get_deferred_side_effects()
+    if side_effects is not None:
+        side_effects.canvases.append(canvas)
+    else:
+        canvas.generate_grid()
+
+
+def cell_created(cell: VisualCell):
+    """Save a new cell's first edit."""
+    side_effects = get_deferred_side_effects()
+    if side_effects is not None:
+        side_effects.cells.append(cell)
+    else:
+        VisualCell.initialize_edits([cell])
+
+
+def edit_created(edit: VisualCellEdit):
+    """
+    Dispatch a new edit's shared edge changes to neighbouring cells.
+
+    Edits dispatched from a neighbour are not passed on again, otherwise
+    each shared edge change would bounce back to its source.
+    """
+    if edit.neighbour_edit is not None:
+        return
+    side_effects = get_deferred_side_effects()
+    if side_effects is not None:
+        side_effects.first_edits.setdefault(edit.cell_id, edit)
+    else:
+        edit.cell.dispatch_neighbour_edits()
+
+
+def create_canvas(**fields) -> VisualCanvas:
+    """Create a canvas, generating any grid in bulk."""
+    return VisualCanvas.objects.create(**fields)
+
+
+def create_cells(cells: Iterable[VisualCell]) -> List[VisualCell]:
+    """Bulk create cells, then their first edits."""
+    created = VisualCell.objects.bulk_create(cells)
+    side_effects = get_deferred_side_effects()
+    if side_effects is not None:
+        side_effects.cells.extend(created)
+    else:
+        VisualCell.initialize_edits(created)
+    return created
+
+
+def create_edits(edits: Iterable[VisualCellEdit]) -> List[VisualCellEdit]:
+    """
+    Bulk create edits in order, one commit and one dispatch per cell.
+
+    See VisualCell.commit_edits, which raises ConcurrentEditException if a
+    cell was edited since it was loaded.
+    """
+    edits_by_cell: Dict[UUID, List[VisualCellEdit]] = {}
+    for edit in edits:
+        edits_by_cell.setdefault(edit.cell_id, []).append(edit)
+    created: List[VisualCellEdit] = []
+    with defer_side_effects():
+        for cell_edits in edits_by_cell.values():
+            cell = cell_edits[0].cell
+            created += cell.commit_edits(cell_edits,
+                                         dispatch_neighbours=False)
+            for edit in cell_edits:
+                edit_created(edit)
+    return created
+
+
+COPY_BATCH_SIZE = 10000
+
+
+def get_copy_value(value) -> str:
+    """A value in COPY's text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, list):
+        # Only arrays of numbers are copied, formatted quicker this way
+        return '{' + repr(value)[1:-1].replace(' ', '') + '}'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def copy_edits(edits: Iterable[VisualCellEdit],
+               batch_size: int = COPY_BATCH_SIZE) -> int:
+    """
+    Load edits with COPY in batches, returning how many were loaded.
+
+    Edits are written exactly as given, so need their sequence,
+    edge_sequences and _order: nothing is reserved, dispatched or sent, and
+    ids aren't set. Edits without a timestamp are timestamped now.
+    """
+    fields = [field for field in VisualCellEdit._meta.concrete_fields
+              if not field.primary_key]
+    quote_name = connection.ops.quote_name
+    columns = ', '.join(quote_name(field.column) for field in fields)
+    sql = (f'COPY {quote_name(VisualCellEdit._meta.db_table)} ({columns}) '
+           'FROM STDIN')
+    now = timezone.now()
+    edits = iter(edits)
+    count = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        while True:
+            batch = list(islice(edits, batch_size))
+            if not batch:
+                return count
+            rows = StringIO()
+            for edit in batch:
+                if edit.timestamp is None:
+                    edit.timestamp = now
+                rows.write('\t'.join(
+                    get_copy_value(getattr(edit, field.attname))
+                    for field in fields) + '\n')
+            rows.seek(0)
+            cursor.copy_expert(sql, rows)
+            count += len(batch)
@@ -1,41 +1,91 @@
-from django.db.models.signals import post_save
+from typing import List, Optional
+
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_out
+from django.db.models import DEFERRED
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 
+from . import services
+from .instrumentation import timed
+from .middleware import (invalidate_assigned_cells, invalidate_auth_hash,
+                         invalidate_session, update_auth_hash)
 from .models import VisualCanvas, VisualCell, VisualCellEdit
+from .tracing import span
 
 
 @receiver(post_save, sender=VisualCanvas)
-def initialize_canvas(sender, **kwargs):
-    """
-    Initiate VisualCells if canvas grid_width or grid_height are set > 0.
-    """
-    if kwargs['created'] and (kwargs['instance'].grid_width or
-                              kwargs['instance'].grid_height):
-        kwargs['instance'].generate_grid()
+@timed('signals')
+def initialize_canvas(sender, instance, created, raw=False, **kwargs):
+    """Initiate VisualCells if canvas grid_width or grid_height are > 0."""
+    if created and not raw:
+        services.canvas_created(instance)
 
 
 @receiver(post_save, sender=VisualCell)
-def initialize_and_manage_cell_edits(sender, **kwargs):
-    """Initiate a blank VisualCellEdit when creating a VisualCell."""
-    if kwargs['created']:
-        cell = kwargs['instance']
-        if cell.is_editable and cell.canvas.new_cells_allowed:
-            edges = cell.get_blank_with_neighbour_edges()
-            # Note: we do not assign an artist to the intial design because
-            # it is autogenerated, not the artist's creative choice
-            cell.edits.create(**edges)
-        else:
-            cell.set_blank()
+@timed('signals')
+def initialize_and_manage_cell_edits(sender, instance, created, raw=False,
+                                     **kwargs):
+    """Initiate a first VisualCellEdit when creating a VisualCell."""
+    if created and not raw:
+        services.cell_created(instance)
 
 
 @receiver(post_save, sender=VisualCellEdit)
-def apply_edge_changes_to_neighbours(sender, **kwargs):
+@timed('signals')
+@span('post_save')
+def apply_edge_changes_to_neighbours(sender, instance, created, raw=False,
+                                     **kwargs):
+    """Dispatch overlapping edge edits to adjacent VisualCells."""
+    if created and not raw:
+        services.edit_created(instance)
+
+
+@receiver(user_logged_out)
+def invalidate_cached_session(sender, request=None, **kwargs):
+    """Stop websockets authenticating with a logged out session."""
+    if request is not None and request.session.session_key:
+        invalidate_session(request.session.session_key)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def update_cached_auth_hash(sender, instance, raw=False, **kwargs):
+    """Stop websockets authenticating with sessions a password change ended."""
+    if not raw:
+        update_auth_hash(instance)
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_deleted_user(sender, instance, **kwargs):
+    invalidate_auth_hash(instance.id)
+
+
+@receiver(pre_save, sender=VisualCell)
+def invalidate_cached_cells(sender, instance, raw=False, **kwargs):
     """
-    Dispatch overlapping edge edits to adjacent VisualCells.
+    Drop cached assigned cells of a cell's current and new artist.
 
-    Todo:
-        * Consider allowing automated edits to neighbours as well
+    The previous artist is only looked up if the cell wasn't loaded with
+    one, so saves not reassigning a loaded cell need no query.
     """
-    if kwargs['created']:
-        cell_edit = kwargs['instance']
-        cell_edit.cell.dispatch_neighbour_edits()
+    if raw:
+        return
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None and 'artist' not in update_fields:
+        invalidate_assigned_cells(instance.artist_id)
+        return
+    loaded_artist_id = getattr(instance, 'loaded_artist_id', DEFERRED)
+    if instance._state.adding:
+        previous_artist_ids: List[Optional[int]] = []
+    elif loaded_artist_id is not DEFERRED:
+        previous_artist_ids = [loaded_artist_id]
+    else:
+        previous_artist_ids = list(VisualCell.objects.filter(
+            pk=instance.pk).values_list('artist_id', flat=True))
+    invalidate_assigned_cells(instance.artist_id, *previous_artist_ids)
+    instance.loaded_artist_id = instance.artist_id
+
+
+@receiver(post_delete, sender=VisualCell)
+def invalidate_deleted_cell(sender, instance, **kwargs):
+    invalidate_assigned_cells(instance.artist_id)
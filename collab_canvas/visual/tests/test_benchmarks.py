@@ -0,0 +1,33 @@
+from ..benchmarks import (benchmark_grid, benchmark_history, compare_results,
+                          run_benchmarks)
+from ..models import VisualCanvas
+from .utils import BaseVisualTest
+
+
+class TestBenchmarks(BaseVisualTest):
+
+    """Test benchmarks measure each hot path and leave nothing behind."""
+
+    def test_grid_benchmarks(self):
+        results = benchmark_grid(3, repeat=2)
+        self.assertEqual([row['benchmark'] for row in results],
+                         ['grid_generation', 'cell_assignment', 'edit_save',
+                          'snapshot'])
+        self.assertTrue(all(row['queries'] > 0 for row in results))
+        self.assertFalse(VisualCanvas.objects.exists())
+
+    def test_history_benchmarks(self):
+        results = benchmark_history(5, repeat=1, grid_size=3)
+        self.assertEqual({row['depth'] for row in results}, {5})
+        self.assertTrue(all(row['queries'] > 0 for row in results))
+        self.assertFalse(VisualCanvas.objects.exists())
+
+    def test_compare_results(self):
+        previous = run_benchmarks([3], [2], repeat=1)
+        current = {**previous, 'results': [
+            {**row, 'seconds': row['seconds'] * 2}
+            for row in previous['results']]}
+        comparison = compare_results(previous, current)
+        self.assertEqual(len(comparison), len(previous['results']))
+        self.assertTrue(all(round(row['ratio'], 6) == 2
+                            for row in comparison))
@@ -0,0 +1,176 @@
+from json import dumps
+
+from django.db.models import Count
+from django.urls import reverse
+
+from ..benchmarks import get_boundary_patch
+from ..budgets import BUDGETS, Budget, BudgetExceeded, check_budget
+from ..models import VisualCanvas, VisualCell, VisualCellEdit
+from ..workload import generate_workload
+from .utils import BaseVisualTest, UserFactory
+
+GRID_SIZE = 16
+
+# Edits drawn per artist on average, a few artists drawing most
+EDITS_PER_ARTIST = 20
+
+
+def get_flipped_boundary_patches(cell, count: int = 1):
+    """
+    Patches flipping the first position of every shared edge segment and
+    back, ending flipped so every neighbour is dispatched to.
+    """
+    edges = cell.latest_valid_edit.get_edges()
+    flipped = [(edge_name, index, 1 - edges[edge_name][index])
+               for edge_name, index, _ in get_boundary_patch(cell, 0)]
+    unflipped = [(edge_name, index, edges[edge_name][index])
+                 for edge_name, index, _ in flipped]
+    return [flipped if number % 2 else unflipped
+            for number in range(count, 0, -1)]
+
+
+class TestCheckBudget(BaseVisualTest):
+
+    """Test blocks over budget fail with the queries they ran."""
+
+    def test_over_budget(self):
+        with check_budget('test', Budget(1)):
+            VisualCanvas.objects.count()
+        with self.assertRaises(BudgetExceeded) as error:
+            with check_budget('test', Budget(1)):
+                VisualCanvas.objects.count()
+                VisualCell.objects.count()
+        self.assertIn('test ran 2 queries', str(error.exception))
+        self.assertIn('visual_visualcell', str(error.exception))
+
+    def test_seconds(self):
+        with self.settings(VISUAL_BUDGET_SECONDS_SCALE=1):
+            with self.assertRaises(BudgetExceeded):
+                with check_budget('test', Budget(0, seconds=0)):
+                    pass
+        with self.settings(VISUAL_BUDGET_SECONDS_SCALE=0):
+            with check_budget('test', Budget(0, seconds=0)):
+                pass
+
+
+class TestBudgets16x16DeepHistory(BaseVisualTest):
+
+    """
+    Test views and operations keep to BUDGETS on a 16x16 grid.
+
+    Nearly every cell has an artist, and a few artists have drawn most of
+    the canvas' thousands of edits, so cells have deep histories.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        results = generate_workload(
+            'grid', artists=GRID_SIZE**2 - 6, edits=EDITS_PER_ARTIST,
+            grid_size=GRID_SIZE, activity='pareto', seed=16)
+        cls.canvas = VisualCanvas.objects.select_related('creator').get(
+            id=results['canvas'])
+        # The artist of the cell with the deepest history
+        cls.cell = VisualCell.objects.select_related('artist').get(
+            id=VisualCellEdit.objects.filter(
+                cell__canvas=cls.canvas, cell__artist__isnull=False
+            ).values('cell_id').annotate(
+                edits=Count('id')).order_by('-edits')[0]['cell_id'])
+        cls.depth = cls.cell.edits.count()
+
+    def setUp(self):
+        super().setUp()
+        self.assertGreater(self.depth, 100)
+        self.new_user = UserFactory()
+
+    def assertWithinBudget(self, name: str):
+        self.assertIn(name, BUDGETS)
+        return check_budget(name)
+
+    def get(self, user, name: str, data: dict = None, **kwargs):
+        self.client.force_login(user)
+        with self.assertWithinBudget(name):
+            return self.client.get(reverse(f'visual:{name}', kwargs=kwargs),
+                                   data)
+
+    def post(self, user, name: str, data: dict):
+        self.client.force_login(user)
+        with self.assertWithinBudget(name):
+            return self.client.post(
+                reverse(f'visual:{name}', kwargs={'cell_id': self.cell.id}),
+                data)
+
+    def test_canvas_views(self):
+        creator, artist = self.canvas.creator, self.cell.artist
+        canvas_id = self.canvas.id
+        response = self.get(creator, 'canvas', canvas_id=canvas_id)
+        self.assertEqual(response.status_code, 200)
+        response = self.get(self.new_user, 'canvas', canvas_id=canvas_id)
+        self.assertEqual(response.status_code, 302)
+        response = self.get(artist, 'canvas-changes', {'after': 0},
+                            canvas_id=canvas_id)
+        self.assertTrue(response.json()['snapshot'])
+        response = self.get(artist, 'canvas-changes',
+                            {'after': self.canvas.sequence - 20},
+                            canvas_id=canvas_id)
+        self.assertFalse(response.json()['snapshot'])
+        response = self.get(artist, 'canvas-presence', canvas_id=canvas_id)
+        self.assertEqual(response.status_code, 200)
+
+    def test_cell_views(self):
+        creator, artist = self.canvas.creator, self.cell.artist
+        cell_id = self.cell.id
+        response = self.get(creator, 'cell', cell_id=cell_id)
+        self.assertEqual(response.status_code, 200)
+        response = self.get(creator, 'cell-history', cell_id=cell_id,
+                            cell_history=self.depth - 1)
+        self.assertEqual(response.status_code, 200)
+        response = self.get(creator, 'cell-valid-edit', cell_id=cell_id,
+                            edit_number=self.depth - 1)
+        self.assertEqual(response.status_code, 200)
+        response = self.get(artist, 'cell-edit', cell_id=cell_id)
+        self.assertEqual(response.status_code, 200)
+        response = self.get(artist, 'cell-edit-success', cell_id=cell_id)
+        self.assertEqual(response.status_code, 200)
+
+    def test_edit_views(self):
+        artist = self.cell.artist
+        patch, = get_flipped_boundary_patches(self.cell)
+        response = self.post(artist, 'cell-edit-patch',
+                             {'patch': dumps(patch)})
+        self.assertEqual(response.status_code, 201)
+        response = self.post(artist, 'cell-edit-batch', {
+            'edits': dumps(get_flipped_boundary_patches(self.cell, 11))})
+        self.assertEqual(response.status_code, 201)
+
+    def test_instrumentation_view(self):
+        staff = UserFactory(is_staff=True)
+        response = self.get(staff, 'instrumentation')
+        self.assertEqual(response.status_code, 200)
+
+    def test_operations(self):
+        cell, canvas = self.cell, self.canvas
+        with self.assertWithinBudget('cell_assignment'):
+            canvas.get_or_assign_cell(self.new_user)
+        patch, = get_flipped_boundary_patches(cell)
+        with self.assertWithinBudget('edit_save'):
+            cell.apply_edit_patch(patch)
+        patches = get_flipped_boundary_patches(cell, 11)
+        with self.assertWithinBudget('edit_batch'):
+            cell.apply_edit_patches(patches)
+        with self.assertWithinBudget('snapshot'):
+            canvas.get_changes_since(0)
+        with self.assertWithinBudget('catch_up'):
+            canvas.get_changes_since(canvas.sequence - 20)
+        with self.assertWithinBudget('neighbours'):
+            cell.get_neighbours()
+        with self.assertWithinBudget('history_latest_valid_edit'):
+            edit = cell.latest_valid_edit
+        depth = cell.edits.count()
+        edit = VisualCellEdit.objects.get(pk=edit.pk)
+        with self.assertWithinBudget('history_number'):
+            self.assertEqual(edit.history_number, depth - 1)
+        edit = VisualCellEdit.objects.get(pk=edit.pk)
+        with self.assertWithinBudget('history_edit_number'):
+            edit.edit_number
+        with self.assertWithinBudget('history_previous_valid_edit'):
+            self.assertIsNotNone(edit.get_previous_valid_edit())
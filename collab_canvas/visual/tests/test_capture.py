@@ -0,0 +1,173 @@
+from json import dumps, loads
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, override_settings
+from django.urls import path, reverse
+
+from ..capture import flush_events
+from ..consumers import VisualCellEditConsumer
+from ..middleware import CachedAuthMiddlewareStack
+from ..models import VisualCanvas
+from ..presence import get_presence
+from ..replay import read_capture, run_replay
+
+from .utils import (BaseTransactionVisualTest, BaseVisualTest, CanvasFactory,
+                    UserFactory)
+
+
+application = CachedAuthMiddlewareStack(URLRouter([
+    path("canvas/cell/<uuid:cell_id>/edit/changes", VisualCellEditConsumer),
+]))
+
+
+class CaptureLogMixin(SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        capture_dir = mkdtemp()
+        self.addCleanup(rmtree, capture_dir)
+        self.capture_log = join(capture_dir, 'capture.log')
+        settings_override = override_settings(
+            VISUAL_CAPTURE_LOG=self.capture_log)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def read_events(self):
+        flush_events()
+        with open(self.capture_log) as capture_log:
+            return [loads(line) for line in capture_log]
+
+
+class TestCapture(CaptureLogMixin, BaseVisualTest):
+
+    """Test assignments and edit requests are captured when enabled."""
+
+    def setUp(self):
+        super().setUp()
+        self.canvas = CanvasFactory()
+        self.artist = UserFactory()
+        self.client.force_login(self.artist)
+
+    def test_assignment_and_patch(self):
+        self.client.get(self.canvas.get_absolute_url())
+        cell = self.canvas.visual_cells.get(artist=self.artist)
+        self.client.post(reverse('visual:cell-edit-patch',
+                                 kwargs={'cell_id': cell.id}),
+                         {'patch': dumps([['edges_vertical', 4, 1]])})
+        canvas, assign, request = self.read_events()
+        self.assertEqual(canvas['k'], 'canvas')
+        self.assertEqual(canvas['grid_width'], self.canvas.grid_width)
+        self.assertEqual(canvas['creator'], str(self.canvas.creator_id))
+        self.assertEqual(assign['k'], 'assign')
+        self.assertEqual((assign['cell'], assign['x'], assign['y'],
+                          assign['user']),
+                         (str(cell.id), cell.x_position, cell.y_position,
+                          str(self.artist.id)))
+        self.assertEqual(request['k'], 'request')
+        self.assertEqual(request['view'], 'cell-edit-patch')
+        self.assertEqual(request['status'], 201)
+        self.assertEqual(request['data'],
+                         {'patch': '[["edges_vertical", 4, 1]]'})
+        self.assertLessEqual(assign['t'], request['t'])
+        self.assertGreater(request['d'], 0)
+
+    def test_disabled(self):
+        with override_settings(VISUAL_CAPTURE_LOG=''):
+            self.client.get(self.canvas.get_absolute_url())
+        self.assertFalse(exists(self.capture_log))
+
+    def test_read_capture(self):
+        self.client.get(self.canvas.get_absolute_url())
+        flush_events()
+        with open(self.capture_log, 'a') as capture_log:
+            capture_log.write('{"k":"assign","t":')
+        canvases, events = read_capture(self.capture_log)
+        self.assertEqual(list(canvases), [str(self.canvas.id)])
+        self.assertEqual([event['k'] for event in events], ['assign'])
+
+
+class TestReplay(CaptureLogMixin, BaseTransactionVisualTest):
+
+    """Test a captured session is replayed on new canvases and measured."""
+
+    def setUp(self):
+        super().setUp()
+        self.canvas = CanvasFactory()
+        self.artist = UserFactory()
+        self.client.force_login(self.artist)
+        self.client.get(self.canvas.get_absolute_url())
+        self.cell = self.canvas.visual_cells.get(artist=self.artist)
+        self.client.post(reverse('visual:cell-edit-patch',
+                                 kwargs={'cell_id': self.cell.id}),
+                         {'patch': dumps([['edges_vertical', 4, 1]]),
+                          'base_edit': 1})
+        self.cookie = (
+            f'{settings.SESSION_COOKIE_NAME}='
+            f'{self.client.cookies[settings.SESSION_COOKIE_NAME].value}')
+
+    def tearDown(self):
+        async_to_sync(get_channel_layer().flush)()
+        get_presence().hashes.clear()
+
+    @override_settings(VISUAL_EDIT_FLUSH_INTERVAL=0)
+    @async_to_sync
+    async def capture_websocket(self):
+        communicator = WebsocketCommunicator(
+            application, f"/canvas/cell/{self.cell.id}/edit/changes",
+            headers=[(b'cookie', self.cookie.encode())])
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.send_json_to({'type': 'patch',
+                                         'patch': [['edges_vertical', 4, 0]]})
+        self.assertEqual((await communicator.receive_json_from())['type'],
+                         'ack')
+        await communicator.disconnect()
+
+    def test_replay(self):
+        self.capture_websocket()
+        flush_events()
+        canvases, events = read_capture(self.capture_log)
+        self.assertEqual(
+            [event['k'] for event in events],
+            ['assign', 'request', 'connect', 'message', 'disconnect'])
+        # Served hosts rather than the test environment's testserver
+        with override_settings(VISUAL_CAPTURE_LOG='',
+                               VISUAL_EDIT_FLUSH_INTERVAL=0,
+                               ALLOWED_HOSTS=['localhost']):
+            results = async_to_sync(run_replay)(
+                canvases, events, application, speed=0)
+        self.assertEqual(results['events'], 5)
+        self.assertEqual(results['errors'], 0)
+        self.assertEqual(results['skipped'], 0)
+        self.assertGreaterEqual(results['edits'], 2)
+        for kind in ('assign', 'request', 'message'):
+            self.assertEqual(results['latency'][kind]['count'], 1)
+            self.assertEqual(results['captured'][kind]['count'], 1)
+        self.assertEqual(results['latency']['connect']['count'], 1)
+        flush_events()
+        self.assertEqual(len(read_capture(self.capture_log)[1]), 5)
+        self.assertFalse(VisualCanvas.objects.filter(
+            id__in=results['canvases']).exists())
+        self.assertFalse(get_user_model().objects.filter(
+            username__startswith='replay-').exists())
+
+    def test_replay_host(self):
+        """Requests are sent with the given Host header."""
+        self.capture_websocket()
+        flush_events()
+        canvases, events = read_capture(self.capture_log)
+        for host, errors in (('replay.example.com', 0), ('example.com', 1)):
+            with self.subTest(host=host), override_settings(
+                    VISUAL_CAPTURE_LOG='', VISUAL_EDIT_FLUSH_INTERVAL=0,
+                    ALLOWED_HOSTS=['replay.example.com']):
+                results = async_to_sync(run_replay)(
+                    canvases, events, application, speed=0, host=host)
+                self.assertEqual(results['errors'], errors)
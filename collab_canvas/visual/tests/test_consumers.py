@@ -0,0 +1,426 @@
+import json
+from asyncio import Queue, sleep
+from typing import Dict, Tuple
+from unittest.mock import MagicMock, patch
+from uuid import uuid4
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import ApplicationCommunicator, WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.test import override_settings
+from django.urls import path
+
+from ..consumers import (CanvasChangeFanOut, VisualCanvasChangeFeedConsumer,
+                         VisualCellEditConsumer)
+from ..models import VisualCanvas, VisualCell
+from ..presence import get_presence
+from ..protocol import BINARY_SUBPROTOCOL, decode_frame, encode_frame
+from .utils import BaseTransactionVisualTest, CanvasFactory, UserFactory
+
+
+application = URLRouter([
+    path("canvas/cell/<uuid:cell_id>/edit/changes", VisualCellEditConsumer),
+])
+
+feed_application = URLRouter([
+    path("visual/canvas/<uuid:canvas_id>/feed/",
+         VisualCanvasChangeFeedConsumer),
+])
+
+
+class BaseConsumer2x2GridTest(BaseTransactionVisualTest):
+
+    """Base class connecting artists of a 2x2 grid over websockets."""
+
+    def setUp(self):
+        """Assign an artist to each cell of a 2x2 grid."""
+        super().setUp()
+        self.canvas = CanvasFactory()
+        self.cells: Dict[Tuple[int, int], VisualCell] = {}
+        for cell in self.canvas.visual_cells.all():
+            cell.artist = UserFactory()
+            cell.save()
+            self.cells[cell.coordinates] = cell
+
+    def tearDown(self):
+        """Clear groups from the in memory channel layer and presence."""
+        async_to_sync(get_channel_layer().flush)()
+        get_presence().hashes.clear()
+
+    def get_communicator(self, cell, user=None, subprotocols=None):
+        communicator = WebsocketCommunicator(
+            application, f"/canvas/cell/{cell.id}/edit/changes",
+            subprotocols=subprotocols)
+        communicator.scope['user'] = user or cell.artist
+        return communicator
+
+
+@override_settings(VISUAL_EDIT_FLUSH_INTERVAL=0)
+class TestVisualCellEditConsumer2x2Grid(BaseConsumer2x2GridTest):
+
+    """Test edits sent over websockets reach only adjacent neighbours."""
+
+    @async_to_sync
+    async def test_edit_sent_to_shared_edge_only(self):
+        """Only the north neighbour gets the changed segment of its edge."""
+        communicators = {coordinates: self.get_communicator(cell)
+                         for coordinates, cell in self.cells.items()}
+        for communicator in communicators.values():
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+        editor = communicators[(0, 0)]
+        await editor.send_json_to({'type': 'patch',
+                                   'patch': [['edges_horizontal', 0, 1]]})
+        response = await editor.receive_json_from()
+        self.assertEqual(response['type'], 'ack')
+        change = await communicators[(0, 1)].receive_json_from()
+        self.assertEqual(change, {'type': 'edge',
+                                  'cell': str(self.cells[(0, 0)].id),
+                                  'edit': response['edit'],
+                                  'sequence': response['sequence'],
+                                  'direction': 'south',
+                                  'edge_name': 'edges_horizontal',
+                                  'portion': -3,
+                                  'values': [1, 0, 0]})
+        for coordinates in ((0, 0), (1, 0), (1, 1)):
+            self.assertTrue(await communicators[coordinates].receive_nothing())
+        for communicator in communicators.values():
+            await communicator.disconnect()
+
+    @async_to_sync
+    async def test_presence_and_absent_neighbours_skipped(self):
+        """Connections join presence and edits skip unconnected cells."""
+        editor = self.get_communicator(self.cells[(0, 0)])
+        await editor.connect()
+        presence = get_presence()
+        self.assertEqual(presence.get_present_cells(
+            [cell.id for cell in self.cells.values()]),
+            {str(self.cells[(0, 0)].id)})
+        group_send = MagicMock()
+
+        async def record_group_send(*args, **kwargs):
+            group_send(*args, **kwargs)
+
+        with patch.object(get_channel_layer(), 'group_send',
+                          side_effect=record_group_send):
+            await editor.send_json_to({'type': 'patch',
+                                       'patch': [['edges_horizontal', 0, 1]]})
+            self.assertEqual((await editor.receive_json_from())['type'],
+                             'ack')
+        self.assertNotIn('edge.change', [call[0][1]['type'] for call in
+                                         group_send.call_args_list])
+        await editor.disconnect()
+        self.assertEqual(presence.get_canvas_presence(self.canvas.id), [])
+
+    @async_to_sync
+    async def test_invalid_patch_errors(self):
+        """Invalid patches are rejected without saving an edit."""
+        communicator = self.get_communicator(self.cells[(0, 0)])
+        await communicator.connect()
+        await communicator.send_json_to({'type': 'patch',
+                                         'patch': [['edges_horizontal', 99, 1]]})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['type'], 'error')
+        await communicator.send_json_to({'type': 'patch', 'patch': []})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['type'], 'error')
+        await communicator.disconnect()
+
+    @override_settings(VISUAL_STROKE_RATE=0.001, VISUAL_STROKE_BURST=1)
+    @async_to_sync
+    async def test_stroke_rate_limited(self):
+        """Patches beyond the stroke rate are refused for a retry."""
+        communicator = self.get_communicator(self.cells[(0, 0)])
+        await communicator.connect()
+        for index, reply_type in ((0, 'ack'), (1, 'error')):
+            await communicator.send_json_to(
+                {'type': 'patch', 'patch': [['edges_horizontal', index, 1]]})
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['type'], reply_type)
+        self.assertTrue(response['retry'])
+        await communicator.disconnect()
+
+    @async_to_sync
+    async def test_other_user_rejected(self):
+        """Users who may not edit the cell can't connect."""
+        cell = self.cells[(0, 0)]
+        for user in (self.cells[(1, 1)].artist, AnonymousUser()):
+            connected, _ = await self.get_communicator(cell, user).connect()
+            self.assertFalse(connected)
+
+    @async_to_sync
+    async def test_binary_frames(self):
+        """Binary clients get packed acks, edge changes and snapshots."""
+        editor = self.get_communicator(self.cells[(0, 0)],
+                                       subprotocols=[BINARY_SUBPROTOCOL])
+        neighbour = self.get_communicator(self.cells[(1, 0)],
+                                          subprotocols=[BINARY_SUBPROTOCOL])
+        for communicator in (editor, neighbour):
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertEqual(subprotocol, BINARY_SUBPROTOCOL)
+        await editor.send_to(bytes_data=encode_frame(
+            {'type': 'patch', 'patch': [['edges_vertical', 11, 1]],
+             'idempotency_key': 'stroke-1'}))
+        ack = decode_frame(await editor.receive_from())
+        self.assertEqual(ack['type'], 'ack')
+        change = decode_frame(await neighbour.receive_from())
+        self.assertEqual((change['edit'], change['direction'],
+                          change['values']), (ack['edit'], 'west', [0, 0, 1]))
+        await editor.send_to(bytes_data=encode_frame({'type':
+                                                      'get_snapshot'}))
+        snapshot = decode_frame(await editor.receive_from())
+        self.assertEqual(snapshot['edit'], ack['edit'])
+        self.assertEqual(snapshot['edges']['edges_vertical'][-1], 1)
+        await editor.send_to(bytes_data=b'\x00')
+        self.assertEqual(decode_frame(await editor.receive_from())['type'],
+                         'error')
+        for communicator in (editor, neighbour):
+            await communicator.disconnect()
+
+
+@override_settings(VISUAL_EDIT_FLUSH_INTERVAL=60,
+                   VISUAL_EDIT_BUFFER_MAX_CHANGES=4)
+class TestBufferedVisualCellEditConsumer2x2Grid(BaseConsumer2x2GridTest):
+
+    """Test live edits are sent at once and saved in bulk later."""
+
+    @async_to_sync
+    async def test_buffered_until_disconnect(self):
+        """Strokes reach neighbours at once and are saved as one edit."""
+        cell, north = self.cells[(0, 0)], self.cells[(0, 1)]
+        editor = self.get_communicator(cell)
+        neighbour = self.get_communicator(north)
+        for communicator in (editor, neighbour):
+            await communicator.connect()
+        edit_count = await database_sync_to_async(cell.edits.count)()
+        for stroke in ([['edges_horizontal', 0, 1]],
+                       [['edges_horizontal', 1, 1]],
+                       [['edges_horizontal', 0, 0]]):
+            await editor.send_json_to({'type': 'patch', 'patch': stroke})
+            self.assertEqual(await editor.receive_json_from(),
+                             {'type': 'ack', 'edit': None,
+                              'sequence': None})
+        changes = [(await neighbour.receive_json_from())['values']
+                   for _ in range(3)]
+        self.assertEqual(changes, [[1, 0, 0], [1, 1, 0], [0, 1, 0]])
+        await editor.send_json_to({'type': 'get_snapshot'})
+        snapshot = await editor.receive_json_from()
+        self.assertEqual(snapshot['edges']['edges_horizontal'][:3],
+                         [0, 1, 0])
+        self.assertEqual(
+            await database_sync_to_async(cell.edits.count)(), edit_count)
+        await editor.disconnect()
+        self.assertEqual(
+            await database_sync_to_async(cell.edits.count)(), edit_count + 1)
+        latest_edit = await database_sync_to_async(
+            lambda: cell.latest_valid_edit)()
+        self.assertEqual(latest_edit.edges_horizontal[:3], [0, 1, 0])
+        self.assertEqual(latest_edit.artist_id, cell.artist_id)
+        await neighbour.disconnect()
+
+    @async_to_sync
+    async def test_strokes_sent_to_neighbours_once(self):
+        """Saving buffered strokes doesn't send them to neighbours again."""
+        cell, north = self.cells[(0, 0)], self.cells[(0, 1)]
+        editor = self.get_communicator(cell)
+        neighbour = self.get_communicator(north)
+        for communicator in (editor, neighbour):
+            await communicator.connect()
+        # The fourth change reaches VISUAL_EDIT_BUFFER_MAX_CHANGES
+        for stroke in ([['edges_horizontal', 0, 1]],
+                       [['edges_horizontal', 1, 1]],
+                       [['edges_horizontal', 2, 1]],
+                       [['edges_south_east', 0, 1]]):
+            await editor.send_json_to({'type': 'patch', 'patch': stroke})
+            self.assertIsNone((await editor.receive_json_from())['edit'])
+        self.assertIsNotNone((await editor.receive_json_from())['edit'])
+        await editor.disconnect()
+        frames = []
+        while not await neighbour.receive_nothing():
+            frames.append(await neighbour.receive_json_from())
+        self.assertEqual([frame['values'] for frame in frames],
+                         [[1, 0, 0], [1, 1, 0], [1, 1, 1]])
+        await neighbour.disconnect()
+
+    @async_to_sync
+    async def test_flushed_at_max_changes(self):
+        """Reaching the buffer bound saves coalesced changes at once."""
+        cell = self.cells[(1, 1)]
+        editor = self.get_communicator(cell)
+        await editor.connect()
+        await editor.send_json_to({'type': 'patch', 'patch': [
+            ['edges_vertical', index, 1] for index in range(4)]})
+        self.assertEqual(await editor.receive_json_from(),
+                         {'type': 'ack', 'edit': None, 'sequence': None})
+        saved = await editor.receive_json_from()
+        latest_edit = await database_sync_to_async(
+            lambda: cell.latest_valid_edit)()
+        self.assertEqual(saved, {'type': 'ack', 'edit': latest_edit.id,
+                                 'sequence': latest_edit.sequence})
+        self.assertEqual(latest_edit.edges_vertical[:4], [1, 1, 1, 1])
+        await editor.disconnect()
+
+    @async_to_sync
+    async def test_flushed_after_interval(self):
+        """Buffered changes are saved after the flush interval."""
+        cell = self.cells[(1, 1)]
+        with self.settings(VISUAL_EDIT_FLUSH_INTERVAL=0.05):
+            editor = self.get_communicator(cell)
+            await editor.connect()
+        await editor.send_json_to({'type': 'patch', 'patch': [
+            ['edges_south_east', 0, 1]]})
+        self.assertIsNone((await editor.receive_json_from())['edit'])
+        saved = await editor.receive_json_from(timeout=2)
+        self.assertIsNotNone(saved['edit'])
+        await editor.disconnect()
+
+    @async_to_sync
+    async def test_failed_flush_retried(self):
+        """Changes failing to save are buffered and flushed again."""
+        cell = self.cells[(1, 1)]
+        commit_changes = VisualCellEditConsumer.commit_changes
+        failures = [OSError("Database unavailable")]
+
+        def fail_once(consumer, changes):
+            if failures:
+                raise failures.pop()
+            return commit_changes(consumer, changes)
+
+        with self.settings(VISUAL_EDIT_FLUSH_INTERVAL=0.05):
+            editor = self.get_communicator(cell)
+            await editor.connect()
+        with patch.object(VisualCellEditConsumer, 'commit_changes',
+                          autospec=True, side_effect=fail_once):
+            await editor.send_json_to({'type': 'patch', 'patch': [
+                ['edges_south_east', 0, 1]]})
+            self.assertIsNone((await editor.receive_json_from())['edit'])
+            with self.assertLogs('collab_canvas.visual.consumers', 'ERROR'):
+                error = await editor.receive_json_from(timeout=2)
+            self.assertTrue(error['retry'])
+            saved = await editor.receive_json_from(timeout=2)
+        latest_edit = await database_sync_to_async(
+            lambda: cell.latest_valid_edit)()
+        self.assertEqual(saved['edit'], latest_edit.id)
+        self.assertEqual(latest_edit.edges_south_east[0], 1)
+        await editor.disconnect()
+
+    @async_to_sync
+    async def test_unsaved_changes_logged_on_disconnect(self):
+        """Changes still failing to save on disconnect are logged."""
+        editor = self.get_communicator(self.cells[(1, 1)])
+        await editor.connect()
+        await editor.send_json_to({'type': 'patch', 'patch': [
+            ['edges_south_east', 0, 1]]})
+        await editor.receive_json_from()
+        with patch.object(VisualCellEditConsumer, 'commit_changes',
+                          side_effect=OSError("Database unavailable")):
+            with self.assertLogs('collab_canvas.visual.consumers',
+                                 'ERROR') as logs:
+                await editor.disconnect()
+        self.assertIn('Lost 1 buffered changes', logs.output[-1])
+
+
+class TestVisualCanvasChangeFeedConsumer2x2Grid(BaseConsumer2x2GridTest):
+
+    """Test spectators share one subscription per canvas."""
+
+    async def connect_feed(self, canvas_id=None, headers=None, token=None):
+        if token is None:
+            token = self.canvas.get_spectator_token()
+        communicator = ApplicationCommunicator(feed_application, {
+            'type': 'http', 'http_version': '1.1', 'method': 'GET',
+            'path': f"/visual/canvas/{canvas_id or self.canvas.id}/feed/",
+            'query_string': f'token={token}'.encode(),
+            'headers': headers or []})
+        await communicator.send_input({'type': 'http.request'})
+        return communicator
+
+    async def receive_event(self, communicator):
+        """Parse the next Server-Sent Event, skipping comments."""
+        while True:
+            message = await communicator.receive_output()
+            body = message.get('body', b'').decode()
+            if body and not body.startswith(':'):
+                fields = dict(line.split(': ', 1)
+                              for line in body.strip().split('\n'))
+                return fields['event'], int(fields['id']), json.loads(
+                    fields['data'])
+
+    @async_to_sync
+    async def test_changes_fanned_out(self):
+        """One group membership serves every spectator of a canvas."""
+        spectators = [await self.connect_feed() for _ in range(3)]
+        for spectator in spectators:
+            start = await spectator.receive_output()
+            self.assertEqual(start['status'], 200)
+            self.assertIn((b'Content-Type', b'text/event-stream'),
+                          start['headers'])
+        group = VisualCanvas.change_group_name(self.canvas.id)
+        self.assertEqual(len(get_channel_layer().groups[group]), 1)
+        cell = self.cells[(1, 1)]
+        edit = await database_sync_to_async(cell.apply_edit_patch)(
+            [('edges_south_east', 0, 1)])
+        for spectator in spectators:
+            event, sequence, change = await self.receive_event(spectator)
+            self.assertEqual((event, sequence), ('change', edit.sequence))
+            self.assertEqual(change, {'cell': str(cell.id), 'edit': edit.id,
+                                      'sequence': edit.sequence,
+                                      'patch': [['edges_south_east', 0, 1]]})
+        for spectator in spectators:
+            await spectator.send_input({'type': 'http.disconnect'})
+            await spectator.wait()
+        self.assertEqual(CanvasChangeFanOut.fan_outs, {})
+        self.assertFalse(get_channel_layer().groups.get(group))
+
+    @async_to_sync
+    async def test_catch_up_from_last_event_id(self):
+        """Reconnecting spectators first get the changes they missed."""
+        cell = self.cells[(1, 1)]
+        edit = await database_sync_to_async(cell.apply_edit_patch)(
+            [('edges_south_east', 0, 1)])
+        spectator = await self.connect_feed(headers=[
+            (b'last-event-id', str(edit.sequence - 1).encode())])
+        event, sequence, change = await self.receive_event(spectator)
+        self.assertEqual((event, change['edit']), ('change', edit.id))
+        await spectator.send_input({'type': 'http.disconnect'})
+        await spectator.wait()
+
+    @async_to_sync
+    async def test_slow_spectator_ended(self):
+        """A full queue gets an end of feed marker and no more changes."""
+        queue: Queue = Queue(maxsize=2)
+        await CanvasChangeFanOut.subscribe(self.canvas.id, queue)
+        group = VisualCanvas.change_group_name(self.canvas.id)
+        for sequence in range(1, 4):
+            await get_channel_layer().group_send(group, {
+                'type': 'canvas.change', 'change': {'sequence': sequence}})
+        while queue.qsize() < 2:
+            await sleep(0.01)
+        await sleep(0.05)
+        self.assertEqual([queue.get_nowait(), queue.get_nowait()],
+                         [{'sequence': 1}, None])
+        self.assertTrue(queue.empty())
+        await CanvasChangeFanOut.unsubscribe(self.canvas.id, queue)
+        self.assertEqual(CanvasChangeFanOut.fan_outs, {})
+
+    @async_to_sync
+    async def test_unknown_canvas(self):
+        spectator = await self.connect_feed(canvas_id=uuid4())
+        start = await spectator.receive_output()
+        self.assertEqual(start['status'], 404)
+        self.assertIn((b'Content-Type', b'text/plain'), start['headers'])
+        self.assertTrue((await spectator.receive_output())['body'])
+
+    @async_to_sync
+    async def test_spectator_token_required(self):
+        """Feeds need the canvas' own token, not another canvas'."""
+        for token in ('', VisualCanvas(id=uuid4()).get_spectator_token()):
+            spectator = await self.connect_feed(token=token)
+            start = await spectator.receive_output()
+            self.assertEqual(start['status'], 403)
+            self.assertIn((b'Content-Type', b'text/plain'), start['headers'])
+        self.assertEqual(CanvasChangeFanOut.fan_outs, {})
@@ -0,0 +1,126 @@
+from random import Random
+from unittest import TestCase
+
+from ..engine import Layout, SimulatedCanvas, get_geometry, simulate
+
+from .utils import BaseVisualTest, CanvasFactory, UserFactory
+
+
+class TestLayout(TestCase):
+
+    """Test coordinate rules without a database."""
+
+    def test_torus_wraps_neighbours(self):
+        layout = Layout(3, 3, is_torus=True)
+        neighbours = layout.get_neighbour_coordinates((0, 0))
+        self.assertEqual(neighbours['south_west'], (2, 2))
+        self.assertEqual(neighbours['north'], (0, 1))
+        self.assertEqual(layout.wrap((-4, 3)), (2, 0))
+
+    def test_grid_edges_have_no_free_neighbour(self):
+        layout = Layout(2, 2)
+        self.assertIsNone(layout.get_free_neighbour((1, 1), 'north', set()))
+        self.assertEqual(layout.get_free_neighbour((1, 1), 'west', set()),
+                         (0, 1))
+        self.assertIsNone(layout.get_free_neighbour((1, 1), 'west',
+                                                    {(0, 1)}))
+
+    def test_choose_contiguous_coordinates(self):
+        layout = Layout(3, 3)
+        self.assertIsNone(layout.choose_contiguous_coordinates(
+            [(x, y) for x in range(3) for y in range(3)]))
+        self.assertIn(layout.choose_contiguous_coordinates([(1, 1)]),
+                      {(1, 2), (2, 1), (1, 0), (0, 1)})
+
+
+class TestSimulatedCanvas(TestCase):
+
+    """Test simulated assignment and edits keep the canvas rules."""
+
+    def assertContiguous(self, canvas):
+        for cell in canvas.cells.values():
+            if cell.artist is not None:
+                self.assertTrue(any(
+                    neighbour.artist is not None
+                    for neighbour in cell.neighbours.values()))
+
+    def test_grid_assignment(self):
+        canvas = SimulatedCanvas(Layout(4, 4), random=Random(1))
+        cells = [canvas.assign(artist) for artist in range(16)]
+        self.assertEqual(cells[0].coordinates, (1, 1))
+        self.assertEqual(len({cell.coordinates for cell in cells}), 16)
+        self.assertIs(canvas.assign(3), cells[3])
+        self.assertContiguous(canvas)
+        with self.assertRaises(SimulatedCanvas.FullGridException):
+            canvas.assign(16)
+
+    def test_torus_and_organic_assignment(self):
+        for layout in (Layout(3, 3, is_torus=True),
+                       Layout(new_cells_allowed=True)):
+            canvas = SimulatedCanvas(layout, random=Random(2))
+            cells = [canvas.assign(artist) for artist in range(9)]
+            self.assertEqual(len({cell.coordinates for cell in cells}), 9)
+            self.assertContiguous(canvas)
+        self.assertEqual(cells[0].coordinates, (0, 0))
+
+    def test_shared_edges_stay_equal(self):
+        """Neighbours agree on every shared position after random edits."""
+        random = Random(3)
+        canvas = SimulatedCanvas(Layout(3, 3, is_torus=True), 3, 3,
+                                 random=random)
+        cells = [canvas.assign(artist) for artist in range(9)]
+        geometry = canvas.geometry
+        for _ in range(500):
+            edge_name = random.choice(list(geometry.dimensions))
+            canvas.edit(random.choice(cells), [
+                (edge_name, random.randrange(geometry.dimensions[edge_name]),
+                 random.randint(0, 1))])
+        for cell in cells:
+            for (edge_name, index), boundary in geometry.boundary.items():
+                for direction, _, neighbour_index in boundary:
+                    self.assertEqual(
+                        cell.edges[edge_name][index],
+                        cell.neighbours[direction].edges[edge_name][
+                            neighbour_index])
+
+    def test_unchanged_edit_not_written(self):
+        canvas = SimulatedCanvas(Layout(2, 2))
+        cell = canvas.assign(0)
+        edits = canvas.edits
+        self.assertEqual(canvas.edit(cell, [('edges_horizontal', 0, 0)]), 0)
+        self.assertEqual(canvas.edits, edits)
+
+    def test_simulate(self):
+        results = simulate(artists=100, edits=1000, seed=4)
+        self.assertEqual(results['cells'], 100)
+        self.assertEqual(results['edits'], 1000)
+        self.assertEqual(results['edits_written'],
+                         results['own_edits'] + results['neighbour_edits'])
+
+
+class TestEngineMatchesModels(BaseVisualTest):
+
+    """Test the simulation and the ORM agree on a 3x3 grid."""
+
+    def test_edges_match(self):
+        canvas = CanvasFactory(title='Test Engine Grid', slug='engine',
+                               grid_width=3, grid_height=3)
+        simulated = SimulatedCanvas(canvas.layout, canvas.cell_width,
+                                    canvas.cell_height)
+        for cell in canvas.visual_cells.all():
+            cell.artist = UserFactory()
+            cell.save()
+        geometry = get_geometry(canvas.cell_width, canvas.cell_height)
+        random = Random(5)
+        for _ in range(30):
+            cell = canvas.visual_cells.get(x_position=random.randrange(3),
+                                           y_position=random.randrange(3))
+            edge_name = random.choice(list(geometry.dimensions))
+            patch = [(edge_name,
+                      random.randrange(geometry.dimensions[edge_name]),
+                      random.randint(0, 1))]
+            cell.apply_edit_patch(patch)
+            simulated.edit(simulated.cells[cell.coordinates], patch)
+        for cell in canvas.visual_cells.all():
+            self.assertEqual(cell.latest_valid_edit.get_edges(),
+                             simulated.cells[cell.coordinates].get_edges())
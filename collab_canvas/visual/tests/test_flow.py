@@ -0,0 +1,51 @@
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase
+
+from .. import metrics
+from ..flow import OutboundQueue, TokenBucket
+
+
+class TestOutboundQueue(SimpleTestCase):
+
+    """Test slow clients get merged changes and a bounded backlog."""
+
+    def drain(self, queue):
+        return [async_to_sync(queue.get)() for _ in range(len(queue))]
+
+    def test_keyed_messages_merged(self):
+        merged = metrics.get_counters().get('visual_outbound_merged_total', 0)
+        queue = OutboundQueue(maxsize=4)
+        queue.put('change-1', key=('cell', 'edges_horizontal', -3))
+        queue.put('ack')
+        queue.put('change-2', key=('cell', 'edges_horizontal', -3))
+        self.assertEqual(self.drain(queue), ['change-2', 'ack'])
+        self.assertEqual(metrics.get_counters()['visual_outbound_merged_total'],
+                         merged + 1)
+        self.assertFalse(queue.resync)
+
+    def test_oldest_dropped_when_full(self):
+        queue = OutboundQueue(maxsize=2)
+        for message in ('ack-1', 'ack-2', 'ack-3'):
+            queue.put(message)
+        self.assertEqual(self.drain(queue), ['ack-2', 'ack-3'])
+        self.assertTrue(queue.resync)
+
+
+class TestTokenBucket(SimpleTestCase):
+
+    """Test patches are limited to a rate with bursts."""
+
+    @patch('collab_canvas.visual.flow.monotonic')
+    def test_burst_then_rate(self, monotonic):
+        monotonic.return_value = 0
+        bucket = TokenBucket(rate=2, burst=3)
+        self.assertEqual([bucket.allow() for _ in range(4)],
+                         [True, True, True, False])
+        monotonic.return_value = 0.5
+        self.assertEqual([bucket.allow() for _ in range(2)], [True, False])
+
+    def test_no_rate_allows_all(self):
+        bucket = TokenBucket(rate=0, burst=0)
+        self.assertTrue(all(bucket.allow() for _ in range(100)))
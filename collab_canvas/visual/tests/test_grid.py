@@ -1,10 +1,12 @@
 from datetime import timedelta
+from unittest.mock import patch
 
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError, transaction
+from django.db import IntegrityError, connection, transaction
 
-from ..models import VisualCell
-from .utils import BaseVisualTest, CanvasFactory, UserFactory
+from ..models import VisualCell, VisualCellEdit
+from .utils import (BaseTransactionVisualTest, BaseVisualTest, CanvasFactory,
+                    UserFactory)
 
 
 class TestCellAllocation3x3NonTorusGrid(BaseVisualTest):
@@ -219,3 +221,185 @@ class TestNonTorus2x2Grid(BaseVisualTest):
                               "set max_coordinates (2, 1) for canvas "
                               "Test Non-Torus Grid",
                               str(error.exception))
+
+
+class TestConcurrentCellEdits2x2Grid(BaseVisualTest):
+
+    """Test optimistic concurrency of cell edits via VisualCell.version."""
+
+    def setUp(self):
+        """Create a 2x2 grid with an artist for the (0, 0) cell."""
+        super().setUp()
+        self.canvas = CanvasFactory()
+        self.cell = self.canvas.visual_cells.get(x_position=0, y_position=0)
+        self.cell.artist = UserFactory()
+        self.cell.save()
+
+    def test_version_incremented_per_commit(self):
+        """Edits and the neighbour edits they dispatch increment version."""
+        north = self.canvas.visual_cells.get(x_position=0, y_position=1)
+        self.cell.apply_edit_patch([('edges_horizontal', 0, 1)])
+        self.cell.apply_edit_patches([[('edges_vertical', 0, 1)],
+                                      [('edges_vertical', 1, 1)]])
+        self.cell.refresh_from_db()
+        north.refresh_from_db()
+        self.assertEqual(self.cell.version, 2)
+        self.assertEqual(north.version, 1)
+
+    def test_concurrent_edit_fails_fast(self):
+        """A commit against an out of date version raises without saving."""
+        stale_cell = VisualCell.objects.get(pk=self.cell.pk)
+        self.cell.apply_edit_patch([('edges_horizontal', 0, 1)])
+        edit_count = self.cell.edits.count()
+        with transaction.atomic():
+            with self.assertRaises(VisualCell.ConcurrentEditException):
+                stale_cell.apply_edit_patch([('edges_horizontal', 1, 1)])
+        self.assertEqual(self.cell.edits.count(), edit_count)
+        stale_cell.refresh_from_db(fields=['version'])
+        stale_cell.apply_edit_patch([('edges_horizontal', 1, 1)])
+        self.assertEqual(self.cell.edits.count(), edit_count + 1)
+
+
+class TestCanvasSequence2x2Grid(BaseVisualTest):
+
+    """Test edits are numbered in commit order across a canvas."""
+
+    def setUp(self):
+        """Create a 2x2 grid with an artist for the (0, 0) cell."""
+        super().setUp()
+        self.canvas = CanvasFactory()
+        self.cell = self.canvas.visual_cells.get(x_position=0, y_position=0)
+        self.cell.artist = UserFactory()
+        self.cell.save()
+        self.north = self.canvas.visual_cells.get(x_position=0, y_position=1)
+
+    def test_sequence_increases_across_cells(self):
+        """Edits and the neighbour edits they dispatch get new sequences."""
+        start = self.canvas.sequence
+        first = self.cell.apply_edit_patch([('edges_horizontal', 0, 1)])
+        neighbour_edit = self.north.latest_valid_edit
+        second, third = self.cell.apply_edit_patches(
+            [[('edges_vertical', 0, 1)], [('edges_vertical', 1, 1)]])
+        self.assertLess(start, first.sequence)
+        self.assertLess(first.sequence, neighbour_edit.sequence)
+        self.assertLess(neighbour_edit.sequence, second.sequence)
+        self.assertEqual(third.sequence, second.sequence + 1)
+        self.canvas.refresh_from_db()
+        self.assertEqual(self.canvas.sequence, third.sequence)
+
+    def test_changes_since_as_patches(self):
+        """Each changed cell gets one sparse patch since the sequence."""
+        self.cell.apply_edit_patch([('edges_vertical', 0, 1)])
+        self.canvas.refresh_from_db()
+        sequence = self.canvas.sequence
+        self.cell.apply_edit_patch([('edges_horizontal', 0, 1)])
+        edit = self.cell.apply_edit_patch([('edges_horizontal', 1, 1)])
+        changes = self.canvas.get_changes_since(sequence)
+        self.assertFalse(changes['snapshot'])
+        self.assertEqual(changes['sequence'], self.north.edits.latest(
+            'timestamp', '_order').sequence)
+        cells = {change['cell']: change for change in changes['cells']}
+        self.assertEqual(set(cells), {str(self.cell.id), str(self.north.id)})
+        self.assertEqual(cells[str(self.cell.id)],
+                         {'cell': str(self.cell.id), 'edit': edit.id,
+                          'sequence': edit.sequence,
+                          'patch': [['edges_horizontal', 0, 1],
+                                    ['edges_horizontal', 1, 1]]})
+        self.assertEqual(self.canvas.get_changes_since(
+            changes['sequence'])['cells'], [])
+
+    def test_changes_since_filtered_by_cell(self):
+        """Only requested cells are included, with edges if new."""
+        self.cell.apply_edit_patch([('edges_horizontal', 0, 1)])
+        changes = self.canvas.get_changes_since(0, cell_ids=[self.cell.id])
+        self.assertEqual(len(changes['cells']), 1)
+        self.assertEqual(
+            changes['cells'][0]['edges'],
+            self.cell.latest_valid_edit.get_edges())
+
+    def test_changes_since_snapshot_for_large_gap(self):
+        """Too many edits since the sequence returns every cell's edges."""
+        self.cell.apply_edit_patch([('edges_horizontal', 0, 1)])
+        self.canvas.CATCH_UP_MAX_EDITS = 1
+        changes = self.canvas.get_changes_since(0)
+        self.assertTrue(changes['snapshot'])
+        self.assertEqual(len(changes['cells']), 4)
+        self.assertTrue(all('edges' in change for change in changes['cells']))
+
+
+class TestCanvasSequenceLock2x2Grid(BaseTransactionVisualTest):
+
+    """Test the canvas sequence is only locked while inserting edits."""
+
+    def test_neighbours_dispatched_after_commit(self):
+        """Saves and commits dispatch outside their transaction."""
+        canvas = CanvasFactory()
+        cell = canvas.visual_cells.get(x_position=0, y_position=0)
+        in_atomic_blocks = []
+
+        def dispatch_neighbour_edits(cell, *args, **kwargs):
+            in_atomic_blocks.append(connection.in_atomic_block)
+
+        with patch.object(VisualCell, 'dispatch_neighbour_edits',
+                          autospec=True,
+                          side_effect=dispatch_neighbour_edits):
+            edges = cell.latest_valid_edit.get_edges()
+            edges['edges_horizontal'][0] = 1
+            cell.edits.create(**edges)
+            cell.refresh_from_db(fields=['version'])
+            cell.apply_edit_patch([('edges_horizontal', 1, 1)])
+        self.assertEqual(in_atomic_blocks, [False, False])
+
+
+class TestSharedEdgeMerge2x2Grid(BaseVisualTest):
+
+    """Test concurrent edits either side of a boundary converge."""
+
+    def setUp(self):
+        """Allow three colours in the (0, 0) and east (1, 0) cells."""
+        super().setUp()
+        self.canvas = CanvasFactory()
+        self.cell = self.canvas.visual_cells.get(x_position=0, y_position=0)
+        self.east = self.canvas.visual_cells.get(x_position=1, y_position=0)
+        for cell in (self.cell, self.east):
+            cell.colour_range = 2
+            cell.save()
+
+    def commit_undispatched(self, cell, patch):
+        """Commit a patch without dispatching, as if racing a neighbour."""
+        base_edit = cell.latest_valid_edit
+        cell.commit_edits([VisualCellEdit(**cell.patch_edges(
+            base_edit.get_edges(), patch))], base_edit,
+            dispatch_neighbours=False)
+        return base_edit
+
+    def get_boundary(self):
+        """The shared edge as seen from (0, 0) and from the east cell."""
+        return (self.cell.latest_valid_edit.edges_vertical[-3:],
+                self.east.latest_valid_edit.edges_vertical[:3])
+
+    def test_strokes_on_both_sides_kept(self):
+        """Neither side's stroke is overwritten by the other's segment."""
+        cell_base = self.commit_undispatched(self.cell,
+                                             [('edges_vertical', 9, 1)])
+        east_base = self.commit_undispatched(self.east,
+                                             [('edges_vertical', 2, 2)])
+        self.east.dispatch_neighbour_edits(previous_edit=east_base)
+        self.cell.refresh_from_db(fields=['version'])
+        self.cell.dispatch_neighbour_edits(previous_edit=cell_base)
+        self.assertEqual(self.get_boundary(), ([1, 0, 2], [1, 0, 2]))
+
+    def test_same_position_latest_writer_wins(self):
+        """Both cells take the later of two writes in either order."""
+        cell_base = self.commit_undispatched(self.cell,
+                                             [('edges_vertical', 10, 1)])
+        east_base = self.commit_undispatched(self.east,
+                                             [('edges_vertical', 1, 2)])
+        self.cell.dispatch_neighbour_edits(previous_edit=cell_base)
+        self.east.refresh_from_db(fields=['version'])
+        self.east.dispatch_neighbour_edits(previous_edit=east_base)
+        self.assertEqual(self.get_boundary(), ([0, 2, 0], [0, 2, 0]))
+        neighbour_edits = VisualCellEdit.objects.filter(
+            neighbour_edit__isnull=False)
+        self.assertEqual([edit.cell_id for edit in neighbour_edits],
+                         [self.cell.id])
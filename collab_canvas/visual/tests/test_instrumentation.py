@@ -0,0 +1,82 @@
+import json
+
+from django.test import override_settings
+from django.urls import reverse
+
+from ..instrumentation import RollingStats, get_rolling_stats, timed
+
+from .utils import (BaseVisualTest, CanvasFactory, CellFactory, UserFactory,
+                    TEST_USER_PASSWORD)
+
+
+class TestRollingStats(BaseVisualTest):
+
+    """Test percentiles of the last window samples per view."""
+
+    def test_window_keeps_latest_samples(self):
+        stats = RollingStats(window=3)
+        for queries in range(1, 6):
+            stats.add('visual:canvas', {'queries': queries, 'db': 0,
+                                        'signals': 0, 'propagation': 0,
+                                        'render': 0, 'total': 0})
+        summary = stats.get_summary()['visual:canvas']
+        self.assertEqual(summary['count'], 5)
+        self.assertEqual(summary['queries']['p50'], 4)
+        self.assertEqual(summary['queries']['p99'], 5)
+
+    def test_timed_outside_request_is_noop(self):
+        with timed('signals'):
+            pass
+
+
+class TestVisualInstrumentationMiddleware(BaseVisualTest):
+
+    """Test visual requests are measured and summarised for staff."""
+
+    def setUp(self):
+        super().setUp()
+        self.canvas = CanvasFactory(grid_height=0, grid_width=0,
+                                    new_cells_allowed=True)
+        self.cell = CellFactory(canvas=self.canvas)
+        self.assertTrue(self.client.login(username=self.cell.artist.username,
+                                          password=TEST_USER_PASSWORD))
+
+    def post_patch(self):
+        return self.client.post(
+            reverse('visual:cell-edit-patch',
+                    kwargs={'cell_id': self.cell.id}),
+            {'patch': json.dumps([['edges_horizontal', 2, 1]])})
+
+    def test_view_queries_recorded(self):
+        count = get_rolling_stats().get_summary().get(
+            'visual:cell-edit-patch', {}).get('count', 0)
+        self.assertEqual(self.post_patch().status_code, 201)
+        summary = get_rolling_stats().get_summary()['visual:cell-edit-patch']
+        self.assertEqual(summary['count'], count + 1)
+        self.assertGreater(summary['queries']['p99'], 0)
+        self.assertGreater(summary['propagation']['p99'], 0)
+
+    def test_debug_headers(self):
+        self.assertNotIn('Server-Timing', self.post_patch())
+        with override_settings(DEBUG=True):
+            response = self.post_patch()
+        self.assertGreater(int(response['X-Visual-Queries']), 0)
+        self.assertIn('propagation;dur=', response['Server-Timing'])
+
+    def test_render_time_recorded(self):
+        with override_settings(DEBUG=True):
+            response = self.client.get(self.cell.get_edit_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('render;dur=', response['Server-Timing'])
+        summary = get_rolling_stats().get_summary()['visual:cell-edit']
+        self.assertGreater(summary['render']['p99'], 0)
+
+    def test_staff_only_summary(self):
+        url = reverse('visual:instrumentation')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        staff = UserFactory(is_staff=True)
+        self.client.force_login(staff)
+        self.post_patch()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('visual:cell-edit-patch', response.json())
@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+
+from asgiref.sync import async_to_sync
+from channels.auth import AuthMiddlewareStack
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, override_settings
+from django.urls import path
+
+from ..consumers import VisualCellEditConsumer
+from ..loadtest import measure_fan_out, run_load_test
+from ..models import VisualCanvas
+from ..presence import get_presence
+from .utils import BaseTransactionVisualTest
+
+
+application = AuthMiddlewareStack(URLRouter([
+    path("canvas/cell/<uuid:cell_id>/edit/changes", VisualCellEditConsumer),
+]))
+
+
+class TestLoadTest(BaseTransactionVisualTest):
+
+    """Test simulated artists draw, are measured and cleaned up."""
+
+    def tearDown(self):
+        async_to_sync(get_channel_layer().flush)()
+        get_presence().hashes.clear()
+
+    def run_load_test(self, **kwargs):
+        return async_to_sync(run_load_test)(
+            application, clients=4, strokes=10, interval=0, seed=1, **kwargs)
+
+    @override_settings(VISUAL_EDIT_FLUSH_INTERVAL=0)
+    def test_edits_measured_and_cleaned_up(self):
+        results = self.run_load_test()
+        self.assertEqual(results['messages_sent'], 40)
+        self.assertEqual(results['ack']['count'], 40)
+        self.assertGreaterEqual(results['edits'], 40)
+        self.assertGreater(results['fan_out']['count'], 0)
+        self.assertLessEqual(results['fan_out']['p50'],
+                             results['fan_out']['p99'])
+        self.assertFalse(VisualCanvas.objects.filter(
+            id=results['canvas']).exists())
+        self.assertFalse(get_user_model().objects.filter(
+            username__startswith='loadtest-').exists())
+
+    @override_settings(VISUAL_EDIT_FLUSH_INTERVAL=60)
+    def test_buffered_edits_saved_on_disconnect(self):
+        results = self.run_load_test(binary=False)
+        self.assertTrue(results['buffered'])
+        self.assertEqual(results['ack']['count'], 40)
+        self.assertGreaterEqual(results['edits'], 4)
+        self.assertGreater(results['fan_out']['count'], 0)
+        self.assertEqual(results['saved_edge_frames'], 0)
+
+
+class TestMeasureFanOut(SimpleTestCase):
+
+    """Test edge changes are matched to the patches that made them."""
+
+    def test_live_saved_and_flushed_changes(self):
+        sender = SimpleNamespace(cell=SimpleNamespace(id='a'),
+                                 sent=[1.0, 2.0], edit_sent={7: 1.0},
+                                 received=[])
+        neighbour = SimpleNamespace(
+            cell=SimpleNamespace(id='b'), sent=[], edit_sent={},
+            received=[('a', 7, 1.5), ('a', None, 2.25), ('a', 8, 9.0)])
+        fan_out, saved_edge_frames = measure_fan_out([sender, neighbour])
+        self.assertEqual(fan_out, [0.5, 0.25])
+        self.assertEqual(saved_edge_frames, 1)
@@ -0,0 +1,99 @@
+import json
+
+from django.test import override_settings
+from django.urls import reverse
+
+from collab_canvas.taskapp.celery import app as celery_app
+
+from .. import metrics
+
+from .utils import (BaseTransactionVisualTest, BaseVisualTest,
+                    CanvasFactory, CellFactory, UserFactory,
+                    TEST_USER_PASSWORD)
+
+
+class TestMetricsRegistry(BaseVisualTest):
+
+    """Test samples are formatted in the Prometheus text format."""
+
+    def test_labelled_counter(self):
+        metrics.increment('visual_edits_total', 2, canvas='test-labelled')
+        self.assertIn('visual_edits_total{canvas="test-labelled"} 2\n',
+                      metrics.render())
+        self.assertEqual(metrics.get_counters()[
+            'visual_edits_total{canvas="test-labelled"}'], 2)
+
+    def test_histogram_buckets_cumulative(self):
+        for value in (0.0004, 0.003, 30):
+            metrics.observe('visual_cell_assignment_seconds', value,
+                            test='buckets')
+        rendered = metrics.render()
+        for line in ('visual_cell_assignment_seconds_bucket'
+                     '{test="buckets",le="0.0005"} 1',
+                     'visual_cell_assignment_seconds_bucket'
+                     '{test="buckets",le="0.005"} 2',
+                     'visual_cell_assignment_seconds_bucket'
+                     '{test="buckets",le="10"} 2',
+                     'visual_cell_assignment_seconds_bucket'
+                     '{test="buckets",le="+Inf"} 3',
+                     'visual_cell_assignment_seconds_count'
+                     '{test="buckets"} 3'):
+            self.assertIn(line + '\n', rendered)
+
+    def test_every_metric_described(self):
+        rendered = metrics.render()
+        for name, (metric_type, *_) in metrics.METRICS.items():
+            self.assertIn(f'# TYPE {name} {metric_type}\n', rendered)
+
+    def test_celery_queue_depth(self):
+        depths = metrics.get_celery_queue_depths(celery_app)
+        self.assertTrue(all(depth >= 0 for depth in depths.values()))
+
+
+class TestVisualMetricsView(BaseVisualTest):
+
+    """Test canvas activity is counted and only shown to scrapers."""
+
+    def setUp(self):
+        super().setUp()
+        self.canvas = CanvasFactory(grid_height=0, grid_width=0,
+                                    new_cells_allowed=True)
+        self.cell = CellFactory(canvas=self.canvas)
+        self.url = reverse('visual:metrics')
+
+    def test_staff_only(self):
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.client.force_login(UserFactory(is_staff=True))
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'],
+                         'text/plain; version=0.0.4')
+        self.assertIn(f'visual_canvas_cells{{canvas="{self.canvas.id}"}} 1',
+                      response.content.decode())
+
+    @override_settings(VISUAL_METRICS_TOKEN='scrape')
+    def test_token(self):
+        self.assertEqual(self.client.get(
+            self.url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(self.client.get(
+            self.url, HTTP_AUTHORIZATION='Bearer scrape').status_code, 200)
+
+
+class TestEditMetrics(BaseTransactionVisualTest):
+
+    """Test committed edits are counted per canvas."""
+
+    def test_edits_counted(self):
+        canvas = CanvasFactory(grid_height=0, grid_width=0,
+                               new_cells_allowed=True)
+        cell = CellFactory(canvas=canvas)
+        key = f'visual_edits_total{{canvas="{canvas.id}"}}'
+        edits = metrics.get_counters()[key]
+        self.assertTrue(self.client.login(username=cell.artist.username,
+                                          password=TEST_USER_PASSWORD))
+        response = self.client.post(
+            reverse('visual:cell-edit-patch', kwargs={'cell_id': cell.id}),
+            {'patch': json.dumps([['edges_horizontal', 2, 1]])})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(metrics.get_counters()[key], edits + 1)
+        self.assertIn('visual_neighbour_fan_out_count ', metrics.render())
@@ -0,0 +1,148 @@
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.urls import path
+
+from ..consumers import VisualCellEditConsumer
+from ..middleware import (CachedAuthMiddlewareStack, cache_user,
+                          get_assigned_cells, get_cached_user)
+from ..models import VisualCell
+from ..presence import get_presence
+from .utils import (BaseTransactionVisualTest, BaseVisualTest, CanvasFactory,
+                    UserFactory)
+
+
+application = CachedAuthMiddlewareStack(URLRouter([
+    path("canvas/cell/<uuid:cell_id>/edit/changes", VisualCellEditConsumer),
+]))
+
+
+class TestCachedAuthInvalidation(BaseVisualTest):
+
+    """Test cached users and cells are dropped when they change."""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.canvas = CanvasFactory()
+        self.user = UserFactory()
+        self.cell = self.canvas.visual_cells.get(x_position=0, y_position=0)
+        self.cell.artist = self.user
+        self.cell.save()
+
+    def test_assigned_cells_cached(self):
+        self.assertEqual(list(get_assigned_cells(self.user)),
+                         [str(self.cell.id)])
+        with self.assertNumQueries(0):
+            cell = get_assigned_cells(self.user)[str(self.cell.id)]
+            self.assertTrue(cell.user_may_edit(self.user))
+
+    def test_reassigning_cell_invalidates(self):
+        get_assigned_cells(self.user)
+        self.cell.artist = UserFactory()
+        self.cell.save()
+        self.assertEqual(get_assigned_cells(self.user), {})
+
+    def test_saving_loaded_cell_needs_no_artist_query(self):
+        cell = VisualCell.objects.get(pk=self.cell.pk)
+        with self.assertNumQueries(1):
+            cell.save()
+        get_assigned_cells(self.user)
+        cell.artist = UserFactory()
+        with self.assertNumQueries(1):
+            cell.save()
+        self.assertEqual(get_assigned_cells(self.user), {})
+
+    def test_logout_invalidates_session(self):
+        self.client.force_login(self.user)
+        session_key = self.client.session.session_key
+        cache_user(session_key, self.user)
+        self.assertEqual(get_cached_user(session_key), self.user)
+        self.client.logout()
+        self.assertIsNone(get_cached_user(session_key))
+
+    def test_password_change_invalidates_sessions(self):
+        self.client.force_login(self.user)
+        session_key = self.client.session.session_key
+        cache_user(session_key, self.user)
+        self.assertEqual(get_cached_user(session_key), self.user)
+        user = get_user_model().objects.get(pk=self.user.pk)
+        user.set_password('changed')
+        user.save()
+        self.assertIsNone(get_cached_user(session_key))
+
+    def test_deactivation_invalidates_sessions(self):
+        self.client.force_login(self.user)
+        session_key = self.client.session.session_key
+        cache_user(session_key, self.user)
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(get_cached_user(session_key))
+
+
+class TestCachedAuthMiddleware(BaseTransactionVisualTest):
+
+    """Test websocket connects resolve sessions through the cache."""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.canvas = CanvasFactory()
+        self.user = UserFactory()
+        self.cell = self.canvas.visual_cells.get(x_position=0, y_position=0)
+        self.cell.artist = self.user
+        self.cell.save()
+        self.client.force_login(self.user)
+        self.cookie = (f'{settings.SESSION_COOKIE_NAME}='
+                       f'{self.client.cookies[settings.SESSION_COOKIE_NAME].value}')
+
+    def tearDown(self):
+        async_to_sync(get_channel_layer().flush)()
+        get_presence().hashes.clear()
+
+    async def connect(self, cookie=None):
+        communicator = WebsocketCommunicator(
+            application, f"/canvas/cell/{self.cell.id}/edit/changes",
+            headers=[(b'cookie', (cookie or self.cookie).encode())])
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    @async_to_sync
+    async def test_second_connect_uses_cache(self):
+        """Only the first connect loads the session user."""
+        communicator, connected = await self.connect()
+        self.assertTrue(connected)
+        await communicator.disconnect()
+        with patch('collab_canvas.visual.middleware.get_user') as get_user:
+            communicator, connected = await self.connect()
+            self.assertTrue(connected)
+            get_user.assert_not_called()
+        await communicator.send_json_to({'type': 'patch',
+                                         'patch': [['edges_vertical', 4, 1]]})
+        self.assertEqual((await communicator.receive_json_from())['type'],
+                         'ack')
+        await communicator.disconnect()
+
+    @async_to_sync
+    async def test_password_change_rejects_cached_session(self):
+        """Other sessions end on a password change, as without caching."""
+        communicator, connected = await self.connect()
+        self.assertTrue(connected)
+        await communicator.disconnect()
+        self.user.set_password('changed')
+        await database_sync_to_async(self.user.save)()
+        _, connected = await self.connect()
+        self.assertFalse(connected)
+
+    @async_to_sync
+    async def test_unknown_session_rejected(self):
+        _, connected = await self.connect(
+            f'{settings.SESSION_COOKIE_NAME}=not-a-session')
+        self.assertFalse(connected)
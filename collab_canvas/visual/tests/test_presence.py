@@ -0,0 +1,89 @@
+from unittest.mock import MagicMock, patch
+
+from django.test import SimpleTestCase
+
+from ..models import VisualCell
+from ..presence import (Presence, RedisPresence, canvas_key, cell_key,
+                        get_presence)
+
+
+class TestPresence(SimpleTestCase):
+
+    """Test joining, heartbeating and expiring presence in process."""
+
+    def setUp(self):
+        self.presence = Presence(timeout=30)
+        self.user = MagicMock(id=1, username='artist')
+
+    def test_join_and_leave(self):
+        self.presence.join('canvas', 'cell-a', 'channel-1', self.user)
+        self.assertEqual(self.presence.get_present_cells(['cell-a', 'cell-b']),
+                         {'cell-a'})
+        self.assertEqual(
+            [(value['cell'], value['username']) for value in
+             self.presence.get_canvas_presence('canvas')],
+            [('cell-a', 'artist')])
+        self.presence.leave('canvas', 'cell-a', 'channel-1')
+        self.assertEqual(self.presence.get_present_cells(['cell-a']), set())
+        self.assertEqual(self.presence.get_canvas_presence('canvas'), [])
+
+    def test_cell_present_while_any_connection_is(self):
+        self.presence.join('canvas', 'cell-a', 'channel-1', self.user)
+        self.presence.join('canvas', 'cell-a', 'channel-2', self.user)
+        self.presence.leave('canvas', 'cell-a', 'channel-1')
+        self.assertEqual(self.presence.get_present_cells(['cell-a']),
+                         {'cell-a'})
+
+    def test_expired_heartbeats_ignored_and_pruned(self):
+        with patch('collab_canvas.visual.presence.time', return_value=100):
+            self.presence.join('canvas', 'cell-a', 'channel-1', self.user)
+        with patch('collab_canvas.visual.presence.time', return_value=120):
+            self.presence.heartbeat('canvas', 'cell-b', 'channel-2',
+                                    self.user)
+        with patch('collab_canvas.visual.presence.time', return_value=140):
+            self.assertEqual(
+                self.presence.get_present_cells(['cell-a', 'cell-b']),
+                {'cell-b'})
+            self.assertEqual([value['cell'] for value in
+                              self.presence.get_canvas_presence('canvas')],
+                             ['cell-b'])
+        self.assertNotIn('channel-1', self.presence.hashes[canvas_key(
+            'canvas')])
+
+
+class TestRedisPresence(SimpleTestCase):
+
+    """Test presence is written as expiring Redis hashes."""
+
+    def test_join_writes_expiring_hash_fields(self):
+        redis = MagicMock()
+        pipeline = redis.pipeline.return_value
+        RedisPresence(redis, timeout=30).join(
+            'canvas', 'cell-a', 'channel-1', MagicMock(id=1,
+                                                       username='artist'))
+        self.assertEqual([call[0][:2] for call in pipeline.hset.call_args_list],
+                         [(cell_key('cell-a'), 'channel-1'),
+                          (canvas_key('canvas'), 'channel-1')])
+        pipeline.expire.assert_called_with(canvas_key('canvas'), 31)
+        pipeline.execute.assert_called_once_with()
+
+
+class TestGetPresence(SimpleTestCase):
+
+    """Test presence per process never skips neighbours it can't see."""
+
+    def test_in_process_layer(self):
+        with patch('collab_canvas.visual.presence._presence', None):
+            self.assertTrue(get_presence().sees_every_connection)
+
+    def test_shared_layer_sends_to_every_neighbour(self):
+        neighbours = {'north': MagicMock(id='cell-a'),
+                      'east': MagicMock(id='cell-b')}
+        with patch('collab_canvas.visual.presence._presence', None), \
+                patch('collab_canvas.visual.presence.get_channel_layer',
+                      return_value=None):
+            with self.assertLogs('collab_canvas.visual.presence',
+                                 'WARNING'):
+                self.assertFalse(get_presence().sees_every_connection)
+            self.assertEqual(VisualCell.get_live_directions(neighbours),
+                             {'north', 'east'})
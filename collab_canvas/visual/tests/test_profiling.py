@@ -0,0 +1,146 @@
+from pstats import Stats
+from os import listdir
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+from django.urls import path, reverse
+
+from ..consumers import VisualCellEditConsumer
+from ..middleware import CachedAuthMiddlewareStack
+from ..presence import get_presence
+from ..profiling import get_profiles, profile
+
+from .utils import (BaseTransactionVisualTest, BaseVisualTest, CanvasFactory,
+                    UserFactory)
+
+
+application = CachedAuthMiddlewareStack(URLRouter([
+    path("canvas/cell/<uuid:cell_id>/edit/changes", VisualCellEditConsumer),
+]))
+
+
+class ProfileDirMixin(SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        profile_dir = mkdtemp()
+        self.addCleanup(rmtree, profile_dir)
+        settings_override = override_settings(VISUAL_PROFILE_DIR=profile_dir,
+                                              VISUAL_PROFILE_KEEP=2)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+class TestProfiling(ProfileDirMixin, BaseVisualTest):
+
+    """Test sampled and requested profiles are saved and listed."""
+
+    def setUp(self):
+        super().setUp()
+        self.canvas = CanvasFactory()
+        self.staff = UserFactory(is_staff=True)
+
+    def test_profile_sampling(self):
+        with profile('unsampled'):
+            pass
+        self.assertEqual(get_profiles(), [])
+        with override_settings(VISUAL_PROFILE_SAMPLE_RATE=1.0):
+            for _ in range(3):
+                with profile('sampled'):
+                    pass
+        profiles = get_profiles()
+        self.assertEqual(len(profiles), 2)
+        self.assertTrue(profiles[0]['name'].endswith('-sampled.prof'))
+        Stats(join(settings.VISUAL_PROFILE_DIR, profiles[0]['name']))
+
+    def test_concurrently_dropped(self):
+        """Profiles dropped by another process meanwhile are skipped."""
+        for _ in range(3):
+            with profile('kept', force=True):
+                pass
+        with patch('collab_canvas.visual.profiling.listdir',
+                   return_value=['dropped.prof'] + listdir(
+                       settings.VISUAL_PROFILE_DIR)):
+            self.assertEqual(len(get_profiles()), 2)
+        with patch('collab_canvas.visual.profiling.remove',
+                   side_effect=FileNotFoundError):
+            with profile('saved', force=True):
+                pass
+
+    def test_staff_header(self):
+        url = self.canvas.get_absolute_url()
+        self.client.force_login(self.canvas.creator)
+        self.assertNotIn('X-Visual-Profile',
+                         self.client.get(url, HTTP_X_VISUAL_PROFILE='1'))
+        self.client.force_login(self.staff)
+        response = self.client.get(url, HTTP_X_VISUAL_PROFILE='1')
+        self.assertEqual([profile['name'] for profile in get_profiles()],
+                         [response['X-Visual-Profile']])
+        self.assertIn('visual_canvas', response['X-Visual-Profile'])
+        self.assertNotIn('X-Visual-Profile',
+                         self.client.get(reverse('home'),
+                                         HTTP_X_VISUAL_PROFILE='1'))
+
+    def test_staff_page(self):
+        with profile('listed', force=True):
+            pass
+        name = get_profiles()[0]['name']
+        list_url = reverse('visual:profiles')
+        profile_url = reverse('visual:profile', kwargs={'name': name})
+        self.client.force_login(self.canvas.creator)
+        self.assertEqual(self.client.get(list_url).status_code, 403)
+        self.assertEqual(self.client.get(profile_url).status_code, 403)
+        self.client.force_login(self.staff)
+        self.assertContains(self.client.get(list_url), profile_url)
+        response = self.client.get(profile_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b''.join(response.streaming_content))
+        self.assertEqual(self.client.get(reverse(
+            'visual:profile', kwargs={'name': '..'})).status_code, 404)
+
+
+class TestConsumerProfiling(ProfileDirMixin, BaseTransactionVisualTest):
+
+    """Test staff can profile the edits a websocket connection saves."""
+
+    def setUp(self):
+        super().setUp()
+        canvas = CanvasFactory()
+        staff = UserFactory(is_staff=True)
+        self.cell = canvas.visual_cells.get(x_position=0, y_position=0)
+        self.cell.artist = staff
+        self.cell.save()
+        self.client.force_login(staff)
+        self.cookie = (
+            f'{settings.SESSION_COOKIE_NAME}='
+            f'{self.client.cookies[settings.SESSION_COOKIE_NAME].value}')
+
+    def tearDown(self):
+        async_to_sync(get_channel_layer().flush)()
+        get_presence().hashes.clear()
+
+    @override_settings(VISUAL_EDIT_FLUSH_INTERVAL=0.5)
+    @async_to_sync
+    async def test_staff_header(self):
+        """Buffered changes are profiled as they're saved on disconnect."""
+        communicator = WebsocketCommunicator(
+            application, f"/canvas/cell/{self.cell.id}/edit/changes",
+            headers=[(b'cookie', self.cookie.encode()),
+                     (b'x-visual-profile', b'1')])
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.send_json_to({'type': 'patch',
+                                         'patch': [['edges_vertical', 4, 1]]})
+        self.assertEqual((await communicator.receive_json_from())['type'],
+                         'ack')
+        await communicator.disconnect()
+        self.assertTrue(get_profiles()[0]['name'].endswith(
+            '-consumer.commit_changes.prof'))
@@ -0,0 +1,65 @@
+from json import dumps
+from uuid import uuid4
+
+from django.test import SimpleTestCase
+
+from ..protocol import (PROTOCOL_VERSION, ProtocolError, decode_frame,
+                        decode_json, encode_frame, encode_json)
+
+
+class TestProtocolFrames(SimpleTestCase):
+
+    """Test binary frames round trip each message type."""
+
+    def setUp(self):
+        self.cell = str(uuid4())
+        self.messages = [
+            {'type': 'patch', 'patch': [['edges_horizontal', 0, 1],
+                                        ['edges_south_west', 8, 2]],
+             'base_edit': 12, 'idempotency_key': 'stroke-1'},
+            {'type': 'patch', 'patch': [['edges_vertical', 11, 0]],
+             'base_edit': None, 'idempotency_key': None},
+            {'type': 'edge', 'cell': self.cell, 'edit': 2**40,
+             'sequence': 2**33, 'direction': 'south', 'edge_name': 'edges_horizontal',
+             'portion': -3, 'values': [1, 0, -1]},
+            {'type': 'ack', 'edit': 7, 'sequence': 12},
+            {'type': 'ack', 'edit': None, 'sequence': None},
+            {'type': 'error', 'errors': ['Stale', 'édge'], 'stale': True},
+            {'type': 'error', 'errors': [], 'retry': True},
+            {'type': 'get_snapshot'},
+            {'type': 'snapshot', 'cell': self.cell, 'edit': 3,
+             'sequence': 4,
+             'edges': {'edges_horizontal': [0]*12, 'edges_vertical': [1]*12,
+                       'edges_south_east': [0]*9, 'edges_south_west': []}},
+        ]
+
+    def test_round_trip(self):
+        for message in self.messages:
+            self.assertEqual(decode_frame(encode_frame(message)), message)
+            self.assertEqual(decode_json(encode_json(message)), message)
+
+    def test_frames_smaller_than_json(self):
+        for message in self.messages:
+            self.assertLess(len(encode_frame(message)),
+                            len(encode_json(message).encode()))
+
+    def test_unsupported_version(self):
+        frame = encode_frame({'type': 'ack', 'edit': 1, 'sequence': 1})
+        with self.assertRaises(ProtocolError):
+            decode_frame(bytes([PROTOCOL_VERSION + 1]) + frame[1:])
+
+    def test_malformed_frames(self):
+        frame = encode_frame(self.messages[2])
+        for malformed in (b'', frame[:-1], frame + b'\x00',
+                          bytes([PROTOCOL_VERSION, 99])):
+            with self.assertRaises(ProtocolError):
+                decode_frame(malformed)
+
+    def test_unencodable_message(self):
+        with self.assertRaises(ProtocolError):
+            encode_frame({'type': 'patch', 'patch': [['edges_up', 0, 1]]})
+
+    def test_malformed_json(self):
+        for text in ('{', '[]', dumps({'type': 'unknown'})):
+            with self.assertRaises(ProtocolError):
+                decode_json(text)
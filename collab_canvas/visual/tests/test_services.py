@@ -0,0 +1,115 @@
+from unittest.mock import patch
+
+from django.db import transaction
+
+from ..models import VisualCanvas, VisualCell, VisualCellEdit
+from ..services import (copy_edits, create_cells, create_edits,
+                        defer_side_effects)
+
+from .utils import BaseTransactionVisualTest, BaseVisualTest, CanvasFactory
+
+
+def get_latest_edges(canvas):
+    return {cell.coordinates: cell.latest_valid_edit.get_edges()
+            for cell in canvas.visual_cells.all()}
+
+
+class TestDeferredSideEffects(BaseVisualTest):
+
+    """Test batched side effects leave the same state as signals."""
+
+    def stroke(self, canvas, index, value=1):
+        """Edit the edge (0, 0) shares with the east cell."""
+        cell = canvas.visual_cells.get(x_position=0, y_position=0)
+        edges = cell.latest_valid_edit.get_edges()
+        edges['edges_vertical'][index] = value
+        return VisualCellEdit(cell=cell, **edges)
+
+    def test_grid_generated_on_exit(self):
+        signalled = CanvasFactory(title='Signalled', slug='signalled')
+        with defer_side_effects():
+            deferred = CanvasFactory(title='Deferred', slug='deferred')
+            self.assertEqual(deferred.visual_cells.count(), 0)
+        self.assertEqual(get_latest_edges(deferred),
+                         get_latest_edges(signalled))
+        self.assertEqual(VisualCanvas.objects.get(id=deferred.id).sequence,
+                         deferred.visual_cells.count())
+
+    def test_dispatched_once_per_cell(self):
+        signalled = CanvasFactory(title='Signalled', slug='signalled')
+        deferred = CanvasFactory(title='Deferred', slug='deferred')
+        for index in (9, 10, 11):
+            self.stroke(signalled, index).save()
+        with patch.object(VisualCell, 'dispatch_neighbour_edits',
+                          autospec=True,
+                          side_effect=VisualCell.dispatch_neighbour_edits
+                          ) as dispatch:
+            with defer_side_effects():
+                for index in (9, 10, 11):
+                    self.stroke(deferred, index).save()
+                dispatch.assert_not_called()
+        dispatch.assert_called_once()
+        self.assertEqual(get_latest_edges(deferred),
+                         get_latest_edges(signalled))
+        east = deferred.visual_cells.get(x_position=1, y_position=0)
+        self.assertEqual(east.latest_valid_edit.edges_vertical[:3],
+                         [1, 1, 1])
+
+    def test_create_edits(self):
+        signalled = CanvasFactory(title='Signalled', slug='signalled')
+        deferred = CanvasFactory(title='Deferred', slug='deferred')
+        for index in (9, 11):
+            self.stroke(signalled, index).save()
+        edits = [self.stroke(deferred, 9)]
+        edits.append(VisualCellEdit(cell=edits[0].cell, **{
+            edge_name: list(edge)
+            for edge_name, edge in edits[0].get_edges().items()}))
+        edits[1].edges_vertical[11] = 1
+        # One commit of both edits, then one dispatch to the east cell
+        with self.assertMaxQueries(17):
+            create_edits(edits)
+        self.assertEqual(edits[0].cell.edits.count(), 3)
+        self.assertEqual(get_latest_edges(deferred),
+                         get_latest_edges(signalled))
+
+    def test_create_cells_copies_neighbour_edges(self):
+        canvas = CanvasFactory(title='Dynamic', grid_width=0, grid_height=0,
+                               new_cells_allowed=True)
+        cell = canvas.choose_initial_cell()
+        edges = cell.latest_valid_edit.get_edges()
+        edges['edges_vertical'][9:] = [1, 0, 1]
+        cell.edits.create(**edges)
+        east, = create_cells([VisualCell(canvas=canvas, x_position=1,
+                                         y_position=0, width=3, height=3)])
+        self.assertEqual(east.latest_valid_edit.edges_vertical[:3],
+                         [1, 0, 1])
+        self.assertEqual(east.edits.count(), 1)
+
+    def test_copy_edits(self):
+        """Copied edits are loaded as given, with no side effects."""
+        canvas = CanvasFactory()
+        cell = canvas.visual_cells.get(x_position=0, y_position=0)
+        edit = self.stroke(canvas, 0)
+        edit.sequence, edit._order = 100, 1
+        edit.edge_sequences = [100]*len(cell.shared_edge_positions)
+        edit.idempotency_key = 'tab\tand\\slash'
+        self.assertEqual(copy_edits([edit], batch_size=1), 1)
+        copied = cell.latest_valid_edit
+        self.assertEqual(copied.get_edges(), edit.get_edges())
+        self.assertEqual(copied.idempotency_key, 'tab\tand\\slash')
+        self.assertEqual(copied.edge_sequences, edit.edge_sequences)
+        self.assertIsNotNone(copied.timestamp)
+        east = canvas.visual_cells.get(x_position=1, y_position=0)
+        self.assertEqual(east.edits.count(), 1)
+
+
+class TestDeferredUntilCommit(BaseTransactionVisualTest):
+
+    """Test side effects can wait for the transaction to commit."""
+
+    def test_grid_generated_after_commit(self):
+        with transaction.atomic():
+            with defer_side_effects(until_commit=True):
+                canvas = CanvasFactory()
+            self.assertEqual(canvas.visual_cells.count(), 0)
+        self.assertEqual(canvas.visual_cells.count(), 4)
@@ -0,0 +1,118 @@
+import json
+from asyncio import ensure_future
+from tempfile import NamedTemporaryFile
+from typing import Dict
+
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+
+from ..tracing import continuation, span, trace
+
+from .utils import (BaseTransactionVisualTest, BaseVisualTest, CanvasFactory,
+                    TEST_USER_PASSWORD)
+
+
+class TracingTestMixin(SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.trace_log = NamedTemporaryFile(suffix='.log')
+        settings_override = override_settings(
+            VISUAL_TRACE_LOG=self.trace_log.name,
+            VISUAL_TRACE_SAMPLE_RATE=1.0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(self.trace_log.close)
+
+    def get_spans(self):
+        with open(self.trace_log.name) as trace_log:
+            return [json.loads(line) for line in trace_log]
+
+
+class TestTracing(TracingTestMixin, BaseVisualTest):
+
+    """Test spans nest, are sampled and join deferred continuations."""
+
+    def test_spans_nest(self):
+        with trace('root', cell='a') as root:
+            with span('child'):
+                pass
+        child, logged_root = self.get_spans()
+        self.assertEqual(logged_root['span'], root.id)
+        self.assertIsNone(logged_root['parent'])
+        self.assertEqual(logged_root['cell'], 'a')
+        self.assertEqual(child['parent'], root.id)
+        self.assertEqual(child['trace'], root.trace_id)
+
+    def test_unsampled(self):
+        with override_settings(VISUAL_TRACE_SAMPLE_RATE=0):
+            with trace('root') as root:
+                with span('child') as child:
+                    self.assertIsNone(root)
+                    self.assertIsNone(child)
+        self.assertEqual(self.get_spans(), [])
+
+    def test_errors_recorded(self):
+        with self.assertRaises(ValueError):
+            with trace('root'):
+                raise ValueError
+        self.assertEqual(self.get_spans()[0]['error'], 'ValueError')
+
+    def test_deferred_continuation(self):
+        with trace('root') as root:
+            callback = continuation(lambda: None, 'later')
+        callback()
+        logged_root, later = self.get_spans()
+        self.assertEqual(later['parent'], root.id)
+        self.assertTrue(later['deferred'])
+        self.assertIs(continuation(print, 'untraced'), print)
+
+    @async_to_sync
+    async def test_async_continuation(self):
+        async def flush():
+            with trace('flush'):
+                pass
+
+        with trace('receive') as root:
+            task = ensure_future(flush())
+        await task
+        logged_root, flush_span = self.get_spans()
+        self.assertEqual(flush_span['parent'], root.id)
+
+
+class TestEditTracing(TracingTestMixin, BaseTransactionVisualTest):
+
+    """Test an edit's stages are traced through to its neighbours."""
+
+    def test_patch_traced(self):
+        canvas = CanvasFactory()
+        cell = canvas.visual_cells.get(x_position=0, y_position=0)
+        cell.artist = canvas.creator
+        cell.save()
+        self.assertTrue(self.client.login(username=canvas.creator.username,
+                                          password=TEST_USER_PASSWORD))
+        response = self.client.post(
+            reverse('visual:cell-edit-patch', kwargs={'cell_id': cell.id}),
+            {'patch': json.dumps([['edges_horizontal', 1, 1]])})
+        self.assertEqual(response.status_code, 201)
+        spans = self.get_spans()
+        self.assertEqual(len({logged['trace'] for logged in spans}), 1)
+        names: Dict[str, dict] = {}
+        for logged in spans:
+            # Spans are logged as they end, so the edit's own commit first
+            names.setdefault(logged['name'], logged)
+        root = names['form_valid']
+        self.assertEqual(root['view'], 'cell-edit-patch')
+        self.assertEqual(names['commit']['parent'], root['span'])
+        self.assertEqual(names['dispatch_neighbour_edits']['parent'],
+                         root['span'])
+        self.assertEqual(names['merge_edge_writes']['parent'],
+                         names['dispatch_neighbour_edits']['span'])
+        merges = {logged['span'] for logged in spans
+                  if logged['name'] == 'merge_edge_writes'}
+        self.assertTrue(merges)
+        self.assertTrue(merges >= {logged['parent'] for logged in spans
+                                   if logged['name'] == 'commit'} - {
+                                       root['span']})
+        self.assertTrue(names['send_canvas_change']['deferred'])
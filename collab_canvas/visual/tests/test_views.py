@@ -1,9 +1,18 @@
+import json
+from typing import List, Tuple, Type
 # from unittest import expectedFailure
+from unittest.mock import patch
 
 # from django.contrib.auth.models import AnonymousUser
 # from django.test import RequestFactory
+from django.db.models import F
 from django.urls import reverse
 
+from ..models import VisualCell
+from ..presence import get_presence
+from ..views import (NonAtomicRequestsMixin, VisualCellEditBatchView,
+                     VisualCellEditPatchView, VisualCellEditView)
+
 from .utils import (BaseVisualTest, CanvasFactory, CellFactory,
                     CellEditFactory, SuperUserFactory, UserFactory,
                     TEST_USER_PASSWORD)
@@ -252,6 +261,19 @@ class TestDynamicVisualCanvasCellEditView(TestDynamicVisualCanvasCellView):
             # Test Cell delta indicates correct changes
             self.assertEqual(latest_edit.get_edges_delta(), self.EDIT_DICT)
 
+    def test_replayed_edit_not_saved_again(self):
+        """Posting an edit twice with an idempotency key saves it once."""
+        login = self.client.login(username=self.cell.artist.username,
+                                  password=TEST_USER_PASSWORD)
+        self.assertTrue(login)
+        data = {**self.EDIT_DICT_STR, 'idempotency_key': 'stroke-1'}
+        for attempt in range(2):
+            response = self.client.post(self.url, data)
+            self.assertEqual(response.url, self.url + 'success/')
+        self.assertEqual(self.cell.edits.count(), 2)
+        response = self.client.get(self.url)
+        self.assertIsNone(response.context['form'].initial['idempotency_key'])
+
     def test_no_initial_valid_cell_changes(self):
         """Test when no valid edits regenerates a new neighbour based blank."""
         latest_edit = self.cell.latest_valid_edit
@@ -335,6 +357,387 @@ class TestDynamicVisualCanvasCellEditValidView(BaseDynamicCanvasTest):
         self.assertEqual(response.status_code, 404)
 
 
+class TestDynamicVisualCanvasCellEditPatchView(BaseDynamicCanvasTest):
+
+    """Test sparse patches of edge changes."""
+
+    def setUp(self):
+        """Add a single cell and log in as its artist."""
+        super().setUp()
+        self.cell = CellFactory(canvas=self.canvas)
+        self.url = reverse('visual:cell-edit-patch',
+                           kwargs={'cell_id': self.cell.id})
+        login = self.client.login(username=self.cell.artist.username,
+                                  password=TEST_USER_PASSWORD)
+        self.assertTrue(login)
+
+    def post_patch(self, patch, **kwargs):
+        return self.client.post(self.url, {'patch': json.dumps(patch),
+                                           **kwargs})
+
+    def test_patch_applied_to_latest_valid_edit(self):
+        """Only patched positions change and the artist is recorded."""
+        base_edit = self.cell.latest_valid_edit
+        response = self.post_patch([['edges_horizontal', 2, 1],
+                                    ['edges_south_west', 8, 1]],
+                                   base_edit=base_edit.id)
+        self.assertEqual(response.status_code, 201)
+        latest_edit = self.cell.latest_valid_edit
+        self.assertEqual(response.json(), {'edit': latest_edit.id})
+        self.assertEqual(latest_edit.artist, self.cell.artist)
+        self.assertEqual(latest_edit.edges_horizontal, [0, 0, 1] + [0]*9)
+        self.assertEqual(latest_edit.edges_south_west, [0]*8 + [1])
+        self.assertEqual(latest_edit.edges_vertical,
+                         base_edit.edges_vertical)
+        self.assertEqual(self.cell.edits.count(), 2)
+
+    def test_stale_base_edit_rejected(self):
+        """A patch drawn against an older edit returns a 409."""
+        base_edit = self.cell.latest_valid_edit
+        self.post_patch([['edges_horizontal', 2, 1]])
+        response = self.post_patch([['edges_horizontal', 3, 1]],
+                                   base_edit=base_edit.id)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.cell.edits.count(), 2)
+
+    def test_invalid_patches_rejected(self):
+        """Malformed patches and out of range changes return a 400."""
+        for invalid_patch in ('not json', [], [['edges_horizontal', 1]],
+                              [['edges_diagonal', 1, 1]],
+                              [['edges_horizontal', 12, 1]],
+                              [['edges_horizontal', 1, 2]]):
+            with self.subTest(patch=invalid_patch):
+                response = self.client.post(self.url, {'patch': (
+                    invalid_patch if isinstance(invalid_patch, str)
+                    else json.dumps(invalid_patch))})
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.cell.edits.count(), 1)
+
+    def test_replayed_patch_not_saved_again(self):
+        """Resubmitting with the same idempotency key returns the original."""
+        base_edit = self.cell.latest_valid_edit
+        first = self.post_patch([['edges_horizontal', 2, 1]],
+                                base_edit=base_edit.id,
+                                idempotency_key='stroke-1')
+        replay = self.post_patch([['edges_horizontal', 2, 1]],
+                                 base_edit=base_edit.id,
+                                 idempotency_key='stroke-1')
+        self.assertEqual(replay.status_code, 201)
+        self.assertEqual(replay.json(), first.json())
+        self.assertEqual(self.cell.edits.count(), 2)
+
+    def test_concurrent_edit_retryable(self):
+        """An edit committed since the cell was loaded returns a 409."""
+        original_commit_edits = VisualCell.commit_edits
+
+        def commit_after_concurrent_edit(cell, *args, **kwargs):
+            VisualCell.objects.filter(pk=cell.pk).update(
+                version=F('version') + 1)
+            return original_commit_edits(cell, *args, **kwargs)
+
+        with patch.object(VisualCell, 'commit_edits',
+                          commit_after_concurrent_edit):
+            response = self.post_patch([['edges_horizontal', 2, 1]])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Retry-After'], '0')
+        self.assertEqual(self.cell.edits.count(), 1)
+
+    def test_non_atomic_requests(self):
+        """Edit views leave transactions to VisualCell.commit_edits."""
+        views: Tuple[Type[NonAtomicRequestsMixin], ...] = (
+            VisualCellEditView, VisualCellEditPatchView,
+            VisualCellEditBatchView)
+        for view in views:
+            with self.subTest(view=view):
+                self.assertIn('default',
+                              view.as_view()._non_atomic_requests)
+
+    def test_other_user_forbidden(self):
+        """Non-artists get a 403 rather than being assigned a cell."""
+        user = UserFactory()
+        login = self.client.login(username=user.username,
+                                  password=TEST_USER_PASSWORD)
+        self.assertTrue(login)
+        response = self.post_patch([['edges_horizontal', 2, 1]])
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(user.visual_cells.count(), 0)
+
+
+class TestGridVisualCanvasCellEditBatchView(BaseVisualTest):
+
+    """Test batches of patches on a 2x2 grid with neighbours."""
+
+    def setUp(self):
+        """Assign the (0, 0) cell and log in as its artist."""
+        super().setUp()
+        self.canvas = CanvasFactory()
+        self.user = UserFactory()
+        self.cell = self.canvas.visual_cells.get(x_position=0, y_position=0)
+        self.cell.artist = self.user
+        self.cell.save()
+        self.north = self.canvas.visual_cells.get(x_position=0, y_position=1)
+        self.url = reverse('visual:cell-edit-batch',
+                           kwargs={'cell_id': self.cell.id})
+        login = self.client.login(username=self.user.username,
+                                  password=TEST_USER_PASSWORD)
+        self.assertTrue(login)
+
+    def post_batch(self, edits, **kwargs):
+        return self.client.post(self.url, {'edits': json.dumps(edits),
+                                           **kwargs})
+
+    def test_batch_keeps_per_edit_history(self):
+        """Each patch is saved in order as its own edit."""
+        base_edit = self.cell.latest_valid_edit
+        response = self.post_batch([[['edges_horizontal', 0, 1]],
+                                    [['edges_horizontal', 1, 1]],
+                                    [['edges_horizontal', 0, 0]]],
+                                   base_edit=base_edit.id)
+        self.assertEqual(response.status_code, 201)
+        edits = list(self.cell.edits.all())
+        self.assertEqual(response.json(),
+                         {'edits': [edit.id for edit in edits[-3:]]})
+        self.assertEqual([edit.edges_horizontal[:3] for edit in edits],
+                         [[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0]])
+        self.assertEqual(self.cell.latest_valid_edit, edits[-1])
+        self.assertEqual(edits[-1].history_number, 3)
+        self.assertTrue(all(edit.artist == self.user for edit in edits[1:]))
+
+    def test_batch_propagates_net_change_once(self):
+        """Neighbours get one edit for the net change of the batch."""
+        neighbour_edit_count = self.north.edits.count()
+        response = self.post_batch([[['edges_horizontal', 0, 1]],
+                                    [['edges_horizontal', 1, 1]],
+                                    [['edges_horizontal', 0, 0]]])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.north.edits.count(), neighbour_edit_count + 1)
+        self.assertEqual(
+            self.north.latest_valid_edit.edges_horizontal[-3:], [0, 1, 0])
+
+    def test_neighbour_conflicts_still_merged(self):
+        """A neighbour losing every version check is merged under lock."""
+        edit_count = self.cell.edits.count()
+        commit_edits = VisualCell.commit_edits
+        conflicts: List[int] = []
+
+        def commit_conflicting_edits(cell, *args, **kwargs):
+            if (cell.id == self.north.id and
+                    len(conflicts) < VisualCell.NEIGHBOUR_EDIT_ATTEMPTS):
+                conflicts.append(cell.version)
+                VisualCell.objects.filter(pk=cell.pk).update(
+                    version=F('version') + 1)
+            return commit_edits(cell, *args, **kwargs)
+
+        with patch.object(VisualCell, 'commit_edits', autospec=True,
+                          side_effect=commit_conflicting_edits):
+            response = self.post_batch([[['edges_horizontal', 0, 1]]])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(conflicts), VisualCell.NEIGHBOUR_EDIT_ATTEMPTS)
+        self.assertEqual(self.cell.edits.count(), edit_count + 1)
+        self.assertEqual(
+            self.north.latest_valid_edit.edges_horizontal[-3:],
+            self.cell.latest_valid_edit.edges_horizontal[:3])
+        self.assertEqual(
+            self.north.latest_valid_edit.edges_horizontal[-3:], [1, 0, 0])
+
+    def test_replayed_batch_not_saved_again(self):
+        """A retried batch returns the original edits without propagating."""
+        edits = [[['edges_horizontal', 0, 1]], [['edges_horizontal', 1, 1]]]
+        keys = json.dumps(['stroke-1', 'stroke-2'])
+        first = self.post_batch(edits, idempotency_keys=keys)
+        edit_count = self.cell.edits.count()
+        neighbour_edit_count = self.north.edits.count()
+        replay = self.post_batch(edits, idempotency_keys=keys)
+        self.assertEqual(replay.status_code, 201)
+        self.assertEqual(replay.json(), first.json())
+        self.assertEqual(self.cell.edits.count(), edit_count)
+        self.assertEqual(self.north.edits.count(), neighbour_edit_count)
+
+    def test_mismatched_idempotency_keys_rejected(self):
+        """Keys must be unique, one per edit and not reused across batches."""
+        edits = [[['edges_horizontal', 0, 1]], [['edges_horizontal', 1, 1]]]
+        self.post_batch(edits[:1], idempotency_keys='["stroke-1"]')
+        for keys in ('["stroke-2"]', '["stroke-2", "stroke-2"]',
+                     '["stroke-1", "stroke-2"]'):
+            with self.subTest(keys=keys):
+                response = self.post_batch(edits, idempotency_keys=keys)
+                self.assertEqual(response.status_code, 400)
+
+    def test_invalid_batch_saves_nothing(self):
+        """One invalid patch rejects the whole batch."""
+        edit_count = self.cell.edits.count()
+        response = self.post_batch([[['edges_horizontal', 0, 1]],
+                                    [['edges_horizontal', 99, 1]]])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.cell.edits.count(), edit_count)
+
+    def test_stale_base_edit_rejected(self):
+        """A batch drawn against an older edit returns a 409."""
+        base_edit = self.cell.latest_valid_edit
+        self.post_batch([[['edges_horizontal', 0, 1]]])
+        response = self.post_batch([[['edges_horizontal', 1, 1]]],
+                                   base_edit=base_edit.id)
+        self.assertEqual(response.status_code, 409)
+
+
+class TestGridVisualCanvasCellEditView(BaseVisualTest):
+
+    """Test full form edits on a 2x2 grid with neighbours."""
+
+    def setUp(self):
+        """Assign the (0, 0) cell and log in as its artist."""
+        super().setUp()
+        self.canvas = CanvasFactory()
+        self.user = UserFactory()
+        self.cell = self.canvas.visual_cells.get(x_position=0, y_position=0)
+        self.cell.artist = self.user
+        self.cell.save()
+        self.north = self.canvas.visual_cells.get(x_position=0, y_position=1)
+        self.url = reverse('visual:cell-edit',
+                           kwargs={'cell_id': self.cell.id})
+        login = self.client.login(username=self.user.username,
+                                  password=TEST_USER_PASSWORD)
+        self.assertTrue(login)
+
+    def test_edit_propagates_over_newer_neighbour_write(self):
+        """A form edit wins shared positions the neighbour last wrote."""
+        self.north.apply_edit_patch([('edges_horizontal', 10, 1)])
+        edges = self.cell.latest_valid_edit.get_edges()
+        self.assertEqual(edges['edges_horizontal'][1], 1)
+        edges['edges_horizontal'][1] = 0
+        response = self.client.post(self.url, {
+            edge_name: str(edge).strip('[]')
+            for edge_name, edge in edges.items()})
+        self.assertEqual(response.url, self.url + 'success/')
+        latest_edit = self.cell.latest_valid_edit
+        self.assertEqual(latest_edit.edges_horizontal[1], 0)
+        self.assertEqual(latest_edit.get_edge_sequences()[
+            ('edges_horizontal', 1)], latest_edit.sequence)
+        self.assertEqual(self.north.latest_valid_edit.edges_horizontal[10],
+                         0)
+
+
+class TestGridVisualCanvasChangesView(BaseVisualTest):
+
+    """Test catching up on canvas changes after a sequence number."""
+
+    def setUp(self):
+        """Assign the (0, 0) cell of a 2x2 grid and log in as its artist."""
+        super().setUp()
+        self.canvas = CanvasFactory()
+        self.user = UserFactory()
+        self.cell = self.canvas.visual_cells.get(x_position=0, y_position=0)
+        self.cell.artist = self.user
+        self.cell.save()
+        self.url = reverse('visual:canvas-changes',
+                           kwargs={'canvas_id': self.canvas.id})
+
+    def login(self, user):
+        self.assertTrue(self.client.login(username=user.username,
+                                          password=TEST_USER_PASSWORD))
+
+    def test_artist_gets_changes(self):
+        self.login(self.user)
+        edit = self.cell.apply_edit_patch([('edges_horizontal', 0, 1)])
+        response = self.client.get(self.url, {'after': edit.sequence - 1,
+                                              'cells': str(self.cell.id)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['cells'],
+                         [{'cell': str(self.cell.id), 'edit': edit.id,
+                           'sequence': edit.sequence,
+                           'patch': [['edges_horizontal', 0, 1]]}])
+
+    def test_invalid_parameters(self):
+        self.login(self.user)
+        for parameters in ({}, {'after': -1},
+                           {'after': 0, 'cells': 'not-a-uuid'}):
+            response = self.client.get(self.url, parameters)
+            self.assertEqual(response.status_code, 400)
+
+    def test_other_user_forbidden(self):
+        self.login(UserFactory())
+        response = self.client.get(self.url, {'after': 0})
+        self.assertEqual(response.status_code, 403)
+
+    def test_artist_gets_presence(self):
+        self.login(self.user)
+        get_presence().join(self.canvas.id, self.cell.id, 'channel-1',
+                            self.user)
+        self.addCleanup(get_presence().leave, self.canvas.id, self.cell.id,
+                        'channel-1')
+        response = self.client.get(reverse(
+            'visual:canvas-presence', kwargs={'canvas_id': self.canvas.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(value['cell'], value['user']) for value in
+             response.json()['presence']],
+            [(str(self.cell.id), str(self.user.id))])
+
+
+class TestVisualViewQueryCeilings(BaseDynamicCanvasTest):
+
+    """
+    Measured query ceilings for visual views.
+
+    Each request includes a savepoint pair plus session and user lookups, so
+    ceilings are the view's own queries + 4.
+    """
+
+    CANVAS_CEILING = 5
+    CELL_CEILING = 5
+    CELL_EDIT_CEILING = 6
+
+    def setUp(self):
+        """Add a single cell and log in as its artist."""
+        super().setUp()
+        self.cell = CellFactory(canvas=self.canvas)
+
+    def login(self, user):
+        self.assertTrue(self.client.login(username=user.username,
+                                          password=TEST_USER_PASSWORD))
+
+    def test_canvas_creator_view(self):
+        """Canvas and creator are fetched in one query."""
+        self.login(self.canvas.creator)
+        self.canvas.creator.is_superuser = False
+        self.canvas.creator.save()
+        with self.assertMaxQueries(self.CANVAS_CEILING):
+            response = self.client.get(self.canvas.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+
+    def test_cell_creator_view(self):
+        """Cell, canvas and creator are fetched in one query."""
+        self.login(self.canvas.creator)
+        self.canvas.creator.is_superuser = False
+        self.canvas.creator.save()
+        with self.assertMaxQueries(self.CELL_CEILING):
+            response = self.client.get(self.cell.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+
+    def test_cell_artist_redirect(self):
+        """Redirecting an artist to their edit view needs no extra queries."""
+        self.login(self.cell.artist)
+        with self.assertMaxQueries(self.CELL_CEILING):
+            response = self.client.get(self.cell.get_absolute_url())
+        self.assertEqual(response.url, self.cell.get_edit_url())
+
+    def test_cell_edit_artist_view(self):
+        """Permission checks and rendering share one cell query."""
+        self.login(self.cell.artist)
+        with self.assertMaxQueries(self.CELL_EDIT_CEILING):
+            response = self.client.get(self.cell.get_edit_url())
+        self.assertEqual(response.status_code, 200)
+
+    def test_cell_edit_creator_view(self):
+        """Creator permission comes from the select_related canvas."""
+        self.login(self.canvas.creator)
+        self.canvas.creator.is_superuser = False
+        self.canvas.creator.save()
+        with self.assertMaxQueries(self.CELL_EDIT_CEILING):
+            response = self.client.get(self.cell.get_edit_url())
+        self.assertEqual(response.status_code, 200)
+
+
 # class TestDynamicVisualCanvasCellEditHistoryView(BaseDynamicCanvasTest):
 #
 #     """Test CanvasCellView manages to show cells adhering to permission."""
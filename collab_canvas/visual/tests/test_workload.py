@@ -0,0 +1,72 @@
+from django.contrib.auth import get_user_model
+from django.db.models import Max
+
+from ..models import VisualCanvas, VisualCell, VisualCellEdit
+from ..workload import WorkloadError, delete_workload, generate_workload
+from .utils import BaseVisualTest
+
+
+class TestWorkload(BaseVisualTest):
+
+    """Test generated workloads load as if edited through the models."""
+
+    def assertConsistent(self, results):
+        canvas = VisualCanvas.objects.get(id=results['canvas'])
+        edits = VisualCellEdit.objects.filter(cell__canvas=canvas)
+        self.assertEqual(edits.count(), results['edits'])
+        self.assertEqual(edits.aggregate(Max('sequence'))['sequence__max'],
+                         canvas.sequence)
+        self.assertEqual(edits.values('sequence').distinct().count(),
+                         results['edits'])
+        self.assertEqual(edits.filter(neighbour_edit__isnull=False).count(),
+                         results['neighbour_edits'])
+        cells = canvas.visual_cells.all()
+        self.assertEqual(cells.exclude(artist=None).count(),
+                         results['artists'])
+        for cell in cells:
+            self.assertEqual(cell.edits.count(), cell.version + 1)
+            latest_edit = cell.latest_valid_edit
+            for direction, neighbour in cell.get_neighbours(
+                    neighbour_coords=VisualCell.ADJACENT_COORDINATES
+            ).items():
+                neighbour_edit = neighbour.latest_valid_edit
+                for (edge_name, index), boundary in (
+                        cell.geometry.boundary.items()):
+                    for boundary_direction, _, neighbour_index in boundary:
+                        if boundary_direction == direction:
+                            self.assertEqual(
+                                getattr(latest_edit, edge_name)[index],
+                                getattr(neighbour_edit, edge_name)[
+                                    neighbour_index])
+        return canvas
+
+    def test_shapes(self):
+        for shape in ('grid', 'torus', 'organic'):
+            results = generate_workload(shape, artists=9, edits=10,
+                                        cell_size=3, stroke_length=2,
+                                        lengths='uniform', activity='pareto',
+                                        seed=1)
+            self.assertEqual(results['cells'], 9)
+            self.assertGreater(results['neighbour_edits'], 0)
+            canvas = self.assertConsistent(results)
+            self.assertEqual(canvas.is_torus, shape == 'torus')
+
+    def test_editable_and_deleted(self):
+        results = generate_workload('grid', artists=3, edits=5, seed=2)
+        self.assertEqual(results['cells'], 4)
+        canvas = VisualCanvas.objects.get(id=results['canvas'])
+        cell = canvas.visual_cells.exclude(artist=None).first()
+        version = cell.version
+        edit = cell.apply_edit_patch([('edges_horizontal', 0, 1),
+                                      ('edges_horizontal', 1, 0)])
+        self.assertEqual(edit.sequence, canvas.sequence + 1)
+        self.assertEqual(cell.version, version + 1)
+        delete_workload(results['run'])
+        self.assertFalse(VisualCanvas.objects.filter(
+            id=results['canvas']).exists())
+        self.assertFalse(get_user_model().objects.filter(
+            username__startswith='workload-').exists())
+
+    def test_too_many_artists(self):
+        with self.assertRaises(WorkloadError):
+            generate_workload('torus', artists=10, grid_size=3)
@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 from datetime import timedelta
 
 from factory import (LazyAttribute, LazyFunction, PostGenerationMethodCall,
@@ -9,7 +10,9 @@ import pytest
 from random import seed
 
 from django.core import serializers
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from config.settings.base import AUTH_USER_MODEL
@@ -151,15 +154,31 @@ class BaseVisualTest(TestCase):
         UserFactory.reset_sequence()
         seed(3141592)
 
+    @contextmanager
+    def assertMaxQueries(self, ceiling: int):
+        """Fail if the wrapped block runs more than ceiling queries."""
+        with CaptureQueriesContext(connection) as context:
+            yield context
+        self.assertLessEqual(
+            len(context.captured_queries), ceiling,
+            f"{len(context.captured_queries)} queries exceeds ceiling of "
+            f"{ceiling}:\n" +
+            "\n".join(query['sql'] for query in context.captured_queries))
 
-# @pytest.mark.django_db
-# class BaseTransactionVisualTest(TestCase):
-#
-#     """Base inheritable class which can also handle transactions/rollbacks."""
-#
-#     def setUp(self):
-#         self.anonymous_user = AnonymousUser()
-#         self.requests = RequestFactory
+
+@pytest.mark.django_db(transaction=True)
+class BaseTransactionVisualTest(TransactionTestCase):
+
+    """
+    Base inheritable class which can also handle transactions/rollbacks.
+
+    Needed where queries run in other threads, such as consumers via
+    database_sync_to_async, and so can't see a TestCase transaction.
+    """
+
+    def setUp(self):
+        UserFactory.reset_sequence()
+        seed(3141592)
 
 
 def dump_data(query_sets, file_format="json", indent=2):
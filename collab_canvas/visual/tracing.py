@@ -0,0 +1,116 @@
+"""
+Sampled spans timing each stage of an edit, written to a local trace log.
+
+An edit starts a trace (trace) in the view or consumer receiving it, kept
+for VISUAL_TRACE_SAMPLE_RATE of edits. Stages it passes through open child
+spans (span), which cost nothing outside a sampled trace. The current span
+is a context variable, so it follows database_sync_to_async calls and
+tasks started while it is open, such as a consumer's delayed flush.
+Callbacks run later, e.g. transaction.on_commit, are wrapped with
+continuation to join the trace that scheduled them.
+
+Each span is appended to VISUAL_TRACE_LOG as a JSON line once it ends:
+
+    {"trace": id, "span": id, "parent": id or null, "name": stage,
+     "start": epoch seconds, "duration": seconds, ...attributes}
+
+so continuations ending after their parent are still logged, and a trace
+is every line with its id.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from json import dumps
+from random import random
+from threading import Lock
+from time import perf_counter, time
+from typing import Optional
+from uuid import uuid4
+
+from django.conf import settings
+
+_current_span: 'ContextVar[Optional[Span]]' = ContextVar(
+    'visual_trace_span', default=None)
+_log_lock = Lock()
+
+
+class Span:
+
+    """A timed stage of a trace."""
+
+    def __init__(self, trace_id: str, name: str, parent: 'Span' = None,
+                 **attributes):
+        self.trace_id = trace_id
+        self.id = uuid4().hex[:16]
+        self.name = name
+        self.parent_id = parent.id if parent else None
+        self.attributes = attributes
+
+    def get_record(self, start: float, duration: float) -> dict:
+        return {'trace': self.trace_id, 'span': self.id,
+                'parent': self.parent_id, 'name': self.name, 'start': start,
+                'duration': duration, **self.attributes}
+
+
+def get_current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def write_span(record: dict):
+    with _log_lock:
+        with open(settings.VISUAL_TRACE_LOG, 'a') as trace_log:
+            trace_log.write(dumps(record, default=str) + '\n')
+
+
+@contextmanager
+def _enter(current: Span):
+    token = _current_span.set(current)
+    start, started = time(), perf_counter()
+    try:
+        yield current
+    except Exception as error:
+        current.attributes['error'] = type(error).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        write_span(current.get_record(start, perf_counter() - started))
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Time a stage of the current trace, if one is being sampled."""
+    parent = get_current_span()
+    if parent is None:
+        yield None
+        return
+    with _enter(Span(parent.trace_id, name, parent, **attributes)) as current:
+        yield current
+
+
+@contextmanager
+def trace(name: str, **attributes):
+    """Start a sampled trace, or a span of the current one."""
+    if get_current_span() is not None:
+        with span(name, **attributes) as current:
+            yield current
+    elif random() < settings.VISUAL_TRACE_SAMPLE_RATE:
+        with _enter(Span(uuid4().hex, name, **attributes)) as current:
+            yield current
+    else:
+        yield None
+
+
+def continuation(function, name: str, **attributes):
+    """Wrap a deferred callback to run as a span of the current trace."""
+    parent = get_current_span()
+    if parent is None:
+        return function
+
+    def traced_continuation(*args, **kwargs):
+        token = _current_span.set(parent)
+        try:
+            with span(name, deferred=True, **attributes):
+                return function(*args, **kwargs)
+        finally:
+            _current_span.reset(token)
+
+    return traced_continuation
@@ -10,9 +10,13 @@ Todo:
 """
 from django.urls import path
 
-from .views import (VisualCanvasView, VisualCellView, VisualCellValidEditView,
-                    VisualCellEditHistoryView, VisualCellEditView,
-                    VisualCellEditSuccessView)
+from .views import (VisualCanvasView, VisualCanvasChangesView,
+                    VisualCanvasPresenceView, VisualCellView,
+                    VisualCellValidEditView, VisualCellEditHistoryView,
+                    VisualCellEditView, VisualCellEditPatchView, VisualCellEditBatchView,
+                    VisualCellEditSuccessView, VisualInstrumentationView,
+                    VisualMetricsView, VisualProfileListView,
+                    VisualProfileView)
 
 
 app_name = "visual"  # Required for naming urls
@@ -27,6 +31,10 @@ urlpatterns = [
 
     # These should only be visible to managers
     path("canvas/<uuid:canvas_id>/", VisualCanvasView.as_view(), name="canvas"),
+    path("canvas/<uuid:canvas_id>/changes/", VisualCanvasChangesView.as_view(),
+         name="canvas-changes"),
+    path("canvas/<uuid:canvas_id>/presence/",
+         VisualCanvasPresenceView.as_view(), name="canvas-presence"),
     # possibly the one view for participants
     path("canvas/cell/<uuid:cell_id>/", VisualCellView.as_view(), name="cell"),
     # the rest only for managers
@@ -39,7 +47,18 @@ urlpatterns = [
     path("canvas/cell/<uuid:cell_id>/edit/",
          VisualCellEditView.as_view(),
          name="cell-edit"),
+    path("canvas/cell/<uuid:cell_id>/edit/patch/",
+         VisualCellEditPatchView.as_view(),
+         name="cell-edit-patch"),
+    path("canvas/cell/<uuid:cell_id>/edit/batch/",
+         VisualCellEditBatchView.as_view(),
+         name="cell-edit-batch"),
     path("canvas/cell/<uuid:cell_id>/edit/success/",
          VisualCellEditSuccessView.as_view(),
          name="cell-edit-success"),
+    path("instrumentation/", VisualInstrumentationView.as_view(),
+         name="instrumentation"),
+    path("metrics/", VisualMetricsView.as_view(), name="metrics"),
+    path("profiles/", VisualProfileListView.as_view(), name="profiles"),
+    path("profiles/<str:name>", VisualProfileView.as_view(), name="profile"),
 ]
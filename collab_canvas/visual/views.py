@@ -4,15 +4,93 @@ Structure views for creating, observing, and editing canvases.
 A basic structure for viewing different sections of visual canvases, dependent
 in part on permissions.
 """
+from os.path import join
+from typing import Tuple
+
+from django.conf import settings
 from django.contrib.auth.mixins import UserPassesTestMixin
-from django.http import Http404
-from django.views.generic import UpdateView, DetailView, TemplateView
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Count
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
+from django.views.generic import (UpdateView, DetailView, FormView,
+                                  TemplateView, View)
+from django.views.generic.detail import SingleObjectMixin
 from django.shortcuts import get_object_or_404, redirect, reverse
+from django.utils.crypto import constant_time_compare
+
+from collab_canvas.taskapp.celery import app as celery_app
 
+from . import metrics
+from .capture import CaptureEditMixin
+from .forms import (VisualCanvasChangesForm, VisualCellEditBatchForm,
+                    VisualCellEditPatchForm)
+from .instrumentation import get_rolling_stats
 from .models import VisualCanvas, VisualCell, VisualCellEdit
+from .presence import get_presence
+from .profiling import get_profiles
+from .tracing import trace
+
+
+class NonAtomicRequestsMixin(View):
+
+    """
+    Opt out of ATOMIC_REQUESTS so transactions only wrap edit commits.
+
+    Otherwise rendering and neighbour propagation hold a transaction open
+    for the whole request, see VisualCell.commit_edits.
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return transaction.non_atomic_requests(super().as_view(**initkwargs))
+
+
+class StaffRequiredMixin(UserPassesTestMixin):
+
+    """Only let staff see a view."""
+
+    raise_exception = True
+
+    def test_func(self):
+        return self.request.user.is_staff
+
 
+class RequestCachedObjectMixin(SingleObjectMixin):
 
-class VisualCanvasView(UserPassesTestMixin, DetailView):
+    """
+    Query a view's object once per request, including related models.
+
+    ``test_func``, ``dispatch`` and ``get`` all call ``get_object``, so without
+    caching each permission check re-queries the object and lazily loads
+    related models (e.g. ``cell.canvas.creator``) again.
+    """
+
+    select_related: Tuple[str, ...] = ()
+
+    def get_queryset(self):
+        """Join related models needed for permission checks and rendering."""
+        return super().get_queryset().select_related(*self.select_related)
+
+    def get_object(self, queryset=None):
+        """Return the object cached on the view instance when possible."""
+        if queryset is not None:
+            return super().get_object(queryset)
+        if not hasattr(self, '_cached_object'):
+            self._cached_object = super().get_object()
+        return self._cached_object
+
+
+def concurrent_edit_response(error):
+    """Conflict response for an edit that may be retried immediately."""
+    response = JsonResponse({'errors': {'version': [str(error)]}},
+                            status=409)
+    response['Retry-After'] = 0
+    return response
+
+
+class VisualCanvasView(NonAtomicRequestsMixin, RequestCachedObjectMixin,
+                       UserPassesTestMixin, DetailView):
 
     """Presents a visual canvas for collaboration."""
 
@@ -22,6 +100,7 @@ class VisualCanvasView(UserPassesTestMixin, DetailView):
     permission_denied_message = ('only administators and the canvas creator may '
                                  'view this canvases')
     pk_url_kwarg = 'canvas_id'
+    select_related = ('creator',)
 
     def test_func(self):
         """Check if user has access to viewing the canvas."""
@@ -39,7 +118,53 @@ class VisualCanvasView(UserPassesTestMixin, DetailView):
         return super().dispatch(request, *args, **kwargs)
 
 
-class VisualCellView(UserPassesTestMixin, DetailView):
+class VisualCanvasChangesView(NonAtomicRequestsMixin, RequestCachedObjectMixin,
+                              UserPassesTestMixin, DetailView):
+
+    """
+    Changes to a canvas after a sequence number, for clients to catch up.
+
+    See VisualCanvas.get_changes_since for the JSON returned.
+    """
+
+    model = VisualCanvas
+    permission_denied_message = ('only administators, the canvas creator and '
+                                 'its artists may follow canvas changes')
+    pk_url_kwarg = 'canvas_id'
+    http_method_names = ['get']
+    raise_exception = True
+
+    def test_func(self):
+        """Check if user is an administrator, the creator or an artist."""
+        user = self.request.user
+        if not user.is_authenticated:
+            return False
+        canvas = self.get_object()
+        return (user.is_superuser or user == canvas.creator or
+                canvas.visual_cells.filter(artist=user).exists())
+
+    def get(self, request, *args, **kwargs):
+        form = VisualCanvasChangesForm(request.GET)
+        if not form.is_valid():
+            return JsonResponse({'errors': form.errors}, status=400)
+        return JsonResponse(self.get_object().get_changes_since(
+            form.cleaned_data['after'], form.cleaned_data['cells']))
+
+
+class VisualCanvasPresenceView(VisualCanvasChangesView):
+
+    """Who is connected to which cells of a canvas (see presence)."""
+
+    permission_denied_message = ('only administators, the canvas creator and '
+                                 'its artists may see who is drawing')
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse({'presence': get_presence().get_canvas_presence(
+            self.get_object().id)})
+
+
+class VisualCellView(NonAtomicRequestsMixin, RequestCachedObjectMixin,
+                     UserPassesTestMixin, DetailView):
 
     """Shows a cell or assigns ownership to a pre-existing one."""
 
@@ -50,6 +175,7 @@ class VisualCellView(UserPassesTestMixin, DetailView):
     permission_denied_message = ('only administators, the canvas creator and '
                                  'the cell artist may view this cell')
     pk_url_kwarg = 'cell_id'
+    select_related = ('canvas__creator', 'artist')
 
     def dispatch(self, request, *args, **kwargs):
         """Show cell or forward if not passing test_func."""
@@ -77,7 +203,8 @@ class VisualCellView(UserPassesTestMixin, DetailView):
         return False
 
 
-class VisualCellEditHistoryView(UserPassesTestMixin, DetailView):
+class VisualCellEditHistoryView(NonAtomicRequestsMixin, UserPassesTestMixin,
+                                DetailView):
 
     """View a saved edit of an assigned cell."""
 
@@ -94,13 +221,23 @@ class VisualCellEditHistoryView(UserPassesTestMixin, DetailView):
         queryset = super().get_queryset()
         return queryset.filter(cell__pk=self.kwargs.get('cell_id'))
 
+    def get_numbered_object(self, queryset, number: int):
+        """
+        The edit number places into the cell's order, in one query.
+
+        See VisualCellEdit.history_number and edit_number, which number
+        edits the same way.
+        """
+        try:
+            return queryset.order_by('_order')[number]
+        except IndexError:
+            raise Http404()
+
     def get_object(self, queryset=None):
         if queryset is None:
             queryset = self.get_queryset()
-        for cell_edit in queryset:
-            if cell_edit.history_number is self.kwargs.get('cell_history'):
-                return cell_edit
-        raise Http404()
+        return self.get_numbered_object(queryset,
+                                        self.kwargs.get('cell_history'))
 
 
 class VisualCellValidEditView(VisualCellEditHistoryView):
@@ -110,13 +247,34 @@ class VisualCellValidEditView(VisualCellEditHistoryView):
     def get_object(self, queryset=None):
         if queryset is None:
             queryset = self.get_queryset()
-        for cell_edit in queryset:
-            if cell_edit.edit_number is self.kwargs.get('edit_number'):
-                return cell_edit
-        raise Http404()
+        return self.get_numbered_object(queryset.filter(is_valid=True),
+                                        self.kwargs.get('edit_number'))
+
+
+class VisualCellEditPermissionMixin(UserPassesTestMixin):
+
+    """Restrict editing a cell to administrators, its artist and creator."""
+
+    permission_denied_message = ('only administators, the canvas creator and '
+                                 'cell owner can edit a cell')
+
+    def _get_cell(self, pk_url_kwarg: str = 'cell_id'):
+        """Query for parent cell, canvas and creator once per request."""
+        self.cell = get_object_or_404(
+            VisualCell.objects.select_related('canvas__creator', 'artist'),
+            pk=self.kwargs.get(pk_url_kwarg))
+
+    def test_func(self):
+        """Check if user has access to edit the cell."""
+        if self.request.user.is_authenticated:
+            if not hasattr(self, 'cell'):
+                self._get_cell()
+            return self.cell.user_may_edit(self.request.user)
+        return False
 
 
-class VisualCellEditView(UserPassesTestMixin, UpdateView):
+class VisualCellEditView(NonAtomicRequestsMixin, VisualCellEditPermissionMixin,
+                         CaptureEditMixin, UpdateView):
 
     """
     Core view for collaborative cell editing.
@@ -132,15 +290,8 @@ class VisualCellEditView(UserPassesTestMixin, UpdateView):
     model = VisualCellEdit
     # form = VisualCellEditForm
 
-    permission_denied_message = ('only administators, the canvas creator and '
-                                 'cell owner can edit a cell')
     context_object_name = 'visual_cell_edit'
-    fields = VisualCellEdit.get_edge_names()
-
-    def _get_cell(self, pk_url_kwarg: str = 'cell_id'):
-        """Query for parent cell."""
-        self.cell = get_object_or_404(VisualCell,
-                                      pk=self.kwargs.get(pk_url_kwarg))
+    fields = VisualCellEdit.get_edge_names() + ['idempotency_key']
 
     def _get_latest_valid_edit(self):
         """Query for latest_valid_edit, generating a new one if necessary."""
@@ -154,24 +305,11 @@ class VisualCellEditView(UserPassesTestMixin, UpdateView):
             # it is autogenerated, not the artist's creative choice
             self.latest_valid_edit = self.cell.edits.create(**edges)
 
-    def test_func(self):
-        """Check if user has access to edit the cell."""
-        user = self.request.user
-        if user.is_authenticated:
-            if not hasattr(self, 'cell'):
-                self._get_cell()
-            # Todo: cache these queries for efficiency
-            return (user.is_superuser or
-                    user == self.cell.artist or
-                    user == self.cell.canvas.creator)
-        return False
-
     def dispatch(self, request, *args, **kwargs):
         """Show cell or forward if not passing test_func."""
         user_test_result = self.get_test_func()()
         if not user_test_result:
             if request.user.is_authenticated:
-                # Todo: Check this for efficiency
                 if not hasattr(self, 'cell'):
                     self._get_cell()
                 cell = self.cell.canvas.get_or_assign_cell(request.user)
@@ -180,9 +318,25 @@ class VisualCellEditView(UserPassesTestMixin, UpdateView):
                 return self.handle_no_permission()
         return super().dispatch(request, *args, **kwargs)
 
+    @trace('form_valid', view='cell-edit')
     def form_valid(self, form):
         form.instance.artist = self.request.user
-        return super().form_valid(form)
+        idempotency_key = form.cleaned_data.get('idempotency_key')
+        committed_edits = (self.cell.get_idempotent_edits([idempotency_key])
+                           if idempotency_key else None)
+        if committed_edits:
+            # A retried submission, so return the original without writing
+            self.object = committed_edits[0]
+            return redirect(self.get_success_url())
+        try:
+            self.object = self.cell.commit_edits([form.instance])[0]
+        except VisualCell.ConcurrentEditException as error:
+            form.add_error(None, str(error))
+            response = self.render_to_response(
+                self.get_context_data(form=form), status=409)
+            response['Retry-After'] = 0
+            return response
+        return redirect(self.get_success_url())
 
     def form_invalid(self, form):
         assert False
@@ -196,6 +350,10 @@ class VisualCellEditView(UserPassesTestMixin, UpdateView):
             self.latest_valid_edit = self.cell.edits.create(**initial_edges)
         new_edit = self.latest_valid_edit
         new_edit.id = None
+        new_edit.neighbour_edit = None  # The artist's own edit, not copied
+        new_edit.idempotency_key = None
+        # Recorded afresh on commit, so changed positions win over neighbours
+        new_edit.edge_sequences = []
         return new_edit
 
     def get_success_url(self):
@@ -204,8 +362,142 @@ class VisualCellEditView(UserPassesTestMixin, UpdateView):
                        kwargs={'cell_id': self.object.cell.id})
 
 
+class VisualCellEditPatchView(NonAtomicRequestsMixin,
+                              VisualCellEditPermissionMixin, CaptureEditMixin,
+                              FormView):
+
+    """
+    Apply a sparse patch of edge changes to the latest valid cell edit.
+
+    Rather than posting every edge array, clients post only the changed
+    [edge_name, index, value] triples, optionally with the base_edit id they
+    were drawn against. Responses are JSON, with 409 for stale base edits.
+    """
+
+    form_class = VisualCellEditPatchForm
+    http_method_names = ['post']
+    raise_exception = True
+
+    @trace('form_valid', view='cell-edit-patch')
+    def form_valid(self, form):
+        try:
+            edit = self.cell.apply_edit_patch(
+                form.cleaned_data['patch'], artist=self.request.user,
+                base_edit_id=form.cleaned_data['base_edit'],
+                idempotency_key=form.cleaned_data['idempotency_key'])
+        except VisualCell.StaleEditException as error:
+            return JsonResponse({'errors': {'base_edit': [str(error)]}},
+                                status=409)
+        except VisualCell.ConcurrentEditException as error:
+            return concurrent_edit_response(error)
+        except ValidationError as error:
+            return JsonResponse({'errors': {'patch': error.messages}},
+                                status=400)
+        return JsonResponse({'edit': edit.id}, status=201)
+
+    def form_invalid(self, form):
+        return JsonResponse({'errors': form.errors}, status=400)
+
+
+class VisualCellEditBatchView(VisualCellEditPatchView):
+
+    """
+    Apply an ordered batch of patches to a cell, e.g. buffered offline.
+
+    The whole batch is validated before saving, each patch is kept as its
+    own edit in history and neighbours are updated once for the net change.
+    """
+
+    form_class = VisualCellEditBatchForm
+
+    @trace('form_valid', view='cell-edit-batch')
+    def form_valid(self, form):
+        try:
+            edits = self.cell.apply_edit_patches(
+                form.cleaned_data['edits'], artist=self.request.user,
+                base_edit_id=form.cleaned_data['base_edit'],
+                idempotency_keys=form.cleaned_data['idempotency_keys'])
+        except VisualCell.StaleEditException as error:
+            return JsonResponse({'errors': {'base_edit': [str(error)]}},
+                                status=409)
+        except VisualCell.ConcurrentEditException as error:
+            return concurrent_edit_response(error)
+        except ValidationError as error:
+            return JsonResponse({'errors': {'edits': error.messages}},
+                                status=400)
+        return JsonResponse({'edits': [edit.id for edit in edits]},
+                            status=201)
+
+
 class VisualCellEditSuccessView(TemplateView):
 
     """Confirm cell edit success."""
 
     template_name = 'visual/visual_cell.html'
+
+
+class VisualInstrumentationView(StaffRequiredMixin, View):
+
+    """Rolling query count and timing percentiles per visual view."""
+
+    permission_denied_message = 'only staff may see instrumentation'
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(get_rolling_stats().get_summary())
+
+
+class VisualMetricsView(StaffRequiredMixin, View):
+
+    """
+    Canvas activity metrics in the Prometheus text format (see metrics).
+
+    Scrapers authenticate with an ``Authorization: Bearer`` header matching
+    VISUAL_METRICS_TOKEN, otherwise only staff may see them. Cells per
+    canvas and Celery queue depth are counted on each scrape.
+    """
+
+    permission_denied_message = 'only staff may see metrics'
+
+    def test_func(self):
+        token = settings.VISUAL_METRICS_TOKEN
+        return (super().test_func() or bool(token) and constant_time_compare(
+            self.request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'))
+
+    def get(self, request, *args, **kwargs):
+        metrics.clear_gauge('visual_canvas_cells')
+        for canvas_cells in VisualCell.objects.values('canvas_id').annotate(
+                cells=Count('id')).order_by():
+            metrics.set_gauge('visual_canvas_cells', canvas_cells['cells'],
+                              canvas=canvas_cells['canvas_id'])
+        metrics.clear_gauge('visual_celery_queue_depth')
+        for queue, depth in metrics.get_celery_queue_depths(
+                celery_app).items():
+            metrics.set_gauge('visual_celery_queue_depth', depth,
+                              queue=queue)
+        return HttpResponse(metrics.render(),
+                            content_type='text/plain; version=0.0.4')
+
+
+class VisualProfileListView(StaffRequiredMixin, TemplateView):
+
+    """List saved request and consumer profiles (see profiling)."""
+
+    template_name = 'visual/visual_profiles.html'
+    permission_denied_message = 'only staff may see profiles'
+
+    def get_context_data(self, **kwargs):
+        return super().get_context_data(profiles=get_profiles(), **kwargs)
+
+
+class VisualProfileView(StaffRequiredMixin, View):
+
+    """Download a saved profile for pstats or snakeviz."""
+
+    permission_denied_message = 'only staff may see profiles'
+
+    def get(self, request, *args, **kwargs):
+        name = kwargs['name']
+        if name not in {profile['name'] for profile in get_profiles()}:
+            raise Http404(f"No profile {name}")
+        return FileResponse(open(join(settings.VISUAL_PROFILE_DIR, name),
+                                 'rb'), as_attachment=True, filename=name)
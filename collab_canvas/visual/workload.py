@@ -0,0 +1,224 @@
+"""
+Synthetic canvases with many artists and edits, to test against.
+
+generate_workload creates a canvas of a shape
+
+    grid:       bounded, the smallest square fitting the artists by default
+    torus:      a grid whose edges wrap
+    organic:    no grid, growing a cell per artist
+
+and assigns it artists who each draw strokes: changes along consecutive
+positions of one edge of their cell. Assignment and edits are simulated in
+memory by engine.SimulatedCanvas, following the rules the models do, so
+shared edges are propagated to neighbours and every edit has the canvas
+sequence and edge sequences it would have had if saved one by one. They are
+then saved in bulk rather than a query per row: edits are streamed into
+services.copy_edits as they're drawn, then users, the canvas and cells are
+saved with bulk_create. Stroke distributions:
+
+    lengths:    fixed (stroke_length), uniform (1 to twice stroke_length
+                less 1) or exponential (stroke_length on average)
+    activity:   uniform, or pareto for a few artists drawing most strokes
+
+Edits are timestamped evenly over the hours before now. Users are named
+workload-<run>-<n>, so delete_workload(run) deletes them and with them the
+canvas, its cells and edits.
+"""
+from datetime import timedelta
+from itertools import accumulate, chain
+from math import ceil, sqrt
+from random import Random
+from time import perf_counter
+from typing import Dict, Iterator, List
+from uuid import uuid4
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.utils import timezone
+from django.utils.text import slugify
+
+from .engine import Layout, SimulatedCanvas, SimulatedCell, get_stroke
+from .models import VisualCanvas, VisualCell, VisualCellEdit
+from .services import copy_edits
+
+WORKLOAD_USERNAME_PREFIX = 'workload-'
+
+SHAPES = ('grid', 'torus', 'organic')
+
+STROKE_LENGTHS = {
+    'fixed': lambda random, length: length,
+    'uniform': lambda random, length: random.randint(1, 2*length - 1),
+    'exponential': lambda random, length: ceil(
+        random.expovariate(1/length)),
+}
+
+# Shape of the Pareto distribution where 20% of artists draw 80% of strokes
+PARETO_ALPHA = 1.16
+
+BULK_CREATE_BATCH_SIZE = 1000
+
+
+class WorkloadError(Exception):
+    pass
+
+
+class RecordingCanvas(SimulatedCanvas):
+
+    """A SimulatedCanvas keeping each edit written as a VisualCellEdit."""
+
+    __slots__ = ('cell_ids', 'artist_ids', 'timestamp', 'pending')
+
+    def __init__(self, layout: Layout, artist_ids: List, cell_width: int,
+                 cell_height: int, colour_range: int, random: Random,
+                 timestamp):
+        self.cell_ids: Dict[tuple, object] = {}
+        self.artist_ids = artist_ids
+        self.timestamp = timestamp
+        self.pending: List[VisualCellEdit] = []
+        super().__init__(layout, cell_width, cell_height, colour_range,
+                         random)
+
+    def written(self, cell: SimulatedCell, sequence: int,
+                neighbour_edit: int = None, artist=None):
+        cell_id = self.cell_ids.setdefault(cell.coordinates, uuid4())
+        self.pending.append(VisualCellEdit(
+            cell_id=cell_id, timestamp=self.timestamp, _order=cell.edits - 1,
+            artist_id=None if artist is None else self.artist_ids[artist],
+            neighbour_edit=neighbour_edit, sequence=sequence,
+            edge_sequences=list(cell.sequences), **cell.get_edges()))
+
+    def take_pending(self) -> List[VisualCellEdit]:
+        pending, self.pending = self.pending, []
+        return pending
+
+
+def get_artist_choices(random: Random, artists: int, strokes: int,
+                       activity: str) -> List[int]:
+    """Which artist draws each stroke."""
+    if activity == 'uniform':
+        return [random.randrange(artists) for _ in range(strokes)]
+    cum_weights = list(accumulate(random.paretovariate(PARETO_ALPHA)
+                                  for _ in range(artists)))
+    return random.choices(range(artists), cum_weights=cum_weights, k=strokes)
+
+
+def draw(canvas: RecordingCanvas, strokes: int, stroke_length: int,
+         lengths: str, activity: str, start, duration: timedelta,
+         counts: dict) -> Iterator[VisualCellEdit]:
+    """Draw strokes, yielding the edits each writes."""
+    random = canvas.random
+    get_length = STROKE_LENGTHS[lengths]
+    cells = [canvas.artists[artist] for artist in range(len(canvas.artists))]
+    for number, artist in enumerate(get_artist_choices(
+            random, len(cells), strokes, activity)):
+        canvas.timestamp = start + duration * number / strokes
+        stroke = get_stroke(canvas.geometry,
+                            get_length(random, stroke_length),
+                            canvas.colour_range, random)
+        if canvas.edit(cells[artist], stroke):
+            counts['own_edits'] += 1
+        yield from canvas.take_pending()
+
+
+def generate_workload(shape: str = 'grid', artists: int = 100,
+                      edits: int = 100, grid_size: int = None,
+                      cell_size: int = 8, colour_range: int = 1,
+                      stroke_length: int = 4, lengths: str = 'fixed',
+                      activity: str = 'uniform', hours: float = 1,
+                      seed: int = None) -> dict:
+    """
+    Create a canvas with artists drawing edits strokes each on average.
+
+    Returns statistics, with the run to pass to delete_workload.
+    """
+    if shape not in SHAPES:
+        raise WorkloadError(f"Shape must be one of {', '.join(SHAPES)}")
+    if lengths not in STROKE_LENGTHS:
+        raise WorkloadError("Stroke lengths must be one of "
+                            f"{', '.join(STROKE_LENGTHS)}")
+    if artists < 1 or edits < 0 or stroke_length < 1:
+        raise WorkloadError("Artists and stroke length must be positive, "
+                            "and edits not negative")
+    if shape == 'organic':
+        grid_size = 0
+    elif grid_size is None:
+        grid_size = max(ceil(sqrt(artists)), 3 if shape == 'torus' else 1)
+    elif grid_size**2 < artists:
+        raise WorkloadError(f"A {grid_size}x{grid_size} grid can't fit "
+                            f"{artists} artists")
+    elif shape == 'torus' and grid_size < 3:
+        raise WorkloadError("A torus must be at least 3x3")
+    User = get_user_model()
+    run = uuid4().hex[:8]
+    now = timezone.now()
+    duration = timedelta(hours=hours)
+    start = now - duration
+    artist_ids = [uuid4() for _ in range(artists)]
+    canvas = RecordingCanvas(
+        Layout(grid_size, grid_size, shape == 'torus', shape == 'organic'),
+        artist_ids, cell_size, cell_size, colour_range, Random(seed), start)
+    started = perf_counter()
+    for artist in range(artists):
+        canvas.assign(artist)
+    counts = {'own_edits': 0}
+    strokes = artists * edits
+    # Foreign keys are checked on commit, so edits are copied as they're
+    # drawn and the canvas and cells saved after, with their final state
+    with transaction.atomic():
+        copied = copy_edits(chain(
+            canvas.take_pending(),
+            draw(canvas, strokes, stroke_length, lengths, activity, start,
+                 duration, counts)))
+        password = make_password(None)
+        creator = User(username=f'{WORKLOAD_USERNAME_PREFIX}{run}-creator',
+                       password=password, is_superuser=True)
+        User.objects.bulk_create(
+            [creator] + [User(id=artist_id, password=password,
+                              username=f'{WORKLOAD_USERNAME_PREFIX}{run}-'
+                                       f'{artist}')
+                         for artist, artist_id in enumerate(artist_ids)],
+            batch_size=BULK_CREATE_BATCH_SIZE)
+        title = f'Workload {run}'
+        # bulk_create sends no post_save, so no grid is generated
+        visual_canvas, = VisualCanvas.objects.bulk_create([VisualCanvas(
+            title=title, slug=slugify(title), creator=creator,
+            start_time=start, end_time=now + timedelta(days=1),
+            grid_width=grid_size, grid_height=grid_size,
+            cell_width=cell_size, cell_height=cell_size,
+            cell_colour_range=colour_range, is_torus=shape == 'torus',
+            new_cells_allowed=shape == 'organic',
+            sequence=canvas.sequence)])
+        VisualCell.objects.bulk_create(
+            (VisualCell(id=canvas.cell_ids[coordinates],
+                        canvas=visual_canvas, x_position=coordinates[0],
+                        y_position=coordinates[1], width=cell_size,
+                        height=cell_size, colour_range=colour_range,
+                        artist_id=(None if cell.artist is None
+                                   else artist_ids[cell.artist]),
+                        version=cell.edits - 1)
+             for coordinates, cell in canvas.cells.items()),
+            batch_size=BULK_CREATE_BATCH_SIZE)
+    seconds = perf_counter() - started
+    return {
+        'run': run,
+        'canvas': str(visual_canvas.id),
+        'slug': visual_canvas.slug,
+        'shape': shape,
+        'artists': artists,
+        'cells': len(canvas.cells),
+        'strokes': strokes,
+        'edits': copied,
+        'first_edits': len(canvas.cells),
+        'own_edits': counts['own_edits'],
+        'neighbour_edits': copied - len(canvas.cells) - counts['own_edits'],
+        'seconds': seconds,
+        'edits_per_second': copied / seconds,
+    }
+
+
+def delete_workload(run: str) -> int:
+    """Delete a run's users, canvas, cells and edits, returning rows."""
+    deleted, _ = get_user_model().objects.filter(
+        username__startswith=f'{WORKLOAD_USERNAME_PREFIX}{run}-').delete()
+    return deleted
@@ -140,6 +140,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'collab_canvas.visual.instrumentation.VisualInstrumentationMiddleware',
+    'collab_canvas.visual.profiling.VisualProfilingMiddleware',
 ]
 
 # STATIC
@@ -268,3 +270,61 @@ INSTALLED_APPS += ['compressor']
 STATICFILES_FINDERS += ['compressor.finders.CompressorFinder']
 # Your stuff...
 # ------------------------------------------------------------------------------
+# Channels
+# ------------------------------------------------------------------------------
+# https://channels.readthedocs.io/en/latest/topics/channel_layers.html
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'CONFIG': {
+            'hosts': [env('REDIS_URL', default='redis://localhost:6379/0')],
+        },
+    },
+}
+# Visual
+# ------------------------------------------------------------------------------
+# Seconds live edits over websockets are buffered before being saved in bulk,
+# 0 saves each edit as it is received. Buffered changes can be lost if a worker
+# dies or a flush keeps failing, so enable it per environment (e.g. 0.5)
+VISUAL_EDIT_FLUSH_INTERVAL = env.float('VISUAL_EDIT_FLUSH_INTERVAL', default=0)
+# Buffered changes to a cell which force a save before the interval, bounding
+# how many changes are lost if a worker dies before flushing
+VISUAL_EDIT_BUFFER_MAX_CHANGES = env.int('VISUAL_EDIT_BUFFER_MAX_CHANGES',
+                                         default=256)
+# Seconds without a heartbeat before a websocket connection is no longer
+# counted as present in a cell
+VISUAL_PRESENCE_TIMEOUT = env.int('VISUAL_PRESENCE_TIMEOUT', default=30)
+# Messages waiting to be sent to a slow websocket client before neighbour
+# changes are merged and older replies dropped for a resync snapshot
+VISUAL_OUTBOUND_QUEUE_SIZE = env.int('VISUAL_OUTBOUND_QUEUE_SIZE', default=64)
+# Patches per second each websocket connection may send, with bursts of up to
+# VISUAL_STROKE_BURST, 0 disables the limit
+VISUAL_STROKE_RATE = env.float('VISUAL_STROKE_RATE', default=30)
+VISUAL_STROKE_BURST = env.int('VISUAL_STROKE_BURST', default=60)
+# Seconds websocket connections may use a cached session user and their
+# assigned cells, logging out and saving cells invalidate them sooner
+VISUAL_AUTH_CACHE_TIMEOUT = env.int('VISUAL_AUTH_CACHE_TIMEOUT', default=60)
+# Requests per visual view kept for rolling query and timing percentiles
+VISUAL_INSTRUMENTATION_WINDOW = env.int('VISUAL_INSTRUMENTATION_WINDOW',
+                                        default=1000)
+# Bearer token Prometheus scrapes visual metrics with, staff need none
+VISUAL_METRICS_TOKEN = env('VISUAL_METRICS_TOKEN', default='')
+# Fraction of edits traced stage by stage into VISUAL_TRACE_LOG (JSON lines)
+VISUAL_TRACE_SAMPLE_RATE = env.float('VISUAL_TRACE_SAMPLE_RATE', default=0.0)
+VISUAL_TRACE_LOG = env('VISUAL_TRACE_LOG',
+                       default=str(ROOT_DIR('visual_traces.log')))
+# Fraction of visual requests and consumer commits profiled with cProfile,
+# staff can ask for a profile with an X-Visual-Profile: 1 header
+VISUAL_PROFILE_SAMPLE_RATE = env.float('VISUAL_PROFILE_SAMPLE_RATE',
+                                       default=0.0)
+VISUAL_PROFILE_DIR = env('VISUAL_PROFILE_DIR',
+                         default=str(ROOT_DIR('visual_profiles')))
+# Newest profiles kept in VISUAL_PROFILE_DIR
+VISUAL_PROFILE_KEEP = env.int('VISUAL_PROFILE_KEEP', default=100)
+# File every assignment, edit request and websocket message is appended to,
+# for the replay command, empty disables capture
+VISUAL_CAPTURE_LOG = env('VISUAL_CAPTURE_LOG', default='')
+# Multiplies the seconds of query budgets for slower machines, 0 only checks
+# query counts (see collab_canvas.visual.budgets)
+VISUAL_BUDGET_SECONDS_SCALE = env.float('VISUAL_BUDGET_SECONDS_SCALE',
+                                        default=1.0)